@@ -5,68 +5,151 @@ const THUMBNAIL_SIZE = 150
 const THUMBNAIL_MARGIN = 16
 const THUMBNAIL_MSIZE = THUMBNAIL_SIZE + THUMBNAIL_MARGIN
 
+// sprite chunks are 10 tiles wide, each tile has 2px padding
+const SPRITE_WIDTH = 10 * (THUMBNAIL_SIZE + 2)
+// rows rendered above and below the viewport
+const OVERSCAN_ROWS = 9
+
 const GALLERY_STATE = {
-    'dirIndex': null, // {dirName: numEntries, ....}
-    'dirNames': null, // [dirName, ....]
+    'manifest': null, // {dirs: [dirName, ...], offsets: [...], total: numEntries}, newest first
     'totalEntries': -1,
     'debounceTimeout': null,
     'lastRenderState': null,
     'dataSource': null,
+    'blocks': {}, // {dirName: entryBlock}, embedded in index.html by scripts/gen_html.py
+    'ranking': null, // entries of images/top_<scope>_<metric>.json, for #top/<scope>/<metric>
 }
 
-async function updateDataSources(itemIndex) {
-    // scan through directories
-    var dirStartIndex = 0
-    for (var dirCursor = GALLERY_STATE.dirNames.length - 1; dirCursor >= 0; dirCursor--) {
-        var dirEntryCount = GALLERY_STATE.dirIndex[GALLERY_STATE.dirNames[dirCursor]]
-        if (itemIndex > dirStartIndex + dirEntryCount) {
-            dirStartIndex += dirEntryCount
+// #top/all/rct, #top/2025/fwd, #top/2025-09/rct
+const RANKING_HASH_RE = /^#top\/(all|\d{4}|\d{4}-\d{2})\/(rct|fwd)$/
+
+function findDirCursor(itemIndex) {
+    // binary search for the last dir with offset <= itemIndex
+    const offsets = GALLERY_STATE.manifest.offsets
+    var lo = 0
+    var hi = offsets.length - 1
+    while (lo < hi) {
+        const mid = (lo + hi + 1) >> 1
+        if (offsets[mid] <= itemIndex) {
+            lo = mid
         } else {
-            break
+            hi = mid - 1
+        }
+    }
+    return lo
+}
+
+function blockEntries(block) {
+    // expand a columnar entry_block.json to entries
+    const entries = []
+    for (var i = 0; i < block.names.length; i++) {
+        const chunkSlot = block.t[i] % block.chunk
+        entries.push({
+            name: block.names[i],
+            w: block.w[i],
+            h: block.h[i],
+            x: (chunkSlot % block.cols) * block.tile,
+            y: Math.floor(chunkSlot / block.cols) * block.tile,
+            s: block.sprites[Math.floor(block.t[i] / block.chunk)],
+        })
+    }
+    return entries
+}
+
+function derivedSrcset(dirURL, entry, derivedWidths) {
+    // downscaled copies in <dir>/derived/ (only narrower than the original)
+    const stem = entry.name.replace(/\.[^.]+$/, "")
+    const candidates = []
+    for (const derivedWidth of derivedWidths) {
+        if (derivedWidth < entry.w) {
+            candidates.push(`${dirURL}/derived/${stem}_${derivedWidth}w.jpg ${derivedWidth}w`)
+        }
+    }
+    if (candidates.length == 0) {
+        return undefined
+    }
+    candidates.push(`${dirURL}/${entry.name} ${entry.w}w`)
+    return candidates.join(", ")
+}
+
+function rankingDataSources() {
+    // all ranked entries are in one file, with their dir, in order
+    const fallbackHost = location.protocol + "//" + location.host
+    const ranking = GALLERY_STATE.ranking
+    const dataSourceItems = GALLERY_STATE.dataSource
+
+    for (var i = 0; i < ranking.length && !dataSourceItems[i]; i++) {
+        var entry = ranking[i]
+        var host = IMG_HOSTS[entry.dir.split("/")[0]] || fallbackHost;
+        var derivedWidths = (entry.d || []).map(function(size) {return size[0]})
+
+        dataSourceItems[i] = {
+            src: `${host}/images/${entry.dir}/${entry.name}`,
+            srcset: derivedSrcset(`${host}/images/${entry.dir}`, entry, derivedWidths),
+            width: entry.w,
+            height: entry.h,
+            bgOffsetX: entry.x,
+            bgOffsetY: entry.y,
+            thumbSrc: `${host}/images/${entry.dir}/${entry.s}`,
+            galleryIndex: i,
         }
     }
 
+    return {
+       dirCursor: "top",
+       dirStartIndex: 0,
+       dataSourceItems: dataSourceItems,
+    }
+}
+
+async function updateDataSources(itemIndex, lastItemIndex) {
+    if (GALLERY_STATE.ranking) {
+        return rankingDataSources()
+    }
+
+    // load the dirs of all items from itemIndex to lastItemIndex
+    const manifest = GALLERY_STATE.manifest
+    const dirCursor = findDirCursor(itemIndex)
+    const lastDirCursor = findDirCursor(Math.min(lastItemIndex || itemIndex, manifest.total - 1))
+    const dirStartIndex = manifest.offsets[dirCursor]
+
     const dirNames = []
     const entryPromises = []
-    const thumbSrcs = []
 
     const fallbackHost = location.protocol + "//" + location.host
 
-    for (var i = dirCursor; i >= Math.max(0, dirCursor - 1); i--) {
-        var dirName = GALLERY_STATE.dirNames[i]
+    for (var i = dirCursor; i <= lastDirCursor; i++) {
+        var dirName = manifest.dirs[i]
         dirNames.push(dirName)
 
         var host = IMG_HOSTS[dirName.split("/")[0]] || fallbackHost;
 
-        var dirURL = `${host}/images/${dirName}/entry_index.json`
-        entryPromises.push(fetchJson(dirURL))
-
-        var thumbSrc = `${host}/images/${dirName}/thumbnails.jpg?cb=${CB}`
-        thumbSrcs.push(thumbSrc)
-
-        new Image().src = thumbSrc;
+        var dirURL = `${host}/images/${dirName}/entry_block.json`
+        entryPromises.push(GALLERY_STATE.blocks[dirName] || fetchJson(dirURL))
     }
 
-    const entryIndexes = await Promise.all(entryPromises)
+    const entryBlocks = await Promise.all(entryPromises)
 
     const dataSourceItems = []
 
-    for (var i = 0; i < entryIndexes.length; i++) {
+    for (var i = 0; i < entryBlocks.length; i++) {
         var dirName = dirNames[i]
-        var entryIndex = entryIndexes[i]
-        var thumbSrc = thumbSrcs[i]
+        var entryIndex = blockEntries(entryBlocks[i])
 
         var host = IMG_HOSTS[dirName.split("/")[0]] || fallbackHost;
+        var derivedWidths = entryBlocks[i].dw || []
 
         for (var j = entryIndex.length - 1; j >= 0; j--) {
             var entry = entryIndex[j]
             dataSourceItems.push({
                 src: `${host}/images/${dirName}/${entry.name}`,
+                srcset: derivedSrcset(`${host}/images/${dirName}`, entry, derivedWidths),
                 width: entry.w,
                 height: entry.h,
                 bgOffsetX: entry.x,
                 bgOffsetY: entry.y,
-                thumbSrc: thumbSrc,
+                // sprite chunk, without scale suffix and extension
+                thumbSrc: `${host}/images/${dirName}/${entry.s}`,
                 galleryIndex: dirStartIndex + dataSourceItems.length,
             })
         }
@@ -77,15 +160,25 @@ async function updateDataSources(itemIndex) {
     }
 
     return {
-       dirCursor: dirCursor,
+       dirCursor: dirCursor + ":" + lastDirCursor,
        dirStartIndex: dirStartIndex,
        dataSourceItems: dataSourceItems,
     }
 }
 
 
+function spriteImageSet(thumbSrc) {
+    return [
+        `url('${thumbSrc}.webp') type('image/webp') 1x`,
+        `url('${thumbSrc}@2x.webp') type('image/webp') 2x`,
+        `url('${thumbSrc}.jpg') type('image/jpeg') 1x`,
+        `url('${thumbSrc}@2x.jpg') type('image/jpeg') 2x`,
+    ].join(", ")
+}
+
+
 async function updateGallery() {
-    if (!GALLERY_STATE.dirNames) {return}  // not yet initialized
+    if (!GALLERY_STATE.manifest) {return}  // not yet initialized
 
     const galleryNode = document.getElementById("gallery")
 
@@ -96,12 +189,17 @@ async function updateGallery() {
     galleryNode.style.height = (totalRows * THUMBNAIL_MSIZE) + "px"
 
     const scrollTop = document.documentElement.scrollTop
-    const scrollRow = Math.max(0, Math.floor(scrollTop / THUMBNAIL_MSIZE) - 9)
+    const scrollRow = Math.max(0, Math.floor(scrollTop / THUMBNAIL_MSIZE) - OVERSCAN_ROWS)
     const scrollEntry = scrollRow * tnColumns
+    const lastRow = scrollRow + Math.ceil(window.innerHeight / THUMBNAIL_MSIZE) + 2 * OVERSCAN_ROWS
 
-    const ds = await updateDataSources(scrollEntry)
+    const ds = await updateDataSources(scrollEntry, (lastRow + 1) * tnColumns - 1)
 
-    const renderState = ds.dirCursor + ":" + tnColumns + ":" + parseInt(window.innerWidth / 10)
+    // only thumbnails near the viewport are rendered, so only the
+    // sprite chunks they are in are downloaded
+    const renderState = [
+        ds.dirCursor, tnColumns, parseInt(window.innerWidth / 10), scrollRow, lastRow,
+    ].join(":")
 
     if (GALLERY_STATE.lastRenderState == renderState) {
         return
@@ -112,21 +210,33 @@ async function updateGallery() {
     var entryRow = 0
     var entryCol = ds.dirStartIndex % tnColumns
 
-    const dirOffsetTop = Math.round(((ds.dirStartIndex - entryCol) / tnColumns) * THUMBNAIL_MSIZE)
+    const dirStartRow = (ds.dirStartIndex - entryCol) / tnColumns
+    const dirOffsetTop = Math.round(dirStartRow * THUMBNAIL_MSIZE)
 
     const thumbnailsHTML = []
 
     for (var i = 0; i < ds.dataSourceItems.length; i++) {
         var item = ds.dataSourceItems[i]
 
+        const galleryRow = dirStartRow + entryRow
+        if (galleryRow < scrollRow || galleryRow > lastRow) {
+            entryCol += 1
+            if (entryCol >= tnColumns) {
+                entryRow += 1
+                entryCol = 0
+            }
+            continue
+        }
+
         const offsetTop = dirOffsetTop + (entryRow * THUMBNAIL_MSIZE)
         const offsetLeft = marginLeft + entryCol * THUMBNAIL_MSIZE
 
         const thumbStyles = [
             `top: ${offsetTop}px;`,
             `left: ${offsetLeft}px;`,
-            `background-image: url('${item.thumbSrc}');`,
-            // `background-size: ${THUMBNAIL_SIZE}px ${THUMBNAIL_SIZE}px;`,
+            `background-image: url('${item.thumbSrc}.jpg');`,
+            `background-image: image-set(${spriteImageSet(item.thumbSrc)});`,
+            `background-size: ${SPRITE_WIDTH}px auto;`,
             `background-position: -${item.bgOffsetX}px -${item.bgOffsetY}px;`,
         ]
 
@@ -153,7 +263,7 @@ async function updateGallery() {
 
 
 async function updateGalleryHandler(evt) {
-    if (!GALLERY_STATE.dirNames) {return}  // not yet initialized
+    if (!GALLERY_STATE.manifest) {return}  // not yet initialized
 
     if (evt.constructor.name == 'PhotoSwipeEvent') {
         const lookBackIndex = Math.max(lightbox.pswp.currIndex - 30, 0)
@@ -213,21 +323,47 @@ function initHandlers() {
     window.addEventListener('resize', updateGalleryHandler)
     window.addEventListener('click', galleryClickHandler)
     window.addEventListener('click', navClickHandler)
+    window.addEventListener('hashchange', function(evt) {
+        if (RANKING_HASH_RE.test(location.hash) || GALLERY_STATE.ranking) {
+            location.reload()
+        }
+    })
 }
 
-async function initGallery() {
-    GALLERY_STATE.dirIndex = await fetchJson("images/dir_index.json")
-    GALLERY_STATE.dirNames = []
-
-    GALLERY_STATE.totalEntries = 0;
+async function refreshManifest() {
+    // the embedded months are from the last build, there might be newer ones
+    const manifest = await fetchJson("images/gallery_manifest.json")
+    const oldManifest = GALLERY_STATE.manifest
+    const manifestKey = function(m) {return JSON.stringify([m.dirs, m.offsets, m.total])}
+    if (manifestKey(manifest) == manifestKey(oldManifest)) {return}
+
+    GALLERY_STATE.manifest = manifest
+    GALLERY_STATE.blocks = {}
+    GALLERY_STATE.totalEntries = manifest.total
+    GALLERY_STATE.dataSource = []
+    GALLERY_STATE.dataSource.length = manifest.total
+    GALLERY_STATE.lastRenderState = null
+    updateGallery()
+}
 
-    Object.entries(GALLERY_STATE.dirIndex).forEach(([dirName, numEntries]) => {
-      // console.log(`dirName: ${dirName}, numEntries: ${numEntries}`);
-      GALLERY_STATE.totalEntries += numEntries
-      GALLERY_STATE.dirNames.push(dirName)
-    });
+async function initGallery() {
+    const preloadNode = document.getElementById("gallery-preload")
+
+    const rankingMatch = RANKING_HASH_RE.exec(location.hash)
+    if (rankingMatch) {
+        // one precomputed ranking instead of the months
+        GALLERY_STATE.ranking = await fetchJson(`images/top_${rankingMatch[1]}_${rankingMatch[2]}.json`)
+        GALLERY_STATE.manifest = {dirs: ["top"], offsets: [0], total: GALLERY_STATE.ranking.length}
+    } else if (preloadNode) {
+        // the first screen is already rendered, app.js only takes over
+        const preload = JSON.parse(preloadNode.textContent)
+        GALLERY_STATE.manifest = preload.manifest
+        GALLERY_STATE.blocks = preload.blocks
+    } else {
+        GALLERY_STATE.manifest = await fetchJson("images/gallery_manifest.json")
+    }
+    GALLERY_STATE.totalEntries = GALLERY_STATE.manifest.total
 
-    GALLERY_STATE.dirNames.sort()
     GALLERY_STATE.dataSource = [
         // {src: '...', width: ..., height: ...},
     ]
@@ -235,6 +371,10 @@ async function initGallery() {
 
     updateGallery()
     initHandlers()
+
+    if (preloadNode && !GALLERY_STATE.ranking) {
+        refreshManifest()
+    }
 }
 
 initGallery()
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the ingest and dedup code on a synthetic archive.
+
+A synthetic archive repo with --months months of --per-month JPEGs
+(realistic sizes and aspect ratios, named like the real uploads) is
+generated in a temporary directory. Then each benchmark is run cold
+(outputs and decode cache removed, images evicted from the page cache) and
+warm (outputs up to date, files cached), --repeat times each.
+
+Everything runs offline, the Telegram channel is replaced by
+fake_telegram.FakeClient.
+
+Usage:
+
+    ./scripts/bench_ingest.py [options]
+
+Options:
+
+    --months=3          number of months in the synthetic archive
+    --per-month=100     number of images per month
+    --repeat=3          number of runs of each benchmark and mode
+    --seed=1            seed of the synthetic archive
+    --workers=N         number of ingest workers (default: one per cpu)
+    --out=PATH          write the results as json to PATH (default: stdout)
+    --compare=PATH      print the change relative to the results in PATH
+    --keep=DIR          generate the archive in DIR and keep it
+"""
+
+import io
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import random
+import platform
+import tempfile
+import statistics
+import contextlib
+import pathlib as pl
+import datetime as dt
+
+# panzer_imgsync only needs these to talk to Telegram
+os.environ.setdefault('PANZER_IMGSYNC_API_ID', "0")
+os.environ.setdefault('PANZER_IMGSYNC_API_HASH', "bench")
+
+import fake_telegram
+import ingest_uploads
+import panzer_digest
+import panzer_imgsync
+
+DEFAULT_OPTIONS = {
+    'months'   : 3,
+    'per-month': 100,
+    'repeat'   : 3,
+    'seed'     : 1,
+    'workers'  : 0,
+}
+
+# (width, height, weight) of telegram photos, which are at most 1280px
+IMG_SIZES = [
+    (1280,  960, 4),
+    ( 960, 1280, 4),
+    (1280,  720, 3),
+    ( 720, 1280, 3),
+    (1280, 1280, 2),
+    (1280,  853, 2),
+    ( 853, 1280, 2),
+    ( 640,  640, 1),
+    ( 800,  450, 1),
+]
+
+# share of messages in the dedup benchmark that are re-posts of archived images
+DUP_SHARE = 0.5
+
+
+def mk_synthetic_img(rng: random.Random, width: int, height: int) -> bytes:
+    """A JPEG with gradients, shapes and some noise, which compresses
+    about as well as a photo or meme."""
+    import numpy as np
+    from PIL import Image, ImageDraw
+
+    np_rng = np.random.default_rng(rng.getrandbits(32))
+    ys = np.linspace(0.0, 1.0, height, dtype=np.float32)[:, None, None]
+    xs = np.linspace(0.0, 1.0, width, dtype=np.float32)[None, :, None]
+    color_a = np_rng.uniform(0, 255, 3).astype(np.float32)
+    color_b = np_rng.uniform(0, 255, 3).astype(np.float32)
+    pixels = color_a * (1 - xs) * ys + color_b * xs * (1 - ys) + 64 * xs * ys
+    pixels += np_rng.normal(0, 12, (height, width, 3)).astype(np.float32)
+    img = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), "RGB")
+
+    draw = ImageDraw.Draw(img)
+    for _ in range(rng.randrange(4, 16)):
+        x0 = rng.randrange(width)
+        y0 = rng.randrange(height)
+        x1 = x0 + rng.randrange(20, width // 2)
+        y1 = y0 + rng.randrange(20, height // 2)
+        fill = tuple(rng.randrange(256) for _ in range(3))
+        if rng.random() < 0.5:
+            draw.rectangle((x0, y0, x1, y1), fill=fill)
+        else:
+            draw.ellipse((x0, y0, x1, y1), fill=fill)
+    for _ in range(rng.randrange(0, 6)):
+        # text-like strokes, as in memes
+        x0 = rng.randrange(width // 2)
+        y0 = rng.randrange(height)
+        draw.line((x0, y0, x0 + rng.randrange(50, width // 2), y0), fill=(255, 255, 255), width=6)
+
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=rng.choice([80, 85, 87, 90]))
+    return out.getvalue()
+
+
+def _recent_months(num_months: int) -> list[dt.date]:
+    month = dt.date.today().replace(day=1)
+    months = []
+    for _ in range(num_months):
+        months.append(month)
+        month = (month - dt.timedelta(days=1)).replace(day=1)
+    return months[::-1]
+
+
+def mk_synthetic_archive(
+    repo_dir: pl.Path, months: int, per_month: int, seed: int = 1,
+) -> list[pl.Path]:
+    """Write an archive repo with images named like the real uploads.
+
+    The months end with the current one (up to now), so the images are
+    within the lookback window of the digest index.
+    """
+    rng = random.Random(seed)
+    sizes = [(w, h) for w, h, weight in IMG_SIZES for _ in range(weight)]
+    now = dt.datetime.now().replace(microsecond=0)
+
+    img_paths = []
+    msg_id = 20000
+    for month in _recent_months(months):
+        month_dir = repo_dir / "images" / f"{month.year:04}" / f"{month.month:02}"
+        month_dir.mkdir(parents=True, exist_ok=True)
+
+        month_start = dt.datetime(month.year, month.month, 1)
+        month_secs = min(28 * 24 * 3600, int((now - month_start).total_seconds()) + 1)
+        secs = sorted(rng.randrange(month_secs) for _ in range(per_month))
+        for sec in secs:
+            width, height = rng.choice(sizes)
+            data = mk_synthetic_img(rng, width, height)
+            date = month_start + dt.timedelta(seconds=sec)
+            fname_prefix = date.isoformat().replace(":", "")[:17]
+            digest = panzer_digest.digest_img(data)
+
+            img_path = month_dir / f"{fname_prefix}_{msg_id}_{digest}.jpg"
+            with img_path.open(mode='wb') as fobj:
+                fobj.write(data)
+            img_paths.append(img_path)
+            msg_id += 1
+
+    return img_paths
+
+
+def _evict_page_cache(paths: list[pl.Path]) -> None:
+    """Ask the kernel to drop cached pages of the files (Linux only)."""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def _remove_ingest_outputs(repo_dir: pl.Path, thumbnails: bool = True, derived: bool = True) -> None:
+    shutil.rmtree(repo_dir / ingest_uploads.CACHE_DIR_NAME, ignore_errors=True)
+    shutil.rmtree(ingest_uploads.DECODE_CACHE_DIR, ignore_errors=True)
+    for month_dir in (repo_dir / "images").glob("*/*"):
+        for path in month_dir.iterdir():
+            if path.name == ingest_uploads.DERIVED_DIR_NAME:
+                if derived:
+                    shutil.rmtree(path)
+            elif ingest_uploads.is_sprite_name(path.name) or path.name == ingest_uploads.THUMBNAILS_INDEX_NAME:
+                if thumbnails:
+                    path.unlink()
+            elif path.suffix == ".json":
+                path.unlink()
+
+
+def _point_imgsync_at(repo_dir: pl.Path, cache_dir: pl.Path) -> None:
+    panzer_imgsync.ROOT_DIR = repo_dir
+    panzer_imgsync.IMAGES_DIR = repo_dir / "images"
+    panzer_imgsync.CACHE_DIR = cache_dir
+    panzer_imgsync.DIGEST_INDEX_PATH = cache_dir / "digest_index.jsonl"
+    panzer_imgsync.SYNC_JOURNAL_PATH = cache_dir / "sync_journal.jsonl"
+    panzer_imgsync.DOWNLOADS_DIR = cache_dir / "downloads"
+    panzer_imgsync.IMG_REPOS = {}
+
+
+def _dedup_messages(img_paths: list[pl.Path], seed: int) -> list:
+    """Messages that re-post a DUP_SHARE of the archived images, a day later."""
+    rng = random.Random(seed)
+    messages = []
+    for i, img_path in enumerate(img_paths):
+        if rng.random() >= DUP_SHARE:
+            continue
+
+        with img_path.open(mode='rb') as fobj:
+            photo = fobj.read()
+
+        date = dt.datetime.strptime(img_path.name[:17], "%Y-%m-%dT%H%M%S")
+        date = date.replace(tzinfo=dt.timezone.utc) + dt.timedelta(days=1)
+        messages.append(fake_telegram.mk_message(100000 + i, date, photo, forwards=i % 7))
+    return messages
+
+
+def _fetch_dups(messages: list) -> dict:
+    client = fake_telegram.FakeClient(messages)
+    with contextlib.redirect_stdout(io.StringIO()):
+        new_messages = client.loop.run_until_complete(panzer_imgsync.fetch_api_messages({}, client=client))
+    # the messages are not dumped, a journal left behind would be resumed by the next fetch
+    panzer_imgsync.clear_sync_journal()
+    return new_messages
+
+
+def _run(name: str, mode: str, func, setup=None, repeat: int = 3) -> dict:
+    times = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            if setup:
+                setup()
+            t0 = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - t0)
+
+    result = {
+        'name'  : name,
+        'mode'  : mode,
+        'runs'  : [round(t, 6) for t in times],
+        'min'   : round(min(times), 6),
+        'median': round(statistics.median(times), 6),
+    }
+    print(f"{name:<20} {mode:<5} min {result['min']:>9.3f} s  median {result['median']:>9.3f} s", file=sys.stderr)
+    return result
+
+
+def run_benchmarks(repo_dir: pl.Path, img_paths: list[pl.Path], options: dict) -> list[dict]:
+    repeat = options['repeat']
+    workers = options['workers'] or None
+    results = []
+
+    def evict():
+        _evict_page_cache(img_paths)
+
+    def cold_indexes():
+        _remove_ingest_outputs(repo_dir)
+        evict()
+
+    def update_indexes():
+        ingest_uploads.update_indexes(repo_dir, workers=workers)
+
+    results.append(_run("update_indexes", "cold", update_indexes, cold_indexes, repeat))
+    results.append(_run("update_indexes", "warm", update_indexes, None, repeat))
+
+    def cold_thumbnails():
+        _remove_ingest_outputs(repo_dir, derived=False)
+        ingest_uploads.update_indexes(repo_dir, workers=workers)
+        evict()
+
+    def update_thumbnails():
+        ingest_uploads.update_thumbnails(repo_dir, workers=workers)
+
+    results.append(_run("update_thumbnails", "cold", update_thumbnails, cold_thumbnails, repeat))
+    results.append(_run("update_thumbnails", "warm", update_thumbnails, None, repeat))
+
+    def cold_derived():
+        _remove_ingest_outputs(repo_dir, thumbnails=False)
+        ingest_uploads.update_indexes(repo_dir, workers=workers)
+        evict()
+
+    def update_derived():
+        ingest_uploads.update_derived(repo_dir, workers=workers)
+
+    results.append(_run("update_derived", "cold", update_derived, cold_derived, repeat))
+    results.append(_run("update_derived", "warm", update_derived, None, repeat))
+
+    def cold_ingest():
+        _remove_ingest_outputs(repo_dir)
+        evict()
+
+    def ingest():
+        ingest_uploads.ingest([repo_dir], workers=workers)
+
+    results.append(_run("ingest", "cold", ingest, cold_ingest, repeat))
+    results.append(_run("ingest", "warm", ingest, None, repeat))
+
+    def digest_img():
+        for img_path in img_paths:
+            panzer_digest.digest_img_path(img_path)
+
+    results.append(_run("digest_img", "cold", digest_img, evict, repeat))
+    results.append(_run("digest_img", "warm", digest_img, None, repeat))
+
+    def digest_imgs():
+        panzer_digest.digest_imgs(img_paths, workers=workers)
+
+    results.append(_run("digest_imgs", "cold", digest_imgs, evict, repeat))
+    results.append(_run("digest_imgs", "warm", digest_imgs, None, repeat))
+
+    # fetch_api_messages with re-posts of archived images, the digest
+    # index is built from scratch (cold) or already complete (warm)
+    cache_dir = repo_dir / ingest_uploads.CACHE_DIR_NAME
+    _point_imgsync_at(repo_dir, cache_dir)
+    messages = _dedup_messages(img_paths, options['seed'])
+
+    def cold_dedup():
+        if panzer_imgsync.DIGEST_INDEX_PATH.exists():
+            panzer_imgsync.DIGEST_INDEX_PATH.unlink()
+        evict()
+
+    def fetch_dups():
+        new_messages = _fetch_dups(messages)
+        assert all(message['name'] in img_names for message in new_messages.values())
+
+    img_names = {img_path.name for img_path in img_paths}
+    results.append(_run("fetch_api_messages", "cold", fetch_dups, cold_dedup, repeat))
+    results.append(_run("fetch_api_messages", "warm", fetch_dups, None, repeat))
+
+    return results
+
+
+def _meta(img_paths: list[pl.Path], options: dict) -> dict:
+    import numpy
+    import PIL
+
+    return {
+        'date'        : dt.datetime.now().isoformat(timespec='seconds'),
+        'python'      : platform.python_version(),
+        'platform'    : platform.platform(),
+        'cpu_count'   : os.cpu_count(),
+        'pillow'      : PIL.__version__,
+        'numpy'       : numpy.__version__,
+        'num_images'  : len(img_paths),
+        'num_bytes'   : sum(img_path.stat().st_size for img_path in img_paths),
+        'options'     : options,
+    }
+
+
+def _print_comparison(old_report: dict, new_report: dict) -> None:
+    old_results = {(result['name'], result['mode']): result for result in old_report['results']}
+    for result in new_report['results']:
+        old_result = old_results.get((result['name'], result['mode']))
+        if old_result is None or old_result['median'] == 0:
+            continue
+        change = result['median'] / old_result['median'] - 1
+        print(
+            f"{result['name']:<20} {result['mode']:<5}"
+            f" {old_result['median']:>9.3f} s -> {result['median']:>9.3f} s  {change:>+7.1%}",
+            file=sys.stderr,
+        )
+
+
+def _parse_options(args: list[str]) -> tuple[dict, list[str]]:
+    options = dict(DEFAULT_OPTIONS)
+    positional = []
+    for arg in args:
+        match = re.match(r"--([\w-]+)(?:=(.*))?$", arg)
+        if match is None:
+            positional.append(arg)
+        elif match.group(2) is None:
+            options[match.group(1)] = True
+        elif match.group(1) in DEFAULT_OPTIONS:
+            options[match.group(1)] = int(match.group(2))
+        else:
+            options[match.group(1)] = match.group(2)
+    return (options, positional)
+
+
+def main(args: list[str]) -> int:
+    options, positional = _parse_options(args)
+    if "help" in options or positional:
+        print(__doc__)
+        return 0
+
+    with contextlib.ExitStack() as stack:
+        if 'keep' in options:
+            bench_dir = pl.Path(options['keep'])
+            shutil.rmtree(bench_dir, ignore_errors=True)
+        else:
+            bench_dir = pl.Path(stack.enter_context(tempfile.TemporaryDirectory(prefix="panzer_bench_")))
+
+        repo_dir = bench_dir / "panzer-archiv-bench"
+        ingest_uploads.DECODE_CACHE_DIR = bench_dir / "decoded"
+        t0 = time.perf_counter()
+        img_paths = mk_synthetic_archive(repo_dir, options['months'], options['per-month'], options['seed'])
+        print(f"generated {len(img_paths)} images in {time.perf_counter() - t0:.1f} s", file=sys.stderr)
+
+        report = {
+            'meta'   : _meta(img_paths, options),
+            'results': run_benchmarks(repo_dir, img_paths, options),
+        }
+
+    report_data = json.dumps(report, indent=2, sort_keys=True)
+    if 'out' in options:
+        with pl.Path(options['out']).open(mode='w') as fobj:
+            fobj.write(report_data + "\n")
+    else:
+        print(report_data)
+
+    if 'compare' in options:
+        with pl.Path(options['compare']).open(mode='r') as fobj:
+            _print_comparison(json.load(fobj), report)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Load test of scripts/serve_static.py, optionally against `python -m http.server`.
+
+A temporary site is built from the pages, assets and json indexes of
+the www repo (with their .gz siblings) and a month of synthetic images.
+Each server is started in a subprocess and loaded by --connections
+keep-alive connections for --duration seconds per scenario:
+
+    pages       the page, assets and json indexes, with Accept-Encoding
+    images      full images
+    ranges      the first 64 kb of images
+    revalidate  images with If-Modified-Since (304)
+
+The load generator runs in this process, on one core. For absolute
+numbers use a native load generator like wrk, the numbers here are
+for comparing servers and changes on the same machine.
+
+Usage:
+
+    ./scripts/bench_serve.py [options]
+
+Options:
+
+    --connections=32    number of concurrent connections
+    --duration=5        seconds per scenario
+    --images=50         number of synthetic images
+    --workers=1         number of workers of serve_static.py
+    --baseline          also load `python -m http.server`
+    --out=PATH          write the results as json to PATH (default: stdout)
+    --compare=PATH      print the change relative to the results in PATH
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import socket
+import asyncio
+import platform
+import tempfile
+import statistics
+import contextlib
+import email.utils
+import pathlib as pl
+import datetime as dt
+import subprocess as sp
+
+import gen_html
+import bench_ingest
+
+ROOT_DIR = pl.Path(__file__).parent.parent
+
+DEFAULT_OPTIONS = {
+    'connections': 32,
+    'duration'   : 5,
+    'images'     : 50,
+    'workers'    : 1,
+}
+
+RANGE_BYTES = 64 * 1024
+SERVER_START_TIMEOUT_SECS = 10
+
+
+def mk_site(site_dir: pl.Path, num_images: int) -> dict[str, list[str]]:
+    """Copy the www repo to site_dir and add images, returns the paths by scenario."""
+    text_paths = [ROOT_DIR / "index.html"]
+    text_paths += sorted(ROOT_DIR.glob("assets/*"))
+    text_paths += sorted(ROOT_DIR.glob("images/*.json"))
+    for src_path in text_paths:
+        if src_path.is_file() and src_path.suffix not in (".gz", ".br"):
+            dst_path = site_dir / src_path.relative_to(ROOT_DIR)
+            dst_path.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(src_path, dst_path)
+
+    page_paths = [site_dir / "index.html"]
+    with (site_dir / "index.html").open(mode='r') as fobj:
+        page_paths += [site_dir / path for path in sorted(set(re.findall(r'"/(assets/[^"]+)"', fobj.read())))]
+    page_paths += sorted(site_dir.glob("images/*.json"))
+    gen_html.precompress(page_paths)
+
+    img_paths = bench_ingest.mk_synthetic_archive(site_dir, 1, num_images)
+    return {
+        'pages' : ["/" + path.relative_to(site_dir).as_posix() for path in page_paths],
+        'images': ["/" + path.relative_to(site_dir).as_posix() for path in img_paths],
+    }
+
+
+def scenario_requests(paths: dict[str, list[str]], site_dir: pl.Path) -> dict[str, list[bytes]]:
+    def request(path: str, *headers: str) -> bytes:
+        lines = [f"GET {path} HTTP/1.1", "Host: 127.0.0.1", *headers]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    def last_modified(path: str) -> str:
+        return email.utils.formatdate((site_dir / path.lstrip("/")).stat().st_mtime, usegmt=True)
+
+    return {
+        'pages'     : [request(path, "Accept-Encoding: gzip, br") for path in paths['pages']],
+        'images'    : [request(path) for path in paths['images']],
+        'ranges'    : [request(path, f"Range: bytes=0-{RANGE_BYTES - 1}") for path in paths['images']],
+        'revalidate': [request(path, f"If-Modified-Since: {last_modified(path)}") for path in paths['images']],
+    }
+
+
+async def _read_response(reader) -> tuple[int, int, bool]:
+    """Returns the status, the length of the body and whether the connection stays open."""
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    version, status = lines[0].split(" ")[:2]
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip().lower()
+
+    status = int(status)
+    connection = headers.get('connection', "")
+    keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+    if 'content-length' in headers:
+        length = int(headers['content-length'])
+        await reader.readexactly(length)
+    elif status == 304 or 100 <= status < 200 or status == 204:
+        length = 0
+    else:
+        length = len(await reader.read())
+        keep_alive = False
+    return (status, length, keep_alive)
+
+
+async def _client(port: int, requests: list[bytes], offset: int, deadline: float, stats: dict) -> None:
+    conn = None
+    i = offset
+    while time.perf_counter() < deadline:
+        if conn is None:
+            conn = await asyncio.open_connection("127.0.0.1", port)
+        reader, writer = conn
+        t0 = time.perf_counter()
+        try:
+            writer.write(requests[i % len(requests)])
+            status, length, keep_alive = await _read_response(reader)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            stats['errors'] += 1
+            keep_alive = False
+        else:
+            stats['latencies'].append(time.perf_counter() - t0)
+            stats['bytes'] += length
+            stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+        if not keep_alive:
+            writer.close()
+            conn = None
+        i += 1
+
+    if conn is not None:
+        conn[1].close()
+
+
+async def load(port: int, requests: list[bytes], connections: int, duration: float) -> dict:
+    stats = {'latencies': [], 'bytes': 0, 'errors': 0, 'statuses': {}}
+    deadline = time.perf_counter() + duration
+    t0 = time.perf_counter()
+    await asyncio.gather(*(
+        _client(port, requests, i * 7, deadline, stats) for i in range(connections)
+    ))
+    elapsed = time.perf_counter() - t0
+
+    latencies = sorted(stats['latencies']) or [0.0]
+    return {
+        'requests'   : len(stats['latencies']),
+        'errors'     : stats['errors'],
+        'statuses'   : {str(status): num for status, num in sorted(stats['statuses'].items())},
+        'req_per_sec': round(len(stats['latencies']) / elapsed, 1),
+        'mb_per_sec' : round(stats['bytes'] / elapsed / 1024 / 1024, 3),
+        'p50_ms'     : round(statistics.median(latencies) * 1000, 3),
+        'p99_ms'     : round(latencies[int(len(latencies) * 0.99)] * 1000, 3),
+    }
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def _server(cmd: list[str], port: int):
+    proc = sp.Popen(cmd, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+    try:
+        t0 = time.perf_counter()
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except ConnectionRefusedError:
+                if proc.poll() is not None or time.perf_counter() - t0 > SERVER_START_TIMEOUT_SECS:
+                    raise RuntimeError(f"server didn't start: {' '.join(cmd)}")
+                time.sleep(0.05)
+        yield proc
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def run_benchmarks(site_dir: pl.Path, requests: dict[str, list[bytes]], options: dict) -> list[dict]:
+    port = _free_port()
+    servers = [(
+        "serve_static",
+        [
+            sys.executable, str(pl.Path(__file__).parent / "serve_static.py"),
+            f"--port={port}", f"--root={site_dir}", f"--workers={options['workers']}", "--quiet",
+        ],
+    )]
+    if options.get('baseline'):
+        servers.append((
+            "http.server",
+            [sys.executable, "-m", "http.server", str(port), "--bind", "127.0.0.1", "--directory", str(site_dir)],
+        ))
+
+    results = []
+    for server_name, cmd in servers:
+        with _server(cmd, port):
+            for scenario, scenario_reqs in requests.items():
+                result = asyncio.run(load(port, scenario_reqs, options['connections'], options['duration']))
+                result = {'server': server_name, 'scenario': scenario, **result}
+                print(
+                    f"{server_name:<13} {scenario:<11}"
+                    f" {result['req_per_sec']:>9.1f} req/s {result['mb_per_sec']:>9.3f} mb/s"
+                    f"  p50 {result['p50_ms']:>8.3f} ms  p99 {result['p99_ms']:>8.3f} ms"
+                    f"  errors {result['errors']}",
+                    file=sys.stderr,
+                )
+                results.append(result)
+    return results
+
+
+def _meta(options: dict, paths: dict[str, list[str]]) -> dict:
+    return {
+        'date'      : dt.datetime.now().isoformat(timespec='seconds'),
+        'python'    : platform.python_version(),
+        'platform'  : platform.platform(),
+        'cpu_count' : os.cpu_count(),
+        'num_pages' : len(paths['pages']),
+        'num_images': len(paths['images']),
+        'options'   : options,
+    }
+
+
+def _print_comparison(old_report: dict, new_report: dict) -> None:
+    old_results = {(result['server'], result['scenario']): result for result in old_report['results']}
+    for result in new_report['results']:
+        old_result = old_results.get((result['server'], result['scenario']))
+        if old_result is None or old_result['req_per_sec'] == 0:
+            continue
+        change = result['req_per_sec'] / old_result['req_per_sec'] - 1
+        print(
+            f"{result['server']:<13} {result['scenario']:<11}"
+            f" {old_result['req_per_sec']:>9.1f} req/s -> {result['req_per_sec']:>9.1f} req/s  {change:>+7.1%}",
+            file=sys.stderr,
+        )
+
+
+def _parse_options(args: list[str]) -> tuple[dict, list[str]]:
+    options = dict(DEFAULT_OPTIONS)
+    positional = []
+    for arg in args:
+        match = re.match(r"--([\w-]+)(?:=(.*))?$", arg)
+        if match is None:
+            positional.append(arg)
+        elif match.group(2) is None:
+            options[match.group(1)] = True
+        elif match.group(1) in DEFAULT_OPTIONS:
+            options[match.group(1)] = int(match.group(2))
+        else:
+            options[match.group(1)] = match.group(2)
+    return (options, positional)
+
+
+def main(args: list[str]) -> int:
+    options, positional = _parse_options(args)
+    if "help" in options or positional:
+        print(__doc__)
+        return 0
+
+    with tempfile.TemporaryDirectory(prefix="panzer_bench_serve_") as tmp_dir:
+        site_dir = pl.Path(tmp_dir) / "www"
+        paths = mk_site(site_dir, options['images'])
+        report = {
+            'meta'   : _meta(options, paths),
+            'results': run_benchmarks(site_dir, scenario_requests(paths, site_dir), options),
+        }
+
+    report_data = json.dumps(report, indent=2, sort_keys=True)
+    if 'out' in options:
+        with pl.Path(options['out']).open(mode='w') as fobj:
+            fobj.write(report_data + "\n")
+    else:
+        print(report_data)
+
+    if 'compare' in options:
+        with pl.Path(options['compare']).open(mode='r') as fobj:
+            _print_comparison(json.load(fobj), report)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
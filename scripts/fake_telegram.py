@@ -0,0 +1,165 @@
+"""
+A local stand-in for the parts of telethon.TelegramClient that
+panzer_imgsync.py uses, serving canned messages and photos.
+
+Usage:
+
+    import fake_telegram
+    client = fake_telegram.FakeClient(fake_telegram.mk_messages(img_paths))
+    new_messages = client.loop.run_until_complete(
+        panzer_imgsync.fetch_api_messages({}, client=client)
+    )
+
+As an event source for panzer_imgsync.run_daemon:
+
+    events = client.subscribe()
+    client.post(msg)            # the daemon receives msg from events
+"""
+
+import asyncio
+import pathlib as pl
+import datetime as dt
+import types
+
+
+class MessageMediaPhoto:
+    """Same class name as the telethon type, fetch_api_messages checks it."""
+
+
+class MessageMediaDocument:
+    pass
+
+
+def mk_message(
+    msg_id: int,
+    date: dt.datetime,
+    photo: bytes | None,
+    forwards: int = 0,
+    reactions: int = 0,
+    mime_type: str = "image/jpeg",
+) -> types.SimpleNamespace:
+    if photo is None:
+        media = MessageMediaDocument()
+    else:
+        media = MessageMediaPhoto()
+
+    if reactions:
+        reaction_results = [types.SimpleNamespace(
+            reaction=types.SimpleNamespace(emoticon="👍"),
+            count=reactions,
+        )]
+        msg_reactions = types.SimpleNamespace(results=reaction_results)
+    else:
+        msg_reactions = None
+
+    return types.SimpleNamespace(
+        id=msg_id,
+        date=date,
+        photo=photo,
+        media=media,
+        file=types.SimpleNamespace(mime_type=mime_type, size=len(photo or b"")),
+        forwards=forwards,
+        reactions=msg_reactions,
+    )
+
+
+def mk_messages(
+    img_paths: list[pl.Path],
+    first_id: int = 20000,
+    first_date: dt.datetime = dt.datetime(2024, 7, 1, 12, 0, tzinfo=dt.timezone.utc),
+    interval: dt.timedelta = dt.timedelta(hours=1),
+) -> list[types.SimpleNamespace]:
+    """One message per image, with ascending ids and dates."""
+    messages = []
+    for i, img_path in enumerate(img_paths):
+        with img_path.open(mode='rb') as fobj:
+            photo = fobj.read()
+
+        messages.append(mk_message(
+            first_id + i,
+            first_date + i * interval,
+            photo,
+            forwards=i % 7,
+            reactions=(i * 13) % 50,
+        ))
+    return messages
+
+
+class FakeClient:
+
+    def __init__(
+        self,
+        messages: list,
+        download_delay: float = 0.0,
+        chunk_size: int = 64 * 1024,
+        fail_after: int | None = None,
+    ):
+        self.messages = sorted(messages, key=lambda msg: msg.id)
+        self.download_delay = download_delay
+        self.chunk_size = chunk_size
+        # download number fail_after + 1 breaks off halfway
+        self.fail_after = fail_after
+        self.downloads = 0
+        self.bytes_downloaded = 0
+        self._loop = None
+        self._subscribers = []
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def subscribe(self) -> asyncio.Queue:
+        """A queue that receives the messages passed to post()."""
+        queue = asyncio.Queue()
+        self._subscribers.append(queue)
+        return queue
+
+    def post(self, msg) -> None:
+        """Add a message to the channel, like a new post."""
+        self.messages.append(msg)
+        self.messages.sort(key=lambda msg: msg.id)
+        for queue in self._subscribers:
+            queue.put_nowait(msg)
+
+    async def get_me(self):
+        return types.SimpleNamespace(id=0, username="fake_telegram", phone=None)
+
+    async def iter_messages(self, entity, min_id: int = 0, limit: int | None = None):
+        """Yield messages newer than min_id, newest first (like telethon)."""
+        count = 0
+        for msg in reversed(self.messages):
+            if msg.id <= min_id:
+                break
+            if limit is not None and count >= limit:
+                break
+
+            count += 1
+            yield msg
+
+    async def download_media(self, msg, file=None):
+        data = msg.photo
+        self.downloads += 1
+        download_num = self.downloads
+
+        if file is bytes:
+            await asyncio.sleep(self.download_delay)
+            self.bytes_downloaded += len(data)
+            return data
+
+        with pl.Path(file).open(mode='wb') as fobj:
+            for offset in range(0, len(data), self.chunk_size):
+                if self.fail_after is not None and download_num == self.fail_after + 1 and offset >= len(data) // 2:
+                    raise ConnectionError("connection lost (simulated)")
+                await asyncio.sleep(self.download_delay * self.chunk_size / max(len(data), 1))
+                fobj.write(data[offset:offset + self.chunk_size])
+                self.bytes_downloaded += min(self.chunk_size, len(data) - offset)
+
+        return str(file)
@@ -1,21 +1,301 @@
+#!/usr/bin/env python3
+"""
+Build the static pages of the site.
+
+All pages in templates/ are rendered in one pass. Templates reference
+assets with {{ asset("app.js") }}, which is the path of a copy of the
+asset named by a hash of its content (/assets/app.3f2a1b9c0d.js), so
+browsers can cache assets forever and only download what changed.
+Outdated copies are removed when all pages are built.
+
+The pages, the text assets and the json indexes in images/ get
+precompressed .gz siblings, and .br siblings if brotli is installed.
+The siblings are committed with their sources, so the origin
+(scripts/serve_static.py) serves them from its checkout.
+
+Outputs are only written if they changed or are missing, compressed
+siblings only if they are older than their source.
+
+index.html gets the first screen of the gallery pre-rendered: the
+gallery manifest and the entry blocks of the newest months (from the
+archive repos next to this one) are embedded in the page, the first
+FIRST_SCREEN_ENTRIES thumbnails are rendered as static markup and
+their sprites get preload hints. assets/app.js hydrates this without
+waiting for any request. Without the archive repos, the page is
+rendered without the first screen and app.js fetches everything.
+
+Usage:
+
+    ./scripts/gen_html.py [--force] [page.html ...]
+"""
+
+import re
 import sys
-import jinja2 as j2
+import gzip
+import json
+import shutil
+import functools as ft
+import hashlib as hl
 import pathlib as pl
+import jinja2 as j2
 
+ROOT_DIR = pl.Path(__file__).parent.parent
+TEMPLATES_DIR = ROOT_DIR / "templates"
+ASSETS_DIR = ROOT_DIR / "assets"
+IMAGES_DIR = ROOT_DIR / "images"
 
-def main(args: list[str]) -> int:
-    template_name = args[0]
+# templates that are only extended, not rendered as pages
+LAYOUT_TEMPLATES = {"base.html"}
+
+# <name>.<hash><suffix>, e.g. app.3f2a1b9c0d.js
+ASSET_HASH_LEN = 10
+HASHED_ASSET_RE = re.compile(r"^(.+)\.([0-9a-f]{%d})(\.\w+)$" % ASSET_HASH_LEN)
+
+COMPRESS_SUFFIXES = {".html", ".js", ".css", ".json", ".svg", ".txt"}
+
+# the images and json indexes of a month are served from the host of its year
+IMG_HOSTS = {
+    "2021": "https://archiv0.derrosarotepanzer.com",
+    "2022": "https://archiv0.derrosarotepanzer.com",
+    "2023": "https://archiv0.derrosarotepanzer.com",
+    "2024": "https://archiv0.derrosarotepanzer.com",
+    "2025": "https://archiv1.derrosarotepanzer.com",
+    "2026": "https://archiv2.derrosarotepanzer.com",
+    "2027": "https://archiv3.derrosarotepanzer.com",
+    "2028": "https://archiv4.derrosarotepanzer.com",
+    "2029": "https://archiv5.derrosarotepanzer.com",
+    "2030": "https://archiv6.derrosarotepanzer.com",
+    "2031": "https://archiv7.derrosarotepanzer.com",
+    "2032": "https://archiv8.derrosarotepanzer.com",
+    "2033": "https://archiv9.derrosarotepanzer.com",
+}
+# archivN.<domain> -> ../panzer-archiv-0N, see IMG_REPOS in panzer_imgsync.py
+ARCHIV_HOST_RE = re.compile(r"^https://archiv(\d+)\.")
+
+# enough thumbnails for the first screen of a large display
+FIRST_SCREEN_ENTRIES = 60
+
+
+def _write_if_changed(path: pl.Path, data: bytes) -> bool:
+    if path.exists() and path.read_bytes() == data:
+        return False
+
+    tmp_path = path.parent / (path.name + ".tmp")
+    with tmp_path.open(mode='wb') as fobj:
+        fobj.write(data)
+    tmp_path.rename(path)
+    return True
+
+
+def hashed_asset_name(path: pl.Path) -> str:
+    digest = hl.sha256(path.read_bytes()).hexdigest()[:ASSET_HASH_LEN]
+    return f"{path.stem}.{digest}{path.suffix}"
+
+
+def fingerprint_asset(
+    name: str, assets_dir: pl.Path = ASSETS_DIR, written_paths: list[pl.Path] | None = None,
+) -> str:
+    """Copy an asset to its hashed name (if needed), returns the hashed name.
+
+    The path of the copy is added to written_paths if it was written.
+    """
+    path = assets_dir / name
+    hashed_name = hashed_asset_name(path)
+    hashed_path = assets_dir / hashed_name
+    if not hashed_path.exists():
+        print(f"writing     {hashed_path.relative_to(ROOT_DIR)}")
+        tmp_path = assets_dir / (hashed_name + ".tmp")
+        shutil.copyfile(path, tmp_path)
+        tmp_path.rename(hashed_path)
+        if written_paths is not None:
+            written_paths.append(hashed_path)
+    return hashed_name
+
+
+def remove_outdated_assets(hashed_names: set[str], assets_dir: pl.Path = ASSETS_DIR) -> None:
+    """Remove hashed copies (and their compressed siblings) not in hashed_names."""
+    for path in sorted(assets_dir.iterdir()):
+        match = HASHED_ASSET_RE.match(path.name.removesuffix(".gz").removesuffix(".br"))
+        if match is None or match.group(0) in hashed_names:
+            continue
+        if (assets_dir / (match.group(1) + match.group(3))).exists():
+            print(f"removing    {path.relative_to(ROOT_DIR)}")
+            path.unlink()
+
+
+def _archive_dir(year: str) -> pl.Path | None:
+    match = ARCHIV_HOST_RE.match(IMG_HOSTS.get(year, ""))
+    if match is None:
+        return None
+    return ROOT_DIR.parent / f"panzer-archiv-{int(match.group(1)):02d}"
+
+
+def first_screen(num_entries: int = FIRST_SCREEN_ENTRIES) -> dict | None:
+    """The data and thumbnails of the first screen of the gallery, for index.html.
+
+    Returns None if the manifest or an entry block is missing.
 
-    env = j2.Environment(loader=j2.FileSystemLoader('templates'))
+    {"data"      : {"manifest": {...}, "blocks": {dir_name: entry_block, ...}},
+     "thumbnails": [{"href": ..., "sprite": ..., "x": ..., "y": ..., "idx": ...}, ...],
+     "sprites"   : [sprite, ...],   # urls without scale suffix and extension
+     "sprite_width": ...}
+    """
+    manifest_path = IMAGES_DIR / "gallery_manifest.json"
+    if not manifest_path.exists():
+        return None
 
-    template = env.get_template(template_name)
+    with manifest_path.open(mode='rb') as fobj:
+        manifest = json.load(fobj)
 
-    with pl.Path(template_name).open(mode="w") as fobj:
-        fobj.write(template.render())
+    blocks = {}
+    thumbnails = []
+    for dir_name in manifest['dirs']:
+        if len(thumbnails) >= num_entries:
+            break
 
+        archive_dir = _archive_dir(dir_name[0:4])
+        block_path = archive_dir and archive_dir / "images" / dir_name / "entry_block.json"
+        if block_path is None or not block_path.exists():
+            return None
+
+        with block_path.open(mode='rb') as fobj:
+            block = json.load(fobj)
+        blocks[dir_name] = block
+
+        # newest entry first, like assets/app.js
+        dir_url = f"{IMG_HOSTS[dir_name[0:4]]}/images/{dir_name}"
+        for i in reversed(range(len(block['names']))):
+            if len(thumbnails) >= num_entries:
+                break
+            chunk_slot = block['t'][i] % block['chunk']
+            thumbnails.append({
+                'href'  : f"{dir_url}/{block['names'][i]}",
+                'sprite': f"{dir_url}/{block['sprites'][block['t'][i] // block['chunk']]}",
+                'x'     : (chunk_slot % block['cols']) * block['tile'],
+                'y'     : (chunk_slot // block['cols']) * block['tile'],
+                'idx'   : len(thumbnails),
+            })
+
+    if not blocks:
+        return None
+
+    return {
+        'data'        : {'manifest': manifest, 'blocks': blocks},
+        'thumbnails'  : thumbnails,
+        'sprites'     : list(dict.fromkeys(thumbnail['sprite'] for thumbnail in thumbnails)),
+        'sprite_width': block['cols'] * block['tile'],
+    }
+
+
+def render_pages(
+    asset_names: dict[str, str], page_names: list[str] | None = None,
+    written_paths: list[pl.Path] | None = None,
+) -> list[pl.Path]:
+    """Render pages to the root dir, returns the paths of all rendered pages.
+
+    The assets referenced by the pages are added to asset_names, the
+    paths of the pages and hashed copies that were written to written_paths.
+    """
+    env = j2.Environment(loader=j2.FileSystemLoader(str(TEMPLATES_DIR)))
+
+    def asset(name: str) -> str:
+        if name not in asset_names:
+            asset_names[name] = fingerprint_asset(name, written_paths=written_paths)
+        return "/assets/" + asset_names[name]
+
+    env.globals['asset'] = asset
+    # loaded once per build, not once per block
+    env.globals['first_screen'] = ft.cache(first_screen)
+    env.globals['img_hosts'] = IMG_HOSTS
+
+    if page_names is None:
+        page_names = sorted(
+            path.name for path in TEMPLATES_DIR.glob("*.html")
+            if path.name not in LAYOUT_TEMPLATES
+        )
+
+    page_paths = []
+    for page_name in page_names:
+        page_path = ROOT_DIR / page_name
+        page_data = env.get_template(page_name).render().encode("utf-8")
+        if _write_if_changed(page_path, page_data):
+            print(f"writing     {page_name}")
+            if written_paths is not None:
+                written_paths.append(page_path)
+        page_paths.append(page_path)
+
+    return page_paths
+
+
+def _compressors() -> dict:
+    compressors = {".gz": lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+    try:
+        import brotli
+    except ImportError:
+        return compressors
+
+    compressors[".br"] = lambda data: brotli.compress(data, quality=11)
+    return compressors
+
+
+def precompress(paths: list[pl.Path], force: bool = False) -> list[pl.Path]:
+    """Write compressed siblings of text files, returns the paths written."""
+    compressors = _compressors()
+    written_paths = []
+    for path in paths:
+        if path.suffix not in COMPRESS_SUFFIXES:
+            continue
+
+        src_mtime = path.stat().st_mtime_ns
+        data = None
+        for suffix, compress in compressors.items():
+            dst_path = path.parent / (path.name + suffix)
+            if not force and dst_path.exists() and dst_path.stat().st_mtime_ns >= src_mtime:
+                continue
+
+            if data is None:
+                data = path.read_bytes()
+            tmp_path = path.parent / (dst_path.name + ".tmp")
+            with tmp_path.open(mode='wb') as fobj:
+                fobj.write(compress(data))
+            tmp_path.rename(dst_path)
+            written_paths.append(dst_path)
+
+    return written_paths
+
+
+def build(page_names: list[str] | None = None, force: bool = False) -> list[pl.Path]:
+    """Render pages (all by default) and precompress them with their assets.
+
+    Returns the paths that were written: changed pages, new hashed
+    copies of assets and compressed siblings, for the sync to commit.
+    """
+    asset_names = {}
+    written_paths = []
+    page_paths = render_pages(asset_names, page_names, written_paths)
+    if page_names is None:
+        # other pages might still reference older copies
+        remove_outdated_assets(set(asset_names.values()))
+
+    compress_paths = [ASSETS_DIR / hashed_name for hashed_name in asset_names.values()]
+    compress_paths += page_paths
+    compress_paths += sorted(IMAGES_DIR.glob("*.json"))
+    compressed_paths = precompress(compress_paths, force=force)
+    if compressed_paths:
+        print(f"compressed  {len(compressed_paths)} files")
+    return written_paths + compressed_paths
+
+
+def main(args: list[str]) -> int:
+    if "-h" in args or "--help" in args:
+        print(__doc__)
+        return 0
+
+    force = "--force" in args
+    page_names = [arg for arg in args if not arg.startswith("-")] or None
+    build(page_names, force=force)
     return 0
 
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv[1:]))
-
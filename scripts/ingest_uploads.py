@@ -5,88 +5,857 @@ import io
 import re
 import sys
 import json
+import shutil
 import hashlib as hl
+import threading
 import pathlib as pl
 import itertools as it
+import contextlib
 import subprocess as sp
 import collections
+import concurrent.futures as cf
 import datetime as dt
-from PIL import Image
+from PIL import Image, ImageOps
 
-DEBUG_ENTRY_INDEX = True
+import panzer_digest
+import panzer_metrics
+
+# number of processes used for the per month work, 0 means one per cpu
+INGEST_WORKERS = int(os.environ.get('PANZER_INGEST_WORKERS', "0")) or os.cpu_count() or 1
 
 
 THUMBNAIL_SIZE = 150
 
+# local, uncommitted state of an archive repo (scan journal etc.)
+CACHE_DIR_NAME = ".cache"
 
-def update_thumbnails(archive_repo_dir: pl.Path):
-    archiv_img_dir = archive_repo_dir / "images"
-    assert archiv_img_dir.exists(), archiv_img_dir
+# Thumbnails are stored in sprites of SPRITE_CHUNK_TILES tiles each. The
+# name of a chunk contains a hash of its content, so it can be cached forever.
+# Each chunk is written in SPRITE_FORMATS and SPRITE_SCALES, these have to
+# match what assets/app.js (spriteImageSet) and templates/index.html request.
+SPRITE_PREFIX = "thumbnails"
+SPRITE_VERSION = 1
+SPRITE_COLUMNS = 10
+SPRITE_CHUNK_TILES = 100
+SPRITE_SCALES = (1, 2)
+SPRITE_FORMATS = ("jpg", "webp")
+SPRITE_QUALITY = 75
+# Superseded chunks are removed this long after the chunk that replaced
+# them was written. Clients with a cached entry_block.json (the gallery
+# fetches it with an hourly cache buster, CDNs may keep it longer) still
+# load the old chunks until then.
+SPRITE_GRACE_HOURS = 48
 
-    for entry_index_path in sorted(archiv_img_dir.glob("*/*/entry_index.json")):
-        dirpath = entry_index_path.parent
-        thumbnails_path = dirpath / "thumbnails.jpg"
-        # is_thumbnails_fresh = (
-        #     thumbnails_path.exists()
-        #     and thumbnails_path.stat().st_mtime >= entry_index_path.stat().st_mtime
-        # )
-        # if is_thumbnails_fresh:
-        #     continue
-
-        with entry_index_path.open('rb') as fobj:
-            entry_index = json.loads(fobj.read().decode("utf-8"))
-
-        print("updating thumbnails", thumbnails_path)
-        num_cols = 10
-        num_rows = len(entry_index) // num_cols
-
-        padding_x = num_cols * 2
-        padding_y = num_rows * 2
-
-        thumbnails_width = THUMBNAIL_SIZE * num_cols + padding_x
-        thumbnails_height = THUMBNAIL_SIZE * (num_rows + 1) + padding_y
-
-        thumbnails_image = Image.new('RGB', (thumbnails_width, thumbnails_height))
-        for i, entry in enumerate(entry_index):
+# {chunk_stem: {name: [x, y, sha256]}} of the sprite chunks that were rendered
+THUMBNAILS_INDEX_NAME = "thumbnails_index.json"
+
+# content hashes of the images of a month, used to sync with the www repo
+MANIFEST_NAME = "manifest.json"
+
+# Downscaled copies of each image for the lightbox, in <month>/derived/.
+# The browser picks the smallest one that fits via srcset, which can't
+# express the image type, so WebP copies are off by default.
+DERIVED_DIR_NAME = "derived"
+DERIVED_WIDTHS = (640, 1280, 1920)
+DERIVED_FORMATS = tuple(os.environ.get('PANZER_DERIVED_FORMATS', "jpg").split(","))
+DERIVED_QUALITY = 80
+
+# What the ingest stages need from the pixels of an image (tiles and derived
+# copies), by the sha256 of the file. Each image is decoded once, when it
+# is downloaded (see panzer_imgsync) or by the first stage that needs it,
+# the other stages read the cache. Shared by all archive repos.
+DECODE_CACHE_DIR = pl.Path(os.environ.get(
+    'PANZER_DECODE_CACHE',
+    pl.Path(__file__).parent.parent / CACHE_DIR_NAME / "decoded",
+))
+# tiles are encoded again in the sprites
+DECODE_CACHE_QUALITY = 95
+DECODE_CACHE_MAX_AGE_DAYS = 14
+# each ingest prunes this many of the 256 subdirs of the decode cache,
+# the next ingest continues after them (see DECODE_CACHE_PRUNE_CURSOR_NAME)
+DECODE_CACHE_PRUNE_DIRS = 16
+DECODE_CACHE_PRUNE_CURSOR_NAME = "prune_cursor.txt"
+
+# columnar version of entry_index.json, loaded by assets/app.js
+ENTRY_BLOCK_NAME = "entry_block.json"
+
+# month offsets of the whole gallery, next to dir_index.json
+GALLERY_MANIFEST_NAME = "gallery_manifest.json"
+
+# Uploads of other types are converted to JPEG, as are JPEGs that need
+# to be rotated (exif orientation) or are not RGB/grayscale.
+UPLOAD_SUFFIXES = (".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp", ".tif", ".tiff")
+UPLOAD_QUALITY = 90
+# dates in names like IMG_20240516_123456.jpg or 2024-05-16 12.34.56.png
+UPLOAD_NAME_DATE_RE = re.compile(
+    r"((?:19|20)\d{2})-?(\d{2})-?(\d{2})(?:[T_ .-]?(\d{2})[.:-]?(\d{2})[.:-]?(\d{2}))?"
+)
+
+
+# paths in the archive repos that this process wrote or removed, the
+# workers' paths are added by _pool_map and ingest() returns them
+_CHANGED_PATHS = []
+
+
+def _changed(path: pl.Path) -> None:
+    _CHANGED_PATHS.append(path)
+
+
+def is_sprite_name(name: str) -> bool:
+    return name.startswith(SPRITE_PREFIX)
+
+
+def _sprite_paths(dirpath: pl.Path, stem: str) -> list[tuple[pl.Path, int, str]]:
+    """The (path, scale, format) of each variant of a sprite chunk."""
+    sprite_paths = []
+    for scale in SPRITE_SCALES:
+        suffix = "" if scale == 1 else f"@{scale}x"
+        for fmt in SPRITE_FORMATS:
+            sprite_paths.append((dirpath / f"{stem}{suffix}.{fmt}", scale, fmt))
+    return sprite_paths
+
+
+def _render_tiles(img: Image.Image, width: int, height: int) -> dict[int, Image.Image]:
+    """Downsize a decoded image to a tile for each scale."""
+    tiles = {}
+    img = img.copy()
+    for scale in sorted(SPRITE_SCALES, reverse=True):
+        tile_size = THUMBNAIL_SIZE * scale
+        # reduces by an integer factor first, about as fast as a JPEG draft
+        img.thumbnail((tile_size, tile_size), reducing_gap=1.0)
+        thumb_width, thumb_height = img.size
+
+        if width > height:
+            offset_x = 0
+            offset_y = (tile_size - thumb_height) // 2
+        else:
+            offset_x = (tile_size - thumb_width) // 2
+            offset_y = 0
+
+        tile = Image.new('RGB', (tile_size, tile_size))
+        tile.paste(img, (offset_x, offset_y))
+        tiles[scale] = tile
+    return tiles
+
+
+def _decode_cache_paths(sha256: str, width: int, height: int) -> tuple[pl.Path, dict, dict]:
+    """The paths of the cached meta data, tiles by scale and derived copies by (width, fmt)."""
+    cache_dir = DECODE_CACHE_DIR / sha256[:2]
+    tile_paths = {
+        scale: cache_dir / f"{sha256}_t{THUMBNAIL_SIZE * scale}.jpg"
+        for scale in SPRITE_SCALES
+    }
+    derived_paths = {
+        (derived_width, fmt): cache_dir / f"{sha256}_{derived_width}w_q{DERIVED_QUALITY}.{fmt}"
+        for derived_width, _ in derived_sizes(width, height)
+        for fmt in DERIVED_FORMATS
+    }
+    return (cache_dir / f"{sha256}.json", tile_paths, derived_paths)
+
+
+def _tmp_path(path: pl.Path) -> pl.Path:
+    # the same image can be in two months, which are processed in parallel,
+    # and reposts are downloaded (and decoded) by parallel threads
+    return path.parent / f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def _save_img(img: Image.Image, path: pl.Path, fmt: str, quality: int) -> None:
+    tmp_path = _tmp_path(path)
+    if fmt == "jpg":
+        img.save(str(tmp_path), "JPEG", quality=quality, optimize=True, progressive=True)
+    elif fmt == "webp":
+        img.save(str(tmp_path), "WEBP", quality=quality, method=6)
+    else:
+        img.save(str(tmp_path), fmt.upper(), quality=quality)
+    tmp_path.rename(path)
+
+
+def decode_img(data: bytes, sha256: str | None = None, digest: bool = False) -> dict:
+    """Decode an image once and cache its tiles and derived copies.
+
+    Returns {"sha256", "w", "h"} and, with digest=True, the perceptual
+    digest as "dig" (same as panzer_digest.digest_img). Without a digest,
+    JPEGs are only decoded at the scale that the largest output needs.
+    """
+    sha256 = sha256 or hl.sha256(data).hexdigest()
+    panzer_metrics.count("images_decoded")
+    with Image.open(io.BytesIO(data)) as img:
+        width, height = img.size
+        meta = {'sha256': sha256, 'w': width, 'h': height}
+        meta_path, tile_paths, derived_paths = _decode_cache_paths(sha256, width, height)
+        derived = derived_sizes(width, height)
+
+        tile_size = THUMBNAIL_SIZE * max(SPRITE_SCALES)
+        max_width, max_height = max(derived, default=[0, 0])
+        min_size = (max(max_width, tile_size), max(max_height, tile_size))
+        if digest:
+            # the digest needs the full image, which is then reduced
+            # by the factor a JPEG draft would have used
+            meta['dig'] = panzer_digest.digest_decoded(img)
+            img = img.convert('RGB')
+            scale = 1
+            while scale < 8 and width // (scale * 2) >= min_size[0] and height // (scale * 2) >= min_size[1]:
+                scale *= 2
+            if scale > 1:
+                img = img.reduce(scale)
+        else:
+            img.draft('RGB', min_size)
+            img = img.convert('RGB')
+
+        meta_path.parent.mkdir(parents=True, exist_ok=True)
+        for derived_width, derived_height in sorted(derived, reverse=True):
+            if img.size != (derived_width, derived_height):
+                img = img.resize((derived_width, derived_height), Image.Resampling.LANCZOS)
+            for fmt in DERIVED_FORMATS:
+                _save_img(img, derived_paths[derived_width, fmt], fmt, DERIVED_QUALITY)
+
+        # the smallest derived copy is still larger than the tiles
+        for scale, tile in _render_tiles(img, width, height).items():
+            tmp_path = _tmp_path(tile_paths[scale])
+            tile.save(str(tmp_path), "JPEG", quality=DECODE_CACHE_QUALITY)
+            tmp_path.rename(tile_paths[scale])
+
+    _write_if_changed(meta_path, json.dumps(meta).encode("utf-8"))
+    return meta
+
+
+def decoded_img(img_path: pl.Path, sha256: str | None = None) -> dict:
+    """The cached decode results of an image, decodes it if any are missing."""
+    if sha256:
+        meta = load_decoded(sha256)
+        if meta:
+            _, tile_paths, derived_paths = _decode_cache_paths(sha256, meta['w'], meta['h'])
+            if all(path.exists() for path in [*tile_paths.values(), *derived_paths.values()]):
+                panzer_metrics.count("decode_cache_hits")
+                return meta
+
+    with img_path.open(mode='rb') as fobj:
+        return decode_img(fobj.read(), sha256)
+
+
+def load_decoded(sha256: str) -> dict | None:
+    meta_path = DECODE_CACHE_DIR / sha256[:2] / f"{sha256}.json"
+    if not meta_path.exists():
+        return None
+
+    with meta_path.open(mode='rb') as fobj:
+        return json.load(fobj)
+
+
+def _prune_decode_cache(
+    max_age_days: int = DECODE_CACHE_MAX_AGE_DAYS, num_dirs: int = DECODE_CACHE_PRUNE_DIRS,
+) -> None:
+    """Remove old files from the next num_dirs subdirs of the decode cache."""
+    if not DECODE_CACHE_DIR.exists():
+        return
+
+    cursor_path = DECODE_CACHE_DIR / DECODE_CACHE_PRUNE_CURSOR_NAME
+    cursor = int(cursor_path.read_text() or "0") if cursor_path.exists() else 0
+
+    min_mtime = dt.datetime.now().timestamp() - max_age_days * 24 * 3600
+    for i in range(cursor, cursor + num_dirs):
+        for path in DECODE_CACHE_DIR.glob(f"{i % 256:02x}/*"):
+            if path.stat().st_mtime < min_mtime:
+                path.unlink()
+
+    _write_if_changed(cursor_path, str((cursor + num_dirs) % 256).encode("utf-8"))
+
+
+def _load_tiles(img_path: pl.Path, sha256: str) -> dict[int, Image.Image]:
+    meta = decoded_img(img_path, sha256)
+    _, tile_paths, _ = _decode_cache_paths(sha256, meta['w'], meta['h'])
+    tiles = {}
+    for scale, tile_path in tile_paths.items():
+        with Image.open(tile_path) as tile:
+            tiles[scale] = tile.convert('RGB')
+    return tiles
+
+
+def _build_sprite_chunk(
+    dirpath: pl.Path,
+    stem: str,
+    entries: list[dict],
+    digests: dict[str, str],
+    old_tiles: dict[str, list],
+) -> int:
+    """Render all variants of one chunk, returns the number of reused tiles.
+
+    All tiles come from the decode cache. Tiles at the same position with
+    the same content as in the previous version of the chunk are reused,
+    their images are usually still cached. They are never copied from the
+    previous sprite, which would lose quality each time the chunk grows.
+    """
+    num_rows = max(entry['y'] for entry in entries) // (THUMBNAIL_SIZE + 2) + 1
+    width = SPRITE_COLUMNS * (THUMBNAIL_SIZE + 2)
+    height = num_rows * (THUMBNAIL_SIZE + 2)
+
+    images = {scale: Image.new('RGB', (width * scale, height * scale)) for scale in SPRITE_SCALES}
+    num_reused = 0
+    for entry in entries:
+        if old_tiles.get(entry['name']) == [entry['x'], entry['y'], digests[entry['name']]]:
+            num_reused += 1
+        for scale, tile in _load_tiles(dirpath / entry['name'], digests[entry['name']]).items():
+            images[scale].paste(tile, (entry['x'] * scale, entry['y'] * scale))
+
+    for path, scale, fmt in _sprite_paths(dirpath, stem):
+        _save_img(images[scale], path, fmt, SPRITE_QUALITY)
+        _changed(path)
+        panzer_metrics.count("sprites_written")
+
+    panzer_metrics.count("tiles_reused", num_reused)
+    return num_reused
+
+
+def _update_month_thumbnails(
+    entry_index_path: pl.Path, force: bool = False, records: dict | None = None,
+) -> str | None:
+    dirpath = entry_index_path.parent
+    thumbnails_index_path = dirpath / THUMBNAILS_INDEX_NAME
+
+    with entry_index_path.open('rb') as fobj:
+        entry_index = json.loads(fobj.read().decode("utf-8"))
+
+    if thumbnails_index_path.exists() and not force:
+        with thumbnails_index_path.open('rb') as fobj:
+            old_thumbnails_index = json.load(fobj)
+    else:
+        old_thumbnails_index = {}
+
+    chunks = collections.defaultdict(list)
+    for entry in entry_index:
+        chunks[entry['s']].append(entry)
+
+    stale_stems = [
+        stem for stem in chunks
+        if force or not all(path.exists() for path, _, _ in _sprite_paths(dirpath, stem))
+    ]
+
+    thumbnails_index = {
+        stem: tiles for stem, tiles in old_thumbnails_index.items()
+        if stem in chunks and stem not in stale_stems
+    }
+
+    messages = []
+    for stem in stale_stems:
+        entries = chunks[stem]
+        digests = {
+            entry['name']: (records or {}).get(entry['name'], {}).get('sha256')
+            or file_digest(dirpath / entry['name'])
+            for entry in entries
+        }
+
+        chunk_prefix = stem.rsplit("_", 1)[0] + "_"
+        old_stems = [old_stem for old_stem in old_thumbnails_index if old_stem.startswith(chunk_prefix)]
+        old_stem = old_stems[0] if old_stems else None
+        old_tiles = old_thumbnails_index.get(old_stem, {})
+
+        num_reused = _build_sprite_chunk(dirpath, stem, entries, digests, old_tiles)
+        thumbnails_index[stem] = {
+            entry['name']: [entry['x'], entry['y'], digests[entry['name']]]
+            for entry in entries
+        }
+        messages.append(f"updating thumbnails {dirpath / stem} ({num_reused} tiles reused)")
+
+    sprite_names = {
+        path.name
+        for stem in chunks
+        for path, _, _ in _sprite_paths(dirpath, stem)
+    }
+    # when each chunk was last replaced, removed chunks count from the index
+    replaced_mtimes = {}
+    for stem in chunks:
+        sprite_path = _sprite_paths(dirpath, stem)[0][0]
+        if sprite_path.exists():
+            replaced_mtimes[stem.rsplit("_", 1)[0]] = sprite_path.stat().st_mtime
+    max_replaced_mtime = dt.datetime.now().timestamp() - SPRITE_GRACE_HOURS * 3600
+
+    for path in sorted(dirpath.iterdir()):
+        if is_sprite_name(path.name) and path.name not in sprite_names and path != thumbnails_index_path:
+            chunk_prefix = path.name.rsplit("_", 1)[0]
+            replaced_mtime = replaced_mtimes.get(chunk_prefix) or entry_index_path.stat().st_mtime
+            if replaced_mtime < max_replaced_mtime:
+                path.unlink()
+                _changed(path)
+
+    if thumbnails_index != old_thumbnails_index:
+        thumbnails_index_data = json.dumps(thumbnails_index, sort_keys=True).encode("utf-8")
+        with thumbnails_index_path.open(mode='wb') as fobj:
+            fobj.write(thumbnails_index_data)
+        _changed(thumbnails_index_path)
+
+    return "\n".join(messages) or None
+
+
+def derived_sizes(width: int, height: int) -> list[list[int]]:
+    """The [width, height] of the derived copies of an image (never upscaled)."""
+    return [
+        [derived_width, (height * derived_width + width // 2) // width]
+        for derived_width in DERIVED_WIDTHS
+        if derived_width < width
+    ]
+
+
+def _derived_paths(dirpath: pl.Path, img_name: str, derived_width: int) -> list[tuple[pl.Path, str]]:
+    stem = img_name.rsplit(".", 1)[0]
+    return [
+        (dirpath / DERIVED_DIR_NAME / f"{stem}_{derived_width}w.{fmt}", fmt)
+        for fmt in DERIVED_FORMATS
+    ]
+
+
+def _write_derived(img_path: pl.Path, sha256: str, targets: list[tuple[pl.Path, str, int, int]]) -> None:
+    """Hardlink the targets to the decode cache (copy them on another filesystem).
+
+    Cache files are only ever replaced by a rename, never written in
+    place, so the archive copies can't change with the cache.
+    """
+    meta = decoded_img(img_path, sha256)
+    _, _, derived_paths = _decode_cache_paths(sha256, meta['w'], meta['h'])
+    for path, fmt, width, _ in targets:
+        tmp_path = _tmp_path(path)
+        try:
+            os.link(derived_paths[width, fmt], tmp_path)
+            # newer than the image, like a copy would be
+            os.utime(tmp_path)
+        except OSError:
+            shutil.copyfile(derived_paths[width, fmt], tmp_path)
+        tmp_path.rename(path)
+        _changed(path)
+        panzer_metrics.count("derived_written")
+
+
+def _update_month_derived(
+    entry_index_path: pl.Path, force: bool = False, records: dict | None = None,
+) -> str | None:
+    dirpath = entry_index_path.parent
+    derived_dir = dirpath / DERIVED_DIR_NAME
+
+    with entry_index_path.open('rb') as fobj:
+        entry_index = json.loads(fobj.read().decode("utf-8"))
+
+    derived_names = set()
+    num_written = 0
+    for entry in entry_index:
+        if 'd' not in entry:
+            continue
+
+        record = (records or {}).get(entry['name'])
+        if record is None:
+            img_mtime = (dirpath / entry['name']).stat().st_mtime_ns
+            img_sha256 = None
+        else:
+            img_mtime = record['mtime']
+            img_sha256 = record['sha256']
+
+        targets = [
+            (path, fmt, width, height)
+            for width, height in entry['d']
+            for path, fmt in _derived_paths(dirpath, entry['name'], width)
+        ]
+        derived_names.update(path.name for path, _, _, _ in targets)
+
+        stale_targets = [
+            target for target in targets
+            if force or not target[0].exists() or target[0].stat().st_mtime_ns < img_mtime
+        ]
+        if stale_targets:
+            derived_dir.mkdir(exist_ok=True)
             img_path = dirpath / entry['name']
-            with Image.open(img_path) as img:
-                img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
-                thumb_width, thumb_height = img.size
+            _write_derived(img_path, img_sha256 or file_digest(img_path), stale_targets)
+            num_written += len(stale_targets)
 
-                if entry['w'] > entry['h']:
-                    offset_x = 0
-                    offset_y = (THUMBNAIL_SIZE - thumb_height) // 2
-                else:
-                    offset_x = (THUMBNAIL_SIZE - thumb_width) // 2
-                    offset_y = 0
+    num_removed = 0
+    if derived_dir.exists():
+        for path in derived_dir.iterdir():
+            if path.name not in derived_names:
+                path.unlink()
+                _changed(path)
+                num_removed += 1
+
+    if num_written or num_removed:
+        return f"updating derived  {derived_dir} ({num_written} written, {num_removed} removed)"
+    return None
+
+
+def _sprite_stem(chunk: int, entries: list[dict], digests: dict[str, str]) -> str:
+    """Name of a sprite chunk, which changes whenever its content would."""
+    chunk_key = [SPRITE_VERSION, THUMBNAIL_SIZE, SPRITE_QUALITY] + [
+        [entry['x'], entry['y'], entry['w'], entry['h'], entry['name'], digests[entry['name']]]
+        for entry in entries
+    ]
+    chunk_digest = hl.sha256(json.dumps(chunk_key).encode("utf-8")).hexdigest()[:10]
+    return f"{SPRITE_PREFIX}_{chunk:03d}_{chunk_digest}"
+
+
+def _entry_slot(entry: dict) -> int | None:
+    if 's' not in entry:
+        return None
+
+    chunk = int(entry['s'].split("_")[1])
+    column = entry['x'] // (THUMBNAIL_SIZE + 2)
+    row = entry['y'] // (THUMBNAIL_SIZE + 2)
+    return chunk * SPRITE_CHUNK_TILES + row * SPRITE_COLUMNS + column
+
+
+def _layout_slots(img_names: list[str], old_entries: dict[str, dict], repack: bool) -> dict[str, int]:
+    """Assign each image a tile slot, keeping the slots of existing images.
+
+    New images are appended after the last used slot, so adding images
+    never moves existing tiles. Removed images leave a hole, until the
+    month is repacked.
+    """
+    slots = {}
+    if not repack:
+        for img_name in img_names:
+            old_entry = old_entries.get(img_name)
+            slot = old_entry and _entry_slot(old_entry)
+            if slot is not None and slot not in slots.values():
+                slots[img_name] = slot
+
+    next_slot = max(slots.values(), default=-1) + 1
+    for img_name in img_names:
+        if img_name not in slots:
+            slots[img_name] = next_slot
+            next_slot += 1
+
+    return slots
+
+
+def _probe_img(img_path: pl.Path, stat: os.stat_result) -> dict:
+    """Hash an image and read its size, from the decode cache or the image header."""
+    with img_path.open(mode='rb') as fobj:
+        data = fobj.read()
+
+    sha256 = hl.sha256(data).hexdigest()
+    meta = load_decoded(sha256)
+    if meta is None:
+        panzer_metrics.count("images_probed")
+        with Image.open(io.BytesIO(data)) as img:
+            meta = {'w': img.width, 'h': img.height}
+
+    return {
+        'size'  : stat.st_size,
+        'mtime' : stat.st_mtime_ns,
+        'w'     : meta['w'],
+        'h'     : meta['h'],
+        'sha256': sha256,
+    }
+
+
+def _scan_month(dirpath: pl.Path, old_records: dict[str, dict]) -> dict[str, dict]:
+    """Stat the images of a month, probing only those that are new or changed."""
+    records = {}
+    for dir_entry in sorted(os.scandir(dirpath), key=lambda e: e.name):
+        if not dir_entry.name.endswith(".jpg") or is_sprite_name(dir_entry.name):
+            continue
+
+        stat = dir_entry.stat()
+        record = old_records.get(dir_entry.name)
+        is_record_fresh = (
+            record is not None
+            and record['size'] == stat.st_size
+            and record['mtime'] == stat.st_mtime_ns
+        )
+        if not is_record_fresh:
+            record = _probe_img(dirpath / dir_entry.name, stat)
+        records[dir_entry.name] = record
+
+    return records
+
+
+def _update_month_index(
+    dirpath: pl.Path, old_records: dict[str, dict], repack: bool = False,
+) -> tuple[str | None, dict, int]:
+    entry_index_path = dirpath / "entry_index.json"
+    records = _scan_month(dirpath, old_records)
+    for img_name in sorted(set(records) | set(old_records)):
+        if records.get(img_name) != old_records.get(img_name):
+            _changed(dirpath / img_name)
+
+    if entry_index_path.exists():
+        with entry_index_path.open(mode='rb') as fobj:
+            old_entry_index_data = fobj.read()
+            old_entry_index = json.loads(old_entry_index_data.decode("utf-8"))
+    else:
+        old_entry_index_data = None
+        old_entry_index = []
 
-                thumbnails_image.paste(img.copy(), (offset_x + entry['x'], offset_y + entry['y']))
+    old_entries = {entry['name']: entry for entry in old_entry_index}
+    slots = _layout_slots(sorted(records), old_entries, repack)
 
-        thumbnails_image.save(str(thumbnails_path), "JPEG", quality=75, optimize=True, progressive=True)
+    chunks = collections.defaultdict(list)
+    for img_name, slot in sorted(slots.items(), key=lambda item: item[1]):
+        chunk, chunk_slot = divmod(slot, SPRITE_CHUNK_TILES)
+        column = chunk_slot % SPRITE_COLUMNS
+        row = chunk_slot // SPRITE_COLUMNS
+        chunks[chunk].append({
+            'x': column * (THUMBNAIL_SIZE + 2),
+            'y': row * (THUMBNAIL_SIZE + 2),
+            'w': records[img_name]['w'],
+            'h': records[img_name]['h'],
+            'name': img_name,
+        })
+        derived = derived_sizes(records[img_name]['w'], records[img_name]['h'])
+        if derived:
+            chunks[chunk][-1]['d'] = derived
 
+    digests = {img_name: record['sha256'] for img_name, record in records.items()}
+    new_entry_index = []
+    for chunk, entries in chunks.items():
+        stem = _sprite_stem(chunk, entries, digests)
+        for entry in entries:
+            entry['s'] = stem
+            new_entry_index.append(entry)
 
-def update_indexes(archive_repo_dir: pl.Path) -> None:
+    new_entry_index.sort(key=lambda e: e['name'])
+    new_entry_index_data = (
+        json.dumps(new_entry_index)
+            .replace("}, {", "},\n{")
+            .encode("utf-8")
+    )
+    if not records:
+        return (None, records, dirpath.stat().st_mtime_ns)
+
+    messages = []
+    if old_entry_index_data != new_entry_index_data:
+        messages.append(f"updating index    {entry_index_path}")
+        with entry_index_path.open(mode='wb') as fobj:
+            fobj.write(new_entry_index_data)
+        _changed(entry_index_path)
+
+    if _update_manifest(dirpath, records):
+        messages.append(f"updating manifest {dirpath / MANIFEST_NAME}")
+        _changed(dirpath / MANIFEST_NAME)
+
+    if _update_entry_block(dirpath, new_entry_index):
+        messages.append(f"updating block    {dirpath / ENTRY_BLOCK_NAME}")
+        _changed(dirpath / ENTRY_BLOCK_NAME)
+
+    return ("\n".join(messages) or None, records, dirpath.stat().st_mtime_ns)
+
+
+def _dump_compact_json(obj) -> bytes:
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def _write_if_changed(path: pl.Path, data: bytes) -> bool:
+    if path.exists() and path.read_bytes() == data:
+        return False
+
+    tmp_path = _tmp_path(path)
+    with tmp_path.open(mode='wb') as fobj:
+        fobj.write(data)
+    tmp_path.rename(path)
+    return True
+
+
+def _update_entry_block(dirpath: pl.Path, entry_index: list[dict]) -> bool:
+    """Write the entries of a month in columnar form, for assets/app.js.
+
+    {"tile": 152, "cols": 10, "chunk": 100,
+     "sprites": [chunk_stem, ...],  # indexed by chunk, null for empty chunks
+     "names": [...], "w": [...], "h": [...],
+     "t": [slot, ...],              # chunk = t // chunk, x/y from t % chunk
+     "dw": [derived_width, ...]}    # see derived_sizes
+    """
+    slots = [_entry_slot(entry) for entry in entry_index]
+    num_chunks = max(slots, default=-1) // SPRITE_CHUNK_TILES + 1
+    sprites = [None] * num_chunks
+    for entry, slot in zip(entry_index, slots):
+        sprites[slot // SPRITE_CHUNK_TILES] = entry['s']
+
+    entry_block = {
+        'tile'   : THUMBNAIL_SIZE + 2,
+        'cols'   : SPRITE_COLUMNS,
+        'chunk'  : SPRITE_CHUNK_TILES,
+        'sprites': sprites,
+        'names'  : [entry['name'] for entry in entry_index],
+        'w'      : [entry['w'] for entry in entry_index],
+        'h'      : [entry['h'] for entry in entry_index],
+        't'      : slots,
+        'dw'     : list(DERIVED_WIDTHS),
+    }
+    return _write_if_changed(dirpath / ENTRY_BLOCK_NAME, _dump_compact_json(entry_block))
+
+
+def write_gallery_manifest(img_dir: pl.Path, dir_index: dict[str, int]) -> bool:
+    """Write the month offsets of the whole gallery, newest month first.
+
+    offsets[i] is the gallery index of the newest entry of dirs[i], so
+    the client can find the month of any entry with a binary search.
+    """
+    dirs = sorted(dir_index, reverse=True)
+    offsets = list(it.accumulate((dir_index[dirname] for dirname in dirs[:-1]), initial=0))
+    gallery_manifest = {
+        'dirs'   : dirs,
+        'offsets': offsets if dirs else [],
+        'total'  : sum(dir_index.values()),
+    }
+    return _write_if_changed(img_dir / GALLERY_MANIFEST_NAME, _dump_compact_json(gallery_manifest))
+
+
+def file_digest(path: pl.Path) -> str:
+    with path.open(mode='rb') as fobj:
+        return hl.file_digest(fobj, "sha256").hexdigest()
+
+
+def load_manifest(dirpath: pl.Path) -> dict[str, dict] | None:
+    """Load the {name: {"sha256": ..., "size": ...}} manifest of a month."""
+    manifest_path = dirpath / MANIFEST_NAME
+    if not manifest_path.exists():
+        return None
+
+    with manifest_path.open(mode='rb') as fobj:
+        return json.load(fobj)
+
+
+def _update_manifest(dirpath: pl.Path, records: dict[str, dict]) -> bool:
+    manifest = {
+        name: {'sha256': record['sha256'], 'size': record['size']}
+        for name, record in records.items()
+    }
+    manifest_data = (
+        json.dumps(manifest, sort_keys=True)
+            .replace('}, "', '},\n"')
+            .encode("utf-8")
+    )
+
+    return _write_if_changed(dirpath / MANIFEST_NAME, manifest_data)
+
+
+def _collect_changed(func, *args) -> tuple:
+    """Call func(*args) and return its result with the paths it changed."""
+    num_changed = len(_CHANGED_PATHS)
+    result = func(*args)
+    changed_paths = _CHANGED_PATHS[num_changed:]
+    del _CHANGED_PATHS[num_changed:]
+    return (result, changed_paths)
+
+
+def _pool_map(func, tasks: list[tuple], workers: int | None = None) -> list:
+    """Run func(*task) for each task, in a process pool if workers > 1.
+
+    Results are returned in the order of the tasks, so callers behave
+    the same no matter how many workers were used.
+    """
+    workers = min(workers or INGEST_WORKERS, len(tasks))
+    if workers <= 1:
+        results = [panzer_metrics.collect(_collect_changed, func, *task) for task in tasks]
+    else:
+        with cf.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(panzer_metrics.collect, _collect_changed, func, *task) for task in tasks]
+            results = [future.result() for future in futures]
+
+    for (_, changed_paths), counters in results:
+        panzer_metrics.merge(counters)
+        _CHANGED_PATHS.extend(changed_paths)
+    return [result for (result, _), _ in results]
+
+
+def _print_messages(messages: list[str | None]) -> None:
+    for message in messages:
+        if message:
+            print(message)
+
+
+def update_derived(archive_repo_dir: pl.Path, force: bool = False, workers: int | None = None) -> None:
+    """Write the downscaled copies of images that are missing or outdated."""
+    tasks = _entry_index_tasks(archive_repo_dir, force)
+    _print_messages(_pool_map(_update_month_derived, tasks, workers))
+
+
+def _scan_journal_path(archive_repo_dir: pl.Path) -> pl.Path:
+    return archive_repo_dir / CACHE_DIR_NAME / "scan_journal.json"
+
+
+def _load_scan_journal(archive_repo_dir: pl.Path) -> dict:
+    """Load the scan journal of an archive repo.
+
+    {"dirs" : {"YYYY/MM": dir_mtime_ns},
+     "files": {"YYYY/MM": {name: {"size", "mtime", "w", "h", "sha256"}}}}
+    """
+    journal_path = _scan_journal_path(archive_repo_dir)
+    if not journal_path.exists():
+        return {"dirs": {}, "files": {}}
+
+    with journal_path.open(mode='rb') as fobj:
+        return json.load(fobj)
+
+
+def _dump_scan_journal(archive_repo_dir: pl.Path, journal: dict) -> None:
+    journal_path = _scan_journal_path(archive_repo_dir)
+    journal_path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_path = journal_path.parent / (journal_path.name + ".tmp")
+    with tmp_path.open(mode='wb') as fobj:
+        fobj.write(json.dumps(journal, sort_keys=True).encode("utf-8"))
+
+    tmp_path.rename(journal_path)
+
+
+def _refresh_scan_journal(archive_repo_dirs: list[pl.Path], changed_paths: list[pl.Path]) -> None:
+    """Record the mtime of the scanned month dirs that were written after the scan.
+
+    Sprites and derived copies are written after the scan, the months
+    would otherwise be scanned again by the next ingest.
+    """
+    changed_dirs = set()
+    for path in changed_paths:
+        changed_dirs.add(path.parent)
+        if path.parent.name == DERIVED_DIR_NAME:
+            changed_dirs.add(path.parent.parent)
+
+    for archive_repo_dir in archive_repo_dirs:
+        journal = _load_scan_journal(archive_repo_dir)
+        is_changed = False
+        for yyyy_mm_dirpath, dir_mtime in journal["dirs"].items():
+            dirpath = archive_repo_dir / "images" / yyyy_mm_dirpath
+            if dirpath in changed_dirs and dirpath.exists() and dirpath.stat().st_mtime_ns != dir_mtime:
+                journal["dirs"][yyyy_mm_dirpath] = dirpath.stat().st_mtime_ns
+                is_changed = True
+
+        if is_changed:
+            _dump_scan_journal(archive_repo_dir, journal)
+
+
+def _entry_index_tasks(
+    archive_repo_dir: pl.Path, force: bool = False, months: set[str] | None = None,
+) -> list[tuple]:
     archiv_img_dir = archive_repo_dir / "images"
     assert archiv_img_dir.exists(), archiv_img_dir
 
-    img_by_dir = collections.defaultdict(list)
-    for fpath in sorted(archiv_img_dir.glob("**/*.jpg")):
-        if fpath.name == "thumbnails.jpg":
-            continue
+    journal_files = _load_scan_journal(archive_repo_dir)["files"]
+
+    tasks = []
+    for entry_index_path in sorted(archiv_img_dir.glob("*/*/entry_index.json")):
+        yyyy_mm_dirpath = entry_index_path.parent.relative_to(archiv_img_dir).as_posix()
+        if months is None or yyyy_mm_dirpath in months:
+            tasks.append((entry_index_path, force, journal_files.get(yyyy_mm_dirpath)))
+    return tasks
 
-        yyyy_mm_dirpath = str(fpath.parent).split("images/", maxsplit=1)[-1]
-        assert re.match(r"\d{4}/\d{2}", yyyy_mm_dirpath), yyyy_mm_dirpath
-        img_by_dir[yyyy_mm_dirpath].append(fpath)
 
-    dir_index_path = archiv_img_dir / "dir_index.json"
+def update_thumbnails(archive_repo_dir: pl.Path, force: bool = False, workers: int | None = None) -> None:
+    """Render the sprite chunks referenced by the entry index of each month.
+
+    Chunks whose files already exist are skipped, their names change with
+    their content. Tiles of images that were already in the previous version
+    of a chunk (see thumbnails_index.json) are copied from it instead of
+    decoding the image again, other tiles come from the decode cache. With
+    force=True, every chunk is rebuilt.
+    """
+    tasks = _entry_index_tasks(archive_repo_dir, force)
+    _print_messages(_pool_map(_update_month_thumbnails, tasks, workers))
+
+
+def _write_dir_index(archive_repo_dir: pl.Path, dir_counts: dict[str, int]) -> None:
+    dir_index_path = archive_repo_dir / "images" / "dir_index.json"
     if dir_index_path.exists():
         with dir_index_path.open(mode='rb') as fobj:
             merged_dir_index_dicts = json.load(fobj)
     else:
         merged_dir_index_dicts = {}
 
-    for yyyy_mm_dirpath, img_paths in img_by_dir.items():
-        merged_dir_index_dicts[yyyy_mm_dirpath] = len(img_paths)
+    merged_dir_index_dicts.update(dir_counts)
 
     merged_dir_index_data = json.dumps(merged_dir_index_dicts, indent=2).encode("utf-8")
 
@@ -97,54 +866,269 @@ def update_indexes(archive_repo_dir: pl.Path) -> None:
     if not is_dir_index_fresh:
         with dir_index_path.open(mode='wb') as fobj:
             fobj.write(merged_dir_index_data)
+        _changed(dir_index_path)
+
 
-    for yyyy_mm_dirpath, img_paths in img_by_dir.items():
-        dirpath = archiv_img_dir.joinpath(*yyyy_mm_dirpath.split("/"))
-        entry_index_path = dirpath / "entry_index.json"
+def _update_indexes(
+    archive_repo_dirs: list[pl.Path],
+    force: bool = False,
+    workers: int | None = None,
+    months: set[str] | None = None,
+) -> None:
+    """Update the entry indexes of all months that changed since the last scan.
 
-        if entry_index_path.exists():
-            with entry_index_path.open(mode='rb') as fobj:
-                old_entry_index_data = fobj.read()
-                old_entry_index = json.loads(old_entry_index_data.decode("utf-8"))
+    A month is clean if the mtime of its directory matches the scan journal,
+    in which case none of its files are even stat-ed. In dirty months, only
+    images whose size or mtime differ from the journal are opened again.
+    With months ({"YYYY/MM", ...}), other months are left as they are.
+    """
+    old_journals = {}
+    new_journals = {}
+    tasks = []
+    task_keys = []
+
+    for archive_repo_dir in archive_repo_dirs:
+        archiv_img_dir = archive_repo_dir / "images"
+        assert archiv_img_dir.exists(), archiv_img_dir
+
+        if force:
+            old_journal = {"dirs": {}, "files": {}}
         else:
-            old_entry_index_data = None
-            old_entry_index = []
-
-        new_entry_index = []
-        old_entries = {entry['name']: entry for entry in old_entry_index}
-
-        for i, img_path in enumerate(reversed(img_paths)):
-            column = i % 10
-            row = i // 10
-            padding_x = column * 2
-            padding_y = row * 2
-            offset_x = padding_x + THUMBNAIL_SIZE * column
-            offset_y = padding_y + THUMBNAIL_SIZE * row
-
-            if not DEBUG_ENTRY_INDEX and img_path.name in old_entries:
-                new_entry_index.append(old_entries[img_path.name])
+            old_journal = _load_scan_journal(archive_repo_dir)
+
+        new_journal = {"dirs": {}, "files": {}}
+
+        for dirpath in sorted(archiv_img_dir.glob("*/*")):
+            if not dirpath.is_dir():
+                continue
+
+            yyyy_mm_dirpath = dirpath.relative_to(archiv_img_dir).as_posix()
+            assert re.match(r"\d{4}/\d{2}", yyyy_mm_dirpath), yyyy_mm_dirpath
+
+            if months is not None and yyyy_mm_dirpath not in months:
+                if yyyy_mm_dirpath in old_journal["files"]:
+                    new_journal["dirs"][yyyy_mm_dirpath] = old_journal["dirs"][yyyy_mm_dirpath]
+                    new_journal["files"][yyyy_mm_dirpath] = old_journal["files"][yyyy_mm_dirpath]
+                continue
+
+            dir_mtime = dirpath.stat().st_mtime_ns
+            is_dir_clean = (
+                old_journal["dirs"].get(yyyy_mm_dirpath) == dir_mtime
+                and (dirpath / "entry_index.json").exists()
+                and (dirpath / MANIFEST_NAME).exists()
+                and (dirpath / ENTRY_BLOCK_NAME).exists()
+            )
+            if is_dir_clean:
+                new_journal["dirs"][yyyy_mm_dirpath] = dir_mtime
+                new_journal["files"][yyyy_mm_dirpath] = old_journal["files"][yyyy_mm_dirpath]
             else:
-                with Image.open(img_path) as img:
-                    img_width, img_height = img.size
-
-                new_entry_index.append({
-                    'x': offset_x,
-                    'y': offset_y,
-                    'w': img_width,
-                    'h': img_height,
-                    'name': img_path.name,
-                })
-
-        new_entry_index.sort(key=lambda e: e['name'])
-        new_entry_index_data = (
-            json.dumps(new_entry_index)
-                .replace("}, {", "},\n{")
-                .encode("utf-8")
-        )
-        if old_entry_index_data != new_entry_index_data:
-            print("updating index   ", entry_index_path)
-            with entry_index_path.open(mode='wb') as fobj:
-                fobj.write(new_entry_index_data)
+                tasks.append((dirpath, old_journal["files"].get(yyyy_mm_dirpath, {}), force))
+                task_keys.append((archive_repo_dir, yyyy_mm_dirpath))
+
+        old_journals[archive_repo_dir] = old_journal
+        new_journals[archive_repo_dir] = new_journal
+
+    results = _pool_map(_update_month_index, tasks, workers)
+    for (archive_repo_dir, yyyy_mm_dirpath), (message, records, dir_mtime) in zip(task_keys, results):
+        if message:
+            print(message)
+        new_journals[archive_repo_dir]["dirs"][yyyy_mm_dirpath] = dir_mtime
+        new_journals[archive_repo_dir]["files"][yyyy_mm_dirpath] = records
+
+    for archive_repo_dir, new_journal in new_journals.items():
+        dir_counts = {
+            yyyy_mm_dirpath: len(records)
+            for yyyy_mm_dirpath, records in sorted(new_journal["files"].items())
+            if records
+        }
+        _write_dir_index(archive_repo_dir, dir_counts)
+
+        if new_journal != old_journals[archive_repo_dir]:
+            _dump_scan_journal(archive_repo_dir, new_journal)
+
+
+def update_indexes(archive_repo_dir: pl.Path, force: bool = False, workers: int | None = None) -> None:
+    _update_indexes([archive_repo_dir], force=force, workers=workers)
+
+
+def ingest(
+    archive_repo_dirs: list[pl.Path],
+    force: bool = False,
+    workers: int | None = None,
+    months: set[str] | None = None,
+) -> list[pl.Path]:
+    """Update indexes, thumbnails and derived images of several archive repos.
+
+    The months of all repos are processed by one pool of workers, so a
+    repo with a single dirty month doesn't leave the other cores idle.
+    With force=True, the decode cache is cleared and all images decoded
+    again. With months ({"YYYY/MM", ...}), only those months are updated.
+
+    Returns the paths that were written or removed (images that were
+    added, changed or removed included), for staging them in git.
+    """
+    _CHANGED_PATHS.clear()
+    if force:
+        shutil.rmtree(DECODE_CACHE_DIR, ignore_errors=True)
+
+    with panzer_metrics.stage("index"):
+        _update_indexes(archive_repo_dirs, force=force, workers=workers, months=months)
+    num_index_changes = len(_CHANGED_PATHS)
+
+    month_tasks = [
+        task for repo_dir in archive_repo_dirs for task in _entry_index_tasks(repo_dir, force, months)
+    ]
+    with panzer_metrics.stage("thumbnails"):
+        _print_messages(_pool_map(_update_month_thumbnails, month_tasks, workers))
+    with panzer_metrics.stage("derived"):
+        _print_messages(_pool_map(_update_month_derived, month_tasks, workers))
+
+    _refresh_scan_journal(archive_repo_dirs, _CHANGED_PATHS[num_index_changes:])
+    _prune_decode_cache()
+    return sorted(set(_CHANGED_PATHS))
+
+
+def _upload_datetime(img: Image.Image, upload_path: pl.Path) -> dt.datetime:
+    """When a photo was taken (exif), else the date in its name, else its mtime."""
+    exif = img.getexif()
+    for value in (exif.get_ifd(0x8769).get(36867), exif.get(306)):
+        try:
+            return dt.datetime.strptime(str(value).strip("\x00 "), "%Y:%m:%d %H:%M:%S")
+        except ValueError:
+            pass
+
+    match = UPLOAD_NAME_DATE_RE.search(upload_path.name)
+    if match:
+        try:
+            return dt.datetime(*(int(part or 0) for part in match.groups()))
+        except ValueError:
+            pass
+
+    return dt.datetime.fromtimestamp(upload_path.stat().st_mtime).replace(microsecond=0)
+
+
+def _prepare_upload(upload_path: pl.Path, staging_dir: pl.Path) -> dict:
+    """Date, digest and (if needed) convert an uploaded image.
+
+    Returns {"src", "path", "name", "dig"}, where path is the JPEG to
+    archive (the upload itself or a converted copy in staging_dir) and
+    name is <date>_<digest>.jpg. Returns {"src", "error"} for files that
+    can't be read as images.
+    """
+    try:
+        with Image.open(upload_path) as img:
+            posted = _upload_datetime(img, upload_path)
+            is_jpeg = (
+                img.format == 'JPEG'
+                and img.mode in ("RGB", "L")
+                and img.getexif().get(0x0112, 1) == 1
+            )
+            if not is_jpeg:
+                panzer_metrics.count("uploads_converted")
+                img = ImageOps.exif_transpose(img)
+                if img.has_transparency_data:
+                    rgba_img = img.convert('RGBA')
+                    img = Image.new('RGB', rgba_img.size, "white")
+                    img.paste(rgba_img, mask=rgba_img.getchannel('A'))
+                else:
+                    img = img.convert('RGB')
+                buf = io.BytesIO()
+                img.save(buf, "JPEG", quality=UPLOAD_QUALITY)
+                data = buf.getvalue()
+
+        if is_jpeg:
+            with upload_path.open(mode='rb') as fobj:
+                data = fobj.read()
+        meta = decode_img(data, digest=True)
+    except (OSError, ValueError, Image.DecompressionBombError) as ex:
+        return {'src': str(upload_path), 'error': str(ex)}
+
+    fname = posted.isoformat().replace(":", "")[:17] + "_" + meta['dig'] + ".jpg"
+    if is_jpeg:
+        img_path = upload_path
+    else:
+        img_path = staging_dir / (meta['sha256'] + ".jpg")
+        tmp_path = _tmp_path(img_path)
+        with tmp_path.open(mode='wb') as fobj:
+            fobj.write(data)
+        tmp_path.rename(img_path)
+
+    return {'src': str(upload_path), 'path': str(img_path), 'name': fname, 'dig': meta['dig']}
+
+
+def prepare_uploads(upload_paths: list[pl.Path], staging_dir: pl.Path, workers: int | None = None) -> list[dict]:
+    """Prepare uploads in parallel, see _prepare_upload.
+
+    Their tiles and derived copies end up in the decode cache, so the
+    ingest of their months doesn't decode them again.
+    """
+    staging_dir.mkdir(parents=True, exist_ok=True)
+    return _pool_map(_prepare_upload, [(upload_path, staging_dir) for upload_path in upload_paths], workers)
+
+
+def test_decode_img_threads(tmp_path: pl.Path, monkeypatch) -> None:
+    # reposts of an image are decoded by concurrent download threads
+    monkeypatch.setitem(globals(), 'DECODE_CACHE_DIR', tmp_path)
+    data = (pl.Path(__file__).parent / "test_images" / "test_1_full.jpg").read_bytes()
+    with cf.ThreadPoolExecutor(max_workers=4) as executor:
+        metas = list(executor.map(lambda _: decode_img(data, digest=True), range(8)))
+
+    assert all(meta == metas[0] for meta in metas)
+    assert metas[0]['dig'] == "12c254fd9a82"
+    assert not list(tmp_path.glob("*/*.tmp"))
+
+
+def test_superseded_sprites(tmp_path: pl.Path, monkeypatch) -> None:
+    monkeypatch.setitem(globals(), 'DECODE_CACHE_DIR', tmp_path / "decoded")
+    repo_dir = tmp_path / "panzer-archiv-02"
+    month_dir = repo_dir / "images" / "2026" / "10"
+    month_dir.mkdir(parents=True)
+    test_images_dir = pl.Path(__file__).parent / "test_images"
+
+    def sprite_names() -> set[str]:
+        return {path.name for path in month_dir.iterdir() if is_sprite_name(path.name)} - {THUMBNAILS_INDEX_NAME}
+
+    shutil.copyfile(test_images_dir / "test_1_small.jpg", month_dir / "2026-10-01T000000_1_12c254fd9a82.jpg")
+    with contextlib.redirect_stdout(io.StringIO()):
+        ingest([repo_dir], workers=1)
+    old_sprite_names = sprite_names()
+
+    # the replaced chunk is kept for the grace period, then removed
+    shutil.copyfile(test_images_dir / "test_2_small.jpg", month_dir / "2026-10-02T000000_2_a9a0086dbdad.jpg")
+    with contextlib.redirect_stdout(io.StringIO()):
+        ingest([repo_dir], workers=1)
+    assert old_sprite_names < sprite_names()
+
+    monkeypatch.setitem(globals(), 'SPRITE_GRACE_HOURS', -1)
+    with contextlib.redirect_stdout(io.StringIO()):
+        ingest([repo_dir], workers=1)
+    assert not old_sprite_names & sprite_names()
+
+
+
+def test_sprite_appends(tmp_path: pl.Path, monkeypatch) -> None:
+    monkeypatch.setitem(globals(), 'DECODE_CACHE_DIR', tmp_path / "decoded")
+    repo_dir = tmp_path / "panzer-archiv-02"
+    month_dir = repo_dir / "images" / "2026" / "10"
+    month_dir.mkdir(parents=True)
+    first_name = "2026-10-01T000000_1_12c254fd9a82.jpg"
+    shutil.copyfile(pl.Path(__file__).parent / "test_images" / "test_1_small.jpg", month_dir / first_name)
+
+    # each new image is appended to the open chunk, which is written again
+    first_tiles = []
+    for i in range(2, 6):
+        noise = Image.frombytes('RGB', (300, 200), os.urandom(300 * 200 * 3))
+        noise.save(month_dir / f"2026-10-0{i}T000000_{i}_000000000000.jpg", quality=90)
+        with contextlib.redirect_stdout(io.StringIO()):
+            ingest([repo_dir], workers=1)
+
+        with (month_dir / THUMBNAILS_INDEX_NAME).open('rb') as fobj:
+            (stem, tiles), = json.load(fobj).items()
+        x, y, _ = tiles[first_name]
+        with Image.open(month_dir / f"{stem}.jpg") as sprite:
+            first_tiles.append(sprite.crop((x, y, x + THUMBNAIL_SIZE, y + THUMBNAIL_SIZE)).tobytes())
+
+    assert len(set(first_tiles)) == 1
 
 
 def mk_datestr(datestr=None):
@@ -161,8 +1145,19 @@ def mk_datestr(datestr=None):
 
 
 def main(args: list[str] = []) -> int:
-    update_indexes()
-    update_thumbnails()
+    """Usage: ingest_uploads.py [--force] [--workers=N] [--profile=cprofile|tracemalloc] [archive_repo_dir ...]"""
+    force = "--force" in args
+    workers = None
+    profile = None
+    for arg in args:
+        if arg.startswith("--workers="):
+            workers = int(arg.split("=", 1)[1])
+        if arg.startswith("--profile="):
+            profile = arg.split("=", 1)[1]
+
+    paths = [arg for arg in args if not arg.startswith("-")] or ["."]
+    with panzer_metrics.run("ingest_uploads", profile=profile):
+        ingest([pl.Path(path).absolute() for path in paths], force=force, workers=workers)
     return 0
 
 
@@ -0,0 +1,249 @@
+"""
+Perceptual digests of images, used to detect duplicate uploads.
+
+The digest is based on a 4x4 version of the image, quantised to
+an 8 colour palette, so it survives re-encoding and rescaling.
+
+digest_imgs() computes the digests of many images at once. Images are
+decoded in a thread pool and the fingerprints are computed with numpy.
+"""
+
+import io
+import os
+import pathlib as pl
+import concurrent.futures as cf
+
+import panzer_metrics
+
+
+def _digest_pixels(img: "Image.Image") -> "Image.Image":
+    from PIL import Image
+
+    img = img.resize((4, 4), Image.Resampling.LANCZOS)
+    return img.convert('P', palette=Image.ADAPTIVE, colors=8)
+
+
+def digest_img(data: bytes, ) -> str:
+    from PIL import Image
+
+    panzer_metrics.count("images_decoded")
+    return digest_decoded(Image.open(io.BytesIO(data)))
+
+
+def digest_decoded(img: "Image.Image") -> str:
+    """The digest of an opened image, which must not be drafted or converted yet."""
+    img = _digest_pixels(img)
+
+    # Get pixel values
+    pixels = list(img.getdata())
+
+    # Calculate the mean pixel value
+    mean_pixel = sum(pixels) / len(pixels)
+
+    # Generate the fingerprint
+    fingerprint = [int(pixel - mean_pixel) for pixel in pixels]
+    offset = abs(min(fingerprint))
+    octal_str = ''.join(str(offset + val) for val in fingerprint)
+
+    # Convert the list to a hash string
+    return hex(int(octal_str, 8))[2:].zfill(12)
+
+
+def digest_img_path(path: pl.Path) -> str:
+    with path.open(mode="rb") as fobj:
+        return digest_img(fobj.read())
+
+
+def _load_palette_indexes(img_src: bytes | pl.Path, draft_size: int | None = None) -> bytes:
+    from PIL import Image
+
+    if isinstance(img_src, bytes):
+        img_src = io.BytesIO(img_src)
+
+    panzer_metrics.count("images_decoded")
+
+    with Image.open(img_src) as img:
+        if draft_size:
+            # Only decodes the JPEG at 1/2, 1/4 or 1/8 scale. This is much
+            # faster, but the digest may differ from a full decode.
+            img.draft(img.mode, (draft_size, draft_size))
+        return _digest_pixels(img).tobytes()
+
+
+def fingerprint_digests(palette_indexes: list[bytes]) -> list[str]:
+    """Compute the digests for rows of 16 palette indexes, same as digest_img."""
+    import numpy as np
+
+    pixels = np.frombuffer(b"".join(palette_indexes), dtype=np.uint8)
+    pixels = pixels.reshape(len(palette_indexes), 16).astype(np.float64)
+
+    mean_pixels = pixels.sum(axis=1, keepdims=True) / pixels.shape[1]
+    fingerprints = np.trunc(pixels - mean_pixels).astype(np.int64)
+    octal_digits = fingerprints - fingerprints.min(axis=1, keepdims=True)
+
+    values = octal_digits @ (8 ** np.arange(15, -1, -1, dtype=np.int64))
+    return [format(int(value), 'x').zfill(12) for value in values]
+
+
+def digest_imgs(
+    img_srcs: list[bytes | pl.Path],
+    draft_size: int | None = None,
+    workers: int | None = None,
+) -> list[str]:
+    """Compute the digests of many images (file contents or paths).
+
+    With draft_size=None, the results are exactly those of digest_img.
+    With a draft_size, JPEGs are decoded at the smallest scale that
+    is at least draft_size x draft_size, which can change the digest
+    of some images.
+    """
+    if not img_srcs:
+        return []
+
+    workers = workers or os.cpu_count() or 1
+    with cf.ThreadPoolExecutor(max_workers=workers) as executor:
+        palette_indexes = list(executor.map(
+            lambda img_src: _load_palette_indexes(img_src, draft_size),
+            img_srcs,
+        ))
+
+    return fingerprint_digests(palette_indexes)
+
+
+# the lowest bit of each of the 16 octal digits of a digest
+_DIGIT_LOW_BITS = int("1" * 16, 8)
+
+# Split into more than d blocks of digits, two digests that differ in d
+# digits are equal in at least one block. With INDEX_BLOCKS blocks of 4
+# digits, a search up to INDEX_BLOCKS - 1 only has to look at digests
+# that share a block with the query, larger distances compare with all.
+INDEX_BLOCKS = 4
+_BLOCK_BITS = 48 // INDEX_BLOCKS
+
+
+def _distance(value_a: int, value_b: int) -> int:
+    diff = value_a ^ value_b
+    return ((diff | diff >> 1 | diff >> 2) & _DIGIT_LOW_BITS).bit_count()
+
+
+def digest_distance(digest_a: str, digest_b: str) -> int:
+    """The number of fingerprint values (of 16) that differ between two digests."""
+    return _distance(int(digest_a, 16), int(digest_b, 16))
+
+
+class DigestIndex:
+    """The digests of images by name, with lookups of near-duplicates.
+
+    A name can have several digests (e.g. of re-posts that were
+    matched to it), any of them matches.
+    """
+
+    def __init__(self):
+        self.digests: dict[str, set[str]] = {}
+        self._names: dict[int, set[str]] = {}
+        self._blocks: list[dict[int, set[int]]] = [{} for _ in range(INDEX_BLOCKS)]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.digests
+
+    def __len__(self) -> int:
+        return len(self.digests)
+
+    def add(self, name: str, digest: str) -> bool:
+        """Add a digest of an image, returns False if it was already known."""
+        digests = self.digests.setdefault(name, set())
+        if digest in digests:
+            return False
+
+        digests.add(digest)
+        value = int(digest, 16)
+        if value not in self._names:
+            self._names[value] = set()
+            for i, block in enumerate(self._blocks):
+                block.setdefault(value >> (i * _BLOCK_BITS) & ((1 << _BLOCK_BITS) - 1), set()).add(value)
+        self._names[value].add(name)
+        return True
+
+    def search(self, digest: str, max_distance: int = 0) -> list[tuple[int, str]]:
+        """The (distance, name) of images within max_distance, closest first."""
+        value = int(digest, 16)
+        if max_distance < INDEX_BLOCKS:
+            candidates = set()
+            for i, block in enumerate(self._blocks):
+                candidates.update(block.get(value >> (i * _BLOCK_BITS) & ((1 << _BLOCK_BITS) - 1), ()))
+        else:
+            candidates = self._names
+
+        results = {}
+        for other_value in candidates:
+            distance = _distance(value, other_value)
+            if distance <= max_distance:
+                for name in self._names[other_value]:
+                    results[name] = min(distance, results.get(name, distance))
+        return sorted((distance, name) for name, distance in results.items())
+
+    def clusters(self, max_distance: int, is_related=None) -> list[list[str]]:
+        """Groups of names connected by digests within max_distance.
+
+        is_related(name_a, name_b) can veto a connection, e.g. by date.
+        """
+        parents = {name: name for name in self.digests}
+
+        def find(name: str) -> str:
+            while parents[name] != name:
+                parents[name] = parents[parents[name]]
+                name = parents[name]
+            return name
+
+        for name, digests in self.digests.items():
+            for digest in digests:
+                for _, other_name in self.search(digest, max_distance):
+                    if other_name != name and (is_related is None or is_related(name, other_name)):
+                        parents[find(other_name)] = find(name)
+
+        clusters = {}
+        for name in sorted(self.digests):
+            clusters.setdefault(find(name), []).append(name)
+        return sorted(cluster for cluster in clusters.values() if len(cluster) > 1)
+
+
+def test_digest_index():
+    assert digest_distance("12c254fd9a82", "12c254fd9a82") == 0
+    assert digest_distance("000000000000", "000000000007") == 1
+    assert digest_distance("000000000000", "000000000009") == 2
+
+    index = DigestIndex()
+    index.add("a.jpg", "12c254fd9a82")
+    index.add("b.jpg", "12c254fd9a83")
+    index.add("c.jpg", "a9a0086dbdad")
+    assert "a.jpg" in index and len(index) == 3
+    assert index.search("12c254fd9a82") == [(0, "a.jpg")]
+    assert index.search("12c254fd9a82", max_distance=1) == [(0, "a.jpg"), (1, "b.jpg")]
+    assert index.search("12c254fd9a82", max_distance=16) == [(0, "a.jpg"), (1, "b.jpg"), (15, "c.jpg")]
+    assert index.clusters(max_distance=1) == [["a.jpg", "b.jpg"]]
+    assert index.clusters(max_distance=1, is_related=lambda a, b: False) == []
+
+
+def test_fingerprint_image():
+    imgdir = pl.Path(__file__).parent / "test_images/"
+    # print(digest_img_path(imgdir / "test_1_small.jpg"))
+    # print(digest_img_path(imgdir / "test_2_small.jpg"))
+
+    assert digest_img_path(imgdir / "test_1_full.jpg")  == "12c254fd9a82"
+    assert digest_img_path(imgdir / "test_1_small.jpg") == "12c254fd9a82"
+    assert digest_img_path(imgdir / "test_2_full.jpg")  == "a9a0086dbdad"
+    assert digest_img_path(imgdir / "test_2_small.jpg") == "a9a0086dbdad"
+
+
+def test_digest_imgs():
+    # not run at import time (see panzer_imgsync), it decodes all images twice
+    imgdir = pl.Path(__file__).parent / "test_images/"
+    img_paths = [
+        imgdir / "test_1_full.jpg",
+        imgdir / "test_1_small.jpg",
+        imgdir / "test_2_full.jpg",
+        imgdir / "test_2_small.jpg",
+    ]
+    expected = ["12c254fd9a82", "12c254fd9a82", "a9a0086dbdad", "a9a0086dbdad"]
+    assert digest_imgs(img_paths) == expected
+    assert digest_imgs(img_paths, draft_size=64) == expected
@@ -3,6 +3,8 @@
 # requires-python = ">=3.13"
 # dependencies = [
 #   "pudb", "ipython",
+#   "jinja2>=3.1.6",
+#   "numpy>=2.0",
 #   "pillow>=11.1.0",
 #   "telethon>=1.39.0"
 # ]
@@ -19,28 +21,72 @@ Uses the following environment variables:
     PANZER_IMGSYNC_BOT_TOKEN
 
 The bot downloads recent images from the channel
-and write them to the "upload" directory.
+and writes them to the images/ directory of the month.
 
-The filenames should use the date (in isoformat) as a prefix
-and the sha256 hash of the file contents as a suffix.
+The filenames use the date (in isoformat) as a prefix
+and the digest of the image (see panzer_digest) as a suffix.
 
 Usage:
 
-    ./scripts/panter_imgsync.py [-h|--help] [--force]
+    ./scripts/panter_imgsync.py [-h|--help] [--force] [--profile=cprofile|tracemalloc]
+    ./scripts/panter_imgsync.py --daemon
+    ./scripts/panter_imgsync.py --export-messages
+    ./scripts/panter_imgsync.py --find-duplicates [--distance=2] [--days=N] [--index-all]
+    ./scripts/panter_imgsync.py --ingest-uploads [--keep] [--workers=N] [upload_dir]
+    ./scripts/panter_imgsync.py --rebuild-rankings
+
+A sync that is interrupted (flood wait, network error, full disk, ...)
+resumes from its journal in .cache/sync_journal.jsonl: photos that were
+downloaded and digested are not downloaded again and photos that were
+placed keep their place.
+
+With --daemon, the client stays connected and new messages of the
+channel trigger a sync, after DAEMON_DEBOUNCE_SECS without further
+messages (at most DAEMON_MAX_DELAY_SECS after the first one). A sync
+that fails (network error, flood wait, git, ...) is logged and retried
+after a backoff, it resumes from the journal like any other.
+
+With --find-duplicates, groups of archived images whose digests differ
+in at most --distance of their 16 fingerprint values are listed, for
+cleanup. With --days, only images posted within that many days of each
+other are grouped. With --index-all, images of all archive months that
+are not in the digest index yet are digested first (slow, once).
+
+With --ingest-uploads, the images in upload/ (e.g. dumps from
+contributors) are converted to JPEG where needed, named by their date
+(exif, file name or mtime) and digest, checked for duplicates and
+placed in the month of their archive repo. Only the months that got
+new images are then indexed. Ingested uploads are removed, unless
+--keep is given. The changes are committed by the next sync.
+
+Each sync updates the "top" rankings by reactions and forwards in
+images/top_*.json (see panzer_rankings), for the months of messages
+whose counts changed and of entry indexes the ingest wrote. With
+--rebuild-rankings, the counts of all messages are recorded and all
+months are ranked again (once, or after the state in .cache/rankings/
+was lost). The changes are committed by the next sync.
 """
 
 import io
 import os
 import re
 import sys
-import copy
+import asyncio
 import json
 import shutil
 import pathlib as pl
 import datetime as dt
+import fcntl
+import signal
+import traceback
 import contextlib
+import concurrent.futures as cf
 import subprocess as sp
 
+import panzer_metrics
+import panzer_rankings
+from panzer_digest import DigestIndex, digest_imgs, test_digest_index, test_fingerprint_image
+
 # Load environment variables
 APP_TITLE = 'panzerimgsync'
 API_ID = os.environ.get('PANZER_IMGSYNC_API_ID')
@@ -58,14 +104,62 @@ ROOT_DIR = pl.Path(__file__).parent.parent
 IMAGES_DIR = ROOT_DIR / "images"
 
 MESSAGES_CACHE_PATH = ROOT_DIR / "scripts" / "telegram_messages_cache.json"
+MESSAGES_LOG_PATH = ROOT_DIR / "scripts" / "telegram_messages.jsonl"
+MESSAGES_LOG_COMPACT_RATIO = 2
+
+# local, uncommitted caches
+CACHE_DIR = ROOT_DIR / ".cache"
+DIGEST_INDEX_PATH = CACHE_DIR / "digest_index.jsonl"
+# converted uploads, until they are placed
+UPLOAD_STAGING_DIR = CACHE_DIR / "uploads"
+
+UPLOAD_DIR = ROOT_DIR / "upload"
+# write-ahead journal of the running sync and its finished downloads,
+# both are removed once the messages of the sync are in the message log
+SYNC_JOURNAL_PATH = CACHE_DIR / "sync_journal.jsonl"
+DOWNLOADS_DIR = CACHE_DIR / "downloads"
+# counts of the messages by month and the months to rank again
+RANKINGS_STATE_DIR = CACHE_DIR / "rankings"
+
+# images with a similar digest within this many days are duplicates,
+# similar means at most DUP_MAX_DISTANCE of the 16 fingerprint values
+# differ. Photos of an album (posted within DUP_ALBUM_SECS) can be that
+# similar too, so they only count as duplicates with the same digest.
+DUP_WINDOW_DAYS = 3
+DUP_MAX_DISTANCE = int(os.environ.get('PANZER_IMGSYNC_DUP_DISTANCE', "1"))
+DUP_ALBUM_SECS = 600
+# images of the archive months within this window are added to the
+# digest index, if they are not already in it
+DIGEST_LOOKBACK_DAYS = 90
+
+# paths of a repo (www or archive) that were written but not committed
+# yet, one per line relative to the repo, in <repo>/.cache/
+UNCOMMITTED_PATHS_NAME = "uncommitted_paths.txt"
+
+# ioctl to share the data blocks of two files (btrfs, xfs)
+FICLONE = 0x40049409
+
+# number of photos that are downloaded at the same time
+DOWNLOAD_CONCURRENCY = int(os.environ.get('PANZER_IMGSYNC_DOWNLOADS', "4"))
+
+# daemon mode: sync once no new message arrived for DAEMON_DEBOUNCE_SECS,
+# but at most DAEMON_MAX_DELAY_SECS after the first new message, and
+# every DAEMON_POLL_SECS in any case (to update forwards and reactions)
+DAEMON_DEBOUNCE_SECS = float(os.environ.get('PANZER_IMGSYNC_DEBOUNCE', "60"))
+DAEMON_MAX_DELAY_SECS = float(os.environ.get('PANZER_IMGSYNC_MAX_DELAY', "600"))
+DAEMON_POLL_SECS = float(os.environ.get('PANZER_IMGSYNC_POLL', "7200"))
+# a failed daemon sync is retried after DAEMON_RETRY_SECS (or when new
+# messages arrive), the delay doubles with each failure in a row, up to
+# DAEMON_POLL_SECS. Flood waits are waited out in any case.
+DAEMON_RETRY_SECS = float(os.environ.get('PANZER_IMGSYNC_RETRY', "60"))
 
 _CLIENT = None
 
 def init_telethon_client() -> "telethon.TelegramClient":
     global _CLIENT
 
-    import telethon
     if _CLIENT is None:
+        import telethon
         _CLIENT = telethon.TelegramClient(APP_TITLE, API_ID, API_HASH)
     return _CLIENT
 
@@ -82,13 +176,46 @@ def change_dir(new_dir: pl.Path):
         os.chdir(old_dir)
 
 
+def _git(*args: str) -> int:
+    panzer_metrics.count("git_calls")
+    return sp.call(["git", *args])
+
+
 def mk_img_path(fname: str) -> pl.Path:
     datestr = fname.replace("-", "")
     return IMAGES_DIR / datestr[0:4] / datestr[4:6] / fname
 
 
+# number of records in the message log (by path), counted when it is
+# read or written, so appends don't have to read the log again
+_MESSAGES_LOG_RECORDS = {}
+
+
+def _read_messages_log() -> dict[int, dict]:
+    messages = {}
+    num_records = 0
+    with MESSAGES_LOG_PATH.open(mode='rb') as fobj:
+        for line in fobj:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            messages[record.pop('id')] = record
+            num_records += 1
+
+    _MESSAGES_LOG_RECORDS[MESSAGES_LOG_PATH] = num_records
+    return messages
+
+
 def load_last_messages() -> dict[int, dict]:
-    """Load messages from the cache file."""
+    """Load messages from the message log.
+
+    The log has one {"id": ..., "dig": ..., "name": ..., ...} record per
+    line, later records override earlier ones. If there is no log yet,
+    the messages are imported from the old json cache file.
+    """
+    if MESSAGES_LOG_PATH.exists():
+        return _read_messages_log()
+
     if not MESSAGES_CACHE_PATH.exists():
         return {}
 
@@ -96,58 +223,76 @@ def load_last_messages() -> dict[int, dict]:
         return {int(key): val for key, val in json.load(fobj).items()}
 
 
-def dump_messages(messages: dict[int, dict]) -> None:
-    """Dump messages to the cache file with pretty printing."""
-    msg_text = json.dumps(messages, sort_keys=True)
-    msg_text = msg_text.replace('}, "', '},\n"')
-    msg_data = msg_text.encode("utf-8")
+def _dump_message_record(msg_id: int, message: dict) -> bytes:
+    return json.dumps({'id': msg_id, **message}, sort_keys=True).encode("utf-8") + b"\n"
 
-    tmp_path = MESSAGES_CACHE_PATH.parent / (MESSAGES_CACHE_PATH.name + ".tmp")
+
+def compact_messages_log(messages: dict[int, dict]) -> None:
+    """Rewrite the message log with only one record per message."""
+    tmp_path = MESSAGES_LOG_PATH.parent / (MESSAGES_LOG_PATH.name + ".tmp")
     with tmp_path.open(mode="wb") as fobj:
-        fobj.write(msg_data)
+        for msg_id in sorted(messages):
+            fobj.write(_dump_message_record(msg_id, messages[msg_id]))
 
-    tmp_path.rename(MESSAGES_CACHE_PATH)
+    tmp_path.rename(MESSAGES_LOG_PATH)
+    _MESSAGES_LOG_RECORDS[MESSAGES_LOG_PATH] = len(messages)
+
+
+def dump_messages(messages: dict[int, dict], old_messages: dict[int, dict] | None = None) -> None:
+    """Append the messages that differ from old_messages to the message log.
 
+    The log is compacted once it has more than MESSAGES_LOG_COMPACT_RATIO
+    records per message.
+    """
+    if old_messages is None or not MESSAGES_LOG_PATH.exists():
+        compact_messages_log(messages)
+        return
 
-def digest_img(data: bytes, ) -> str:
-    from PIL import Image
+    changed_ids = sorted(
+        msg_id for msg_id, message in messages.items()
+        if old_messages.get(msg_id) != message
+    )
+    if not changed_ids:
+        return
 
-    img = Image.open(io.BytesIO(data))
-    img = img.resize((4, 4), Image.Resampling.LANCZOS)
-    img = img.convert('P', palette=Image.ADAPTIVE, colors=8)
+    if MESSAGES_LOG_PATH not in _MESSAGES_LOG_RECORDS:
+        _read_messages_log()
 
-    # Get pixel values
-    pixels = list(img.getdata())
+    with MESSAGES_LOG_PATH.open(mode="ab") as fobj:
+        for msg_id in changed_ids:
+            fobj.write(_dump_message_record(msg_id, messages[msg_id]))
 
-    # Calculate the mean pixel value
-    mean_pixel = sum(pixels) / len(pixels)
+    _MESSAGES_LOG_RECORDS[MESSAGES_LOG_PATH] += len(changed_ids)
+    num_records = _MESSAGES_LOG_RECORDS[MESSAGES_LOG_PATH]
 
-    # Generate the fingerprint
-    fingerprint = [int(pixel - mean_pixel) for pixel in pixels]
-    offset = abs(min(fingerprint))
-    octal_str = ''.join(str(offset + val) for val in fingerprint)
+    if num_records > MESSAGES_LOG_COMPACT_RATIO * len(messages):
+        compact_messages_log(messages)
 
-    # Convert the list to a hash string
-    return hex(int(octal_str, 8))[2:].zfill(12)
 
+def update_ranking_counts(messages: dict[int, dict], old_messages: dict[int, dict]) -> None:
+    """Record the counts of the messages that changed, for update_rankings."""
+    changed_messages = {
+        msg_id: message for msg_id, message in messages.items()
+        if old_messages.get(msg_id) != message
+    }
+    panzer_rankings.update_counts(RANKINGS_STATE_DIR, changed_messages)
 
-def digest_img_path(path: pl.Path) -> str:
-    with path.open(mode="rb") as fobj:
-        return digest_img(fobj.read())
 
+def export_messages(messages: dict[int, dict]) -> None:
+    """Write messages to the json cache file with pretty printing."""
+    msg_text = json.dumps(messages, sort_keys=True)
+    msg_text = msg_text.replace('}, "', '},\n"')
+    msg_data = msg_text.encode("utf-8")
 
-def test_fingerprint_image():
-    imgdir = pl.Path(__file__).parent / "test_images/"
-    # print(digest_img_path(imgdir / "test_1_small.jpg"))
-    # print(digest_img_path(imgdir / "test_2_small.jpg"))
+    tmp_path = MESSAGES_CACHE_PATH.parent / (MESSAGES_CACHE_PATH.name + ".tmp")
+    with tmp_path.open(mode="wb") as fobj:
+        fobj.write(msg_data)
 
-    assert digest_img_path(imgdir / "test_1_full.jpg")  == "12c254fd9a82"
-    assert digest_img_path(imgdir / "test_1_small.jpg") == "12c254fd9a82"
-    assert digest_img_path(imgdir / "test_2_full.jpg")  == "a9a0086dbdad"
-    assert digest_img_path(imgdir / "test_2_small.jpg") == "a9a0086dbdad"
+    tmp_path.rename(MESSAGES_CACHE_PATH)
 
 
 test_fingerprint_image()
+test_digest_index()
 
 
 def _parse_date(date_str):
@@ -159,9 +304,250 @@ def _parse_date(date_str):
 assert _parse_date("2024-09-30") == dt.date(2024, 9, 30)
 
 
-async def fetch_api_messages(old_messages: dict[int, dict]) -> dict[int, dict]:
+def load_digest_index() -> DigestIndex:
+    """Load the digests of archived images.
+
+    The index is an append-only file with one {"name": ..., "dig": ...}
+    record per line.
+    """
+    digest_index = DigestIndex()
+    if not DIGEST_INDEX_PATH.exists():
+        return digest_index
+
+    with DIGEST_INDEX_PATH.open(mode='rb') as fobj:
+        for line in fobj:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            digest_index.add(record['name'], record['dig'])
+
+    return digest_index
+
+
+def append_digest_index(digest_index: DigestIndex, fname: str, digest: str) -> None:
+    if not digest_index.add(fname, digest):
+        return
+
+    DIGEST_INDEX_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with DIGEST_INDEX_PATH.open(mode='ab') as fobj:
+        record = json.dumps({'name': fname, 'dig': digest})
+        fobj.write(record.encode("utf-8") + b"\n")
+
+
+def add_message_digests(digest_index: DigestIndex, messages: dict[int, dict]) -> None:
+    """Add the digests of all archived images that came from the channel.
+
+    The digest of each message was taken when its photo was downloaded,
+    so this covers the whole archive without decoding anything.
+    """
+    for msg_id in sorted(messages, key=int):
+        message = messages[msg_id]
+        if message.get('name') and message.get('dig') and message['name'] not in digest_index:
+            digest_index.add(message['name'], message['dig'])
+
+
+def _parse_datetime(fname: str) -> dt.datetime | None:
+    match = re.match(r"(\d{4}-\d{2}-\d{2}T\d{6})", fname)
+    return match and dt.datetime.strptime(match.group(1), "%Y-%m-%dT%H%M%S")
+
+
+def find_duplicate(
+    digest_index: DigestIndex,
+    digest: str,
+    date: dt.date,
+    max_distance: int = DUP_MAX_DISTANCE,
+    fname: str | None = None,
+) -> str | None:
+    """Return the name of the most similar image with a nearby date.
+
+    With the fname of the new image, similar images of the same album
+    are not considered.
+    """
+    posted = fname and _parse_datetime(fname)
+    for distance, other_fname in digest_index.search(digest, max_distance):
+        if abs((_parse_date(other_fname) - date).days) >= DUP_WINDOW_DAYS:
+            continue
+        other_posted = _parse_datetime(other_fname)
+        if distance > 0 and posted and other_posted and abs((posted - other_posted).total_seconds()) < DUP_ALBUM_SECS:
+            continue
+        return other_fname
+    return None
+
+
+def _iter_archive_img_paths(since: dt.date):
+    month = dt.date(since.year, since.month, 1)
+    while month <= dt.date.today():
+        yyyy = f"{month.year:04}"
+        mm = f"{month.month:02}"
+        img_dirs = [IMAGES_DIR / yyyy / mm]
+        if yyyy in IMG_REPOS:
+            img_dirs.append(ROOT_DIR.parent / IMG_REPOS[yyyy] / "images" / yyyy / mm)
+
+        for img_dir in img_dirs:
+            if img_dir.exists():
+                yield from sorted(img_dir.glob("*.jpg"))
+
+        month = (month + dt.timedelta(days=32)).replace(day=1)
+
+
+def update_digest_index(digest_index: DigestIndex, since: dt.date, check_duplicates: bool = True) -> None:
+    """Add images of the archive since the given date that are not yet indexed."""
+    fpaths = []
+    for fpath in _iter_archive_img_paths(since):
+        if fpath.name.startswith("thumbnails") or not re.match(r"\d{4}-?\d{2}-?\d{2}", fpath.name):
+            continue
+
+        if fpath.name not in digest_index:
+            fpaths.append(fpath)
+
+    panzer_metrics.count("images_indexed", len(fpaths))
+    for fpath, digest in zip(fpaths, digest_imgs(fpaths)):
+        date = _parse_date(fpath.name)
+
+        # Used to prevent duplicate uploads.
+        # files must have the same digest and have a date,
+        #   within 3 days of each other
+        dup_fname = find_duplicate(digest_index, digest, date, max_distance=0)
+        if dup_fname and check_duplicates:
+            errmsg = " ".join([
+                f"digest: {digest}",
+                f"old_path: {dup_fname}",
+                f"new_path : {fpath}",
+            ])
+            raise Exception(errmsg)
+
+        append_digest_index(digest_index, fpath.name, digest)
+
+
+def load_sync_journal() -> dict[int, dict]:
+    """Load the journal of an interrupted sync.
+
+    For each message, a {"id": ..., "dl": ..., "dig": ...} record is
+    appended when its photo is downloaded to DOWNLOADS_DIR and digested,
+    and a {"id": ..., "msg": {...}} record with its message record before
+    the photo is placed (moved to images/ or dropped). Records of a
+    message are merged. A partly written last line is cut off.
+    """
+    journal = {}
+    if not SYNC_JOURNAL_PATH.exists():
+        return journal
+
+    with SYNC_JOURNAL_PATH.open(mode='rb') as fobj:
+        data = fobj.read()
+
+    complete_len = data.rfind(b"\n") + 1
+    if complete_len < len(data):
+        os.truncate(SYNC_JOURNAL_PATH, complete_len)
+
+    for line in data[:complete_len].splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        journal.setdefault(record.pop('id'), {}).update(record)
+
+    return journal
+
+
+def append_sync_journal(msg_id: int, **fields) -> None:
+    SYNC_JOURNAL_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with SYNC_JOURNAL_PATH.open(mode='ab') as fobj:
+        fobj.write(json.dumps({'id': msg_id, **fields}, sort_keys=True).encode("utf-8") + b"\n")
+        fobj.flush()
+        os.fsync(fobj.fileno())
+
+
+def clear_sync_journal() -> None:
+    if SYNC_JOURNAL_PATH.exists():
+        SYNC_JOURNAL_PATH.unlink()
+    if DOWNLOADS_DIR.exists():
+        shutil.rmtree(DOWNLOADS_DIR)
+
+
+def _img_fname(dl_fname: str, digest: str) -> str:
+    return dl_fname.removesuffix(".jpg") + "_" + digest + ".jpg"
+
+
+def _place_download(digest_index: DigestIndex, dl_fname: str, message: dict) -> None:
+    """Move a downloaded photo to images/ if its message names it, else drop it.
+
+    Does what is left to do, if the photo was placed before.
+    """
+    is_new = message['name'] == _img_fname(dl_fname, message['dig'])
+    dl_fpath = DOWNLOADS_DIR / dl_fname
+    if dl_fpath.exists():
+        if is_new:
+            tgt_fpath = mk_img_path(message['name'])
+            tgt_fpath.parent.mkdir(parents=True, exist_ok=True)
+            dl_fpath.rename(tgt_fpath)
+        else:
+            dl_fpath.unlink()
+
+    if is_new:
+        append_digest_index(digest_index, message['name'], message['dig'])
+
+
+def _decode_download(fpath: pl.Path) -> str:
+    """Digest a downloaded photo, its tiles and derived copies are cached for the ingest."""
+    import ingest_uploads
+
+    with fpath.open(mode='rb') as fobj:
+        return ingest_uploads.decode_img(fobj.read(), digest=True)['dig']
+
+
+async def _download_img(
+    client, msg, semaphore: asyncio.Semaphore, executor: cf.Executor, journal_entry: dict,
+) -> tuple[str, str]:
+    """Download the photo of a message to DOWNLOADS_DIR and digest it.
+
+    Returns the name of the download and the digest. The download of an
+    interrupted sync is reused, if the journal has its digest.
+    """
+    fname_prefix = msg.date.isoformat().replace(":", "")[:17]
+    dl_fname = fname_prefix + "_" + str(msg.id) + ".jpg"
+    dl_fpath = DOWNLOADS_DIR / dl_fname
+    if journal_entry.get('dl') == dl_fname and dl_fpath.exists():
+        panzer_metrics.count("downloads_resumed")
+        return (dl_fname, journal_entry['dig'])
+
+    tmp_fpath = DOWNLOADS_DIR / (dl_fname + ".tmp")
+    tmp_fpath.parent.mkdir(parents=True, exist_ok=True)
+
+    async with semaphore:
+        await client.download_media(msg, file=str(tmp_fpath))
+
+    panzer_metrics.count("images_downloaded")
+    panzer_metrics.count("bytes_downloaded", tmp_fpath.stat().st_size)
+
+    loop = asyncio.get_running_loop()
+    digest = await loop.run_in_executor(executor, _decode_download, tmp_fpath)
+    tmp_fpath.rename(dl_fpath)
+    append_sync_journal(msg.id, dl=dl_fname, dig=digest)
+    return (dl_fname, digest)
+
+
+async def fetch_api_messages(
+    old_messages: dict[int, dict],
+    client=None,
+    digest_index: DigestIndex | None = None,
+) -> dict[int, dict]:
+    """Fetch recent messages of the channel and download their images.
+
+    Up to DOWNLOAD_CONCURRENCY photos are downloaded at once while the
+    messages are still being iterated. The downloads are then placed in
+    the order of the messages, so dedup works the same as it would with
+    one download at a time.
+
+    A digest_index that is kept between calls is updated in place,
+    instead of being loaded again.
+
+    Progress is written to the sync journal (see load_sync_journal), so
+    a sync after an interrupted one continues where it stopped. The
+    caller clears the journal once the messages are dumped.
+    """
+    if client is None:
+        client = init_telethon_client()
+
     # Getting information about yourself
-    client = init_telethon_client()
     me = await client.get_me()
 
     # print("client id/username:", me.id, me.username, me.phone)
@@ -174,41 +560,30 @@ async def fetch_api_messages(old_messages: dict[int, dict]) -> dict[int, dict]:
 
     limit = 200
 
-    new_messages = copy.deepcopy(old_messages)
-
-    fpaths = reversed(sorted(IMAGES_DIR.rglob("*.jpg")))
+    # records are replaced, never modified, so a shallow copy is enough
+    new_messages = dict(old_messages)
 
-    # Used to prevent duplicate uploads.
-    # files must have the same digest and have a date,
-    #   within 3 days of each other
-    digest_paths = {}
-    for fpath in fpaths:
-        if fpath.name == "thumbnails.jpg":
-            continue
+    if digest_index is None:
+        digest_index = load_digest_index()
+    add_message_digests(digest_index, old_messages)
+    update_digest_index(digest_index, since=dt.date.today() - dt.timedelta(days=DIGEST_LOOKBACK_DAYS))
 
-        date = _parse_date(fpath.name)
+    # placements of an interrupted sync are redone and then kept
+    journal = load_sync_journal()
+    for msg_id, journal_entry in sorted(journal.items()):
+        if 'msg' in journal_entry and msg_id not in old_messages:
+            _place_download(digest_index, journal_entry['dl'], journal_entry['msg'])
+            new_messages[msg_id] = journal_entry['msg']
+            print("resumed     :", msg_id, journal_entry['dig'], journal_entry['msg']['name'])
+            panzer_metrics.count("messages_resumed")
 
-        with fpath.open(mode='rb') as fobj:
-            data = fobj.read()
-            digest = digest_img(data)
-            if digest in digest_paths:
-                for old_date, old_fname in digest_paths[digest]:
-                    if abs((old_date - date).total_seconds()) < 3 * 24 * 3600:
-                        errmsg = " ".join([
-                            f"digest: {digest}",
-                            f"old_path: {digest_paths[digest]}",
-                            f"new_path : {fpath}",
-                        ])
-                        raise Exception(errmsg)
-                digest_paths[digest].append((date, fpath.name))
-            else:
-                digest_paths[digest] = [(date, fpath.name)]
-
-        if len(digest_paths) > limit * 10:
-            break
+    semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+    executor = cf.ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY)
+    downloads = []
 
     msg_iter = client.iter_messages(CHANNEL_NAME, min_id=min_id, limit=limit)
     async for msg in msg_iter:
+        panzer_metrics.count("messages_scanned")
         if msg.photo is None:
             # Skip if the message has no photo attached
             continue
@@ -225,59 +600,64 @@ async def fetch_api_messages(old_messages: dict[int, dict]) -> dict[int, dict]:
         #     for res in msg.reactions.results
         # })
 
-        if msg.id in old_messages:
-            digest = old_messages[msg.id]['dig']
-            tgt_fname = old_messages[msg.id]['name']
+        if msg.id in new_messages:
+            digest = new_messages[msg.id]['dig']
+            tgt_fname = new_messages[msg.id]['name']
 
             if msg.reactions:
-                new_messages[msg.id].update({
+                new_messages[msg.id] = {
+                    **new_messages[msg.id],
                     'tfwd' : msg.forwards,
                     'trct' : sum(res.count for res in msg.reactions.results),
-                })
+                }
             print("old         :", msg.id, digest, tgt_fname)
             continue
 
-        blob = await client.download_media(msg, bytes)
-        digest = digest_img(blob)
+        download = asyncio.ensure_future(_download_img(
+            client, msg, semaphore, executor, journal.get(msg.id, {}),
+        ))
+        downloads.append((msg, download))
 
-        fname_prefix = msg.date.isoformat().replace(":", "")[:17]
-        tgt_fname = fname_prefix + "_" + str(msg.id) + "_" + digest + ".jpg"
-        cur_date = _parse_date(fname_prefix)
+    try:
+        for msg, download in downloads:
+            dl_fname, digest = await download
 
-        if msg.reactions:
-            reactions = sum(res.count for res in msg.reactions.results)
-        else:
-            reactions = 0
-
-        # TODO (mb 2024-07-31): views/comments ?
-        new_messages[msg.id] = {
-            'name': tgt_fname,
-            'tfwd': int(msg.forwards),
-            'trct': reactions,
-            'dig' : digest,
-        }
-
-        # see if we can find an existing image that matches the digest
-        if digest in digest_paths:
-            for old_date, tgt_fname in digest_paths[digest]:
-                if abs((old_date - cur_date).total_seconds()) < 3 * 24 * 3600:
-                    new_messages[msg.id]['name'] = tgt_fname
-                    print("dup detected:", msg.id, digest, fname_prefix, tgt_fname)
-                    continue
-
-        if msg.id < 13310:
-            new_messages[msg.id]['name'] = None
-            print("missing     :", msg.id, digest, fname_prefix, tgt_fname)
-        else:
-            print("new         :", msg.id, digest, fname_prefix, tgt_fname)
+            fname_prefix = msg.date.isoformat().replace(":", "")[:17]
+            tgt_fname = _img_fname(dl_fname, digest)
+            cur_date = _parse_date(fname_prefix)
 
-            tgt_fpath = mk_img_path(tgt_fname)
-            tgt_fpath.parent.mkdir(parents=True, exist_ok=True)
+            if msg.reactions:
+                reactions = sum(res.count for res in msg.reactions.results)
+            else:
+                reactions = 0
+
+            # TODO (mb 2024-07-31): views/comments ?
+            new_messages[msg.id] = {
+                'name': tgt_fname,
+                'tfwd': int(msg.forwards),
+                'trct': reactions,
+                'dig' : digest,
+            }
+
+            # see if we can find an existing image that matches the digest
+            dup_fname = find_duplicate(digest_index, digest, cur_date, fname=tgt_fname)
+            if dup_fname:
+                new_messages[msg.id]['name'] = dup_fname
+                print("dup detected:", msg.id, digest, fname_prefix, dup_fname)
+                panzer_metrics.count("duplicates")
+            elif msg.id < 13310:
+                new_messages[msg.id]['name'] = None
+                print("missing     :", msg.id, digest, fname_prefix, tgt_fname)
+            else:
+                print("new         :", msg.id, digest, fname_prefix, tgt_fname)
+                panzer_metrics.count("images_new")
 
-            tmp_fpath = tgt_fpath.parent / (tgt_fpath.name + ".tmp")
-            with tmp_fpath.open(mode='wb') as fobj:
-                fobj.write(blob)
-            tmp_fpath.rename(tgt_fpath)
+            append_sync_journal(msg.id, msg=new_messages[msg.id])
+            _place_download(digest_index, dl_fname, new_messages[msg.id])
+    finally:
+        for msg, download in downloads:
+            download.cancel()
+        executor.shutdown(wait=False)
 
     return new_messages
 
@@ -299,68 +679,120 @@ IMG_REPOS = {
 }
 
 
-def _update_images(args: list[str]) -> tuple[pl.Path, pl.Path]:
+def _link_or_copy(src_path: pl.Path, dst_path: pl.Path) -> None:
+    """Hardlink or reflink src to dst if the filesystem allows, else copy it."""
+    tmp_path = dst_path.parent / (dst_path.name + ".tmp")
+    if tmp_path.exists():
+        tmp_path.unlink()
+
+    panzer_metrics.count("files_copied")
+
+    try:
+        os.link(src_path, tmp_path)
+    except OSError:
+        try:
+            with src_path.open(mode='rb') as src, tmp_path.open(mode='wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            shutil.copyfile(src_path, tmp_path)
+
+    tmp_path.rename(dst_path)
+
+
+def _sync_month(www_img_dir: pl.Path, archiv_img_dir: pl.Path) -> list[str]:
+    """Copy new or changed images of a www month dir to the archive repo.
+
+    The archive side is described by the manifest that ingest_uploads
+    writes for each month, so only the few files in the www dir are hashed.
+    """
+    import ingest_uploads
+
+    manifest = ingest_uploads.load_manifest(archiv_img_dir) or {}
+
+    delta = []
+    for www_path in sorted(www_img_dir.glob("*.jpg")):
+        archiv_path = archiv_img_dir / www_path.name
+        if not archiv_path.exists():
+            delta.append(www_path)
+            continue
+
+        archiv_digest = manifest.get(www_path.name, {}).get('sha256')
+        if archiv_digest is None:
+            archiv_digest = ingest_uploads.file_digest(archiv_path)
+        if ingest_uploads.file_digest(www_path) != archiv_digest:
+            delta.append(www_path)
+
+    transfer_size = sum(www_path.stat().st_size for www_path in delta)
+    print(f"sync {www_img_dir} -> {archiv_img_dir}: {len(delta)} files, {transfer_size / 1024:.1f} kb")
+
+    archiv_img_dir.mkdir(parents=True, exist_ok=True)
+    for www_path in delta:
+        _link_or_copy(www_path, archiv_img_dir / www_path.name)
+
+    return [www_path.name for www_path in delta]
+
+
+def _update_images(args: list[str]) -> tuple[list[pl.Path], dict[pl.Path, list[pl.Path]]]:
     client = init_telethon_client()
     old_messages = load_last_messages()
 
-    with client:
+    with panzer_metrics.stage("fetch"), client:
         _fetch_cor = fetch_api_messages(old_messages)
         new_messages = client.loop.run_until_complete(_fetch_cor)
 
     if old_messages != new_messages:
-        dump_messages(new_messages)
-
-    cur_dir = pl.Path(".").absolute()
-    new_img_dirs = list((cur_dir / "images").glob("20*/*"))
-    if new_img_dirs:
-        www_img_dir = new_img_dirs[0]
+        with panzer_metrics.stage("dump_messages"):
+            dump_messages(new_messages, old_messages)
+            update_ranking_counts(new_messages, old_messages)
+    clear_sync_journal()
 
-        year  = www_img_dir.parent.name
-        month = www_img_dir.name
+    return _copy_images(args)
 
-        archiv_repo  = cur_dir.parent / IMG_REPOS[year]
 
-        archiv_img_dir = archiv_repo / "images" / year / month
-        if not archiv_img_dir.exists():
-            archiv_img_dir.mkdir(parents=True, exist_ok=True)
+def _copy_images(args: list[str]) -> tuple[list[pl.Path], dict[pl.Path, list[pl.Path]]]:
+    """Copy the www month dirs to their archive repos.
 
-        for archiv_fpath in archiv_img_dir.iterdir():
-            shutil.copyfile(archiv_fpath, www_img_dir / archiv_fpath.name)
-    elif "--force" in args:
-        www_img_dir = None
-        archiv_repo  = max(cur_dir.parent.glob("panzer-archiv*"))
-        archiv_img_dir = max((archiv_repo / "images").glob("*/*"))
-    else:
-        return (None, None)
+    Returns the www month dirs and the copied images by archive repo.
+    """
+    cur_dir = pl.Path(".").absolute()
+    www_img_dirs = sorted((cur_dir / "images").glob("20*/*"))
+    archiv_paths = {}
+    with panzer_metrics.stage("copy"):
+        for www_img_dir in www_img_dirs:
+            year  = www_img_dir.parent.name
+            month = www_img_dir.name
 
-    def _ignore_existing(src_dir, entry_names) -> set:
-        ignore = set()
-        for name in entry_names:
-            www_path = www_img_dir / name
-            archiv_path = archiv_img_dir / name
+            archiv_repo  = cur_dir.parent / IMG_REPOS[year]
 
-            is_up_to_date = (
-                archiv_path.exists()
-                and www_path.stat().st_size == archiv_path.stat().st_size
-            )
-            if is_up_to_date:
-                ignore.add(name)
+            archiv_img_dir = archiv_repo / "images" / year / month
+            img_names = _sync_month(www_img_dir, archiv_img_dir)
 
-        return ignore
+            archiv_paths.setdefault(archiv_repo, []).extend(archiv_img_dir / img_name for img_name in img_names)
 
-    if www_img_dir:
-        print(f"cp -R {www_img_dir} {archiv_img_dir}")
-        shutil.copytree(www_img_dir, archiv_img_dir, ignore=_ignore_existing, dirs_exist_ok=True)
+    if not archiv_paths and "--force" in args:
+        archiv_paths[max(cur_dir.parent.glob("panzer-archiv*"))] = []
 
-    return (www_img_dir, archiv_repo)
+    return (www_img_dirs, archiv_paths)
 
 
-def _update_dir_index(www_img_dir):
-    if www_img_dir:
+def _update_dir_index(www_img_dirs: list[pl.Path]):
+    for www_img_dir in www_img_dirs:
         print(f"rm -rf {www_img_dir}")
         shutil.rmtree(www_img_dir)
-        sp.call(["git", "checkout", str(www_img_dir)])
+        _git("checkout", str(www_img_dir))
+
+    _merge_dir_index()
+
 
+def _merge_dir_index():
+    """Write the dir_index.json of the archive repos into the www repo.
+
+    index.html is rendered again, as it embeds the manifest and the entry
+    blocks of the newest months (see gen_html.first_screen), which change
+    with every new image, not only with the manifest. The written files,
+    with the hashed assets and compressed siblings of the build, are
+    recorded for the next www commit.
+    """
     cur_dir = pl.Path(".").absolute()
     dir_index = {}
     for year, repo in IMG_REPOS.items():
@@ -370,41 +802,467 @@ def _update_dir_index(www_img_dir):
             with repo_dir_index_path.open() as fobj:
                 dir_index.update(json.load(fobj))
 
+    import gen_html
+    import ingest_uploads
+    gallery_manifest_path = cur_dir / "images" / ingest_uploads.GALLERY_MANIFEST_NAME
+    if ingest_uploads.write_gallery_manifest(cur_dir / "images", dir_index):
+        add_uncommitted(cur_dir, [gallery_manifest_path])
+
     dir_index_path = cur_dir / "images" / "dir_index.json"
     with dir_index_path.open(mode="r") as fobj:
-        if dir_index == json.load(fobj):
-            return
+        dir_index_changed = dir_index != json.load(fobj)
+
+    if dir_index_changed:
+        # the message log is committed with the dir index, as it always was
+        add_uncommitted(cur_dir, [dir_index_path, gallery_manifest_path, cur_dir / "scripts" / "telegram_messages.jsonl"])
+        with dir_index_path.open(mode="w") as fobj:
+            print("writing dir_index.json")
+            json.dump(dir_index, fobj, sort_keys=True, indent=2)
 
-    with dir_index_path.open(mode="w") as fobj:
-        print("writing dir_index.json")
-        json.dump(dir_index, fobj, sort_keys=True, indent=2)
+    # after the json indexes, so their compressed siblings are up to date
+    add_uncommitted(cur_dir, gen_html.build(["index.html"]))
 
 
-def _commit_archive(archiv_repo):
-    with change_dir(archiv_repo):
-        import ingest_uploads
-        ingest_uploads.update_indexes(archiv_repo)
-        ingest_uploads.update_thumbnails(archiv_repo)
+def _uncommitted_paths_path(repo_dir: pl.Path) -> pl.Path:
+    return repo_dir / ".cache" / UNCOMMITTED_PATHS_NAME
 
-        print(f"git add&commit {archiv_repo}")
-        sp.call(["git", "add", "images/"])
-        sp.call(["git", "commit", "-m", "update " + dt.date.today().isoformat()])
-        sp.call(["git", "push"])
 
+def add_uncommitted(repo_dir: pl.Path, paths: list[pl.Path]) -> None:
+    """Record paths of a repo that were (or are about to be) written, for _commit_repo."""
+    if not paths:
+        return
+
+    record_path = _uncommitted_paths_path(repo_dir)
+    record_path.parent.mkdir(parents=True, exist_ok=True)
+    with record_path.open(mode='ab') as fobj:
+        for path in paths:
+            fobj.write(path.relative_to(repo_dir).as_posix().encode("utf-8") + b"\n")
+
+
+def _commit_repo(repo_dir: pl.Path, recover: bool = False) -> tuple[pl.Path, sp.Popen] | None:
+    """Stage the recorded paths of a repo, commit them and start the push.
+
+    All paths are staged by one git update-index, which also stages
+    removed paths, so git only looks at these paths instead of the
+    whole tree. With recover=True (the record is left from a run that
+    didn't finish), the whole months of the recorded paths are staged,
+    as that run may have written more than it recorded.
+
+    Returns the push, for _wait_pushes.
+    """
+    record_path = _uncommitted_paths_path(repo_dir)
+    if not record_path.exists():
+        return None
+
+    with record_path.open(mode='rb') as fobj:
+        rel_paths = sorted(set(fobj.read().decode("utf-8").splitlines()) - {""})
+
+    print(f"git add&commit {repo_dir} ({len(rel_paths)} paths)")
+    with change_dir(repo_dir):
+        panzer_metrics.count("git_calls")
+        pathspec = "".join(rel_path + "\0" for rel_path in rel_paths).encode("utf-8")
+        sp.run(["git", "update-index", "--add", "--remove", "-z", "--stdin"], input=pathspec, check=True)
+
+        if recover:
+            month_dirs = sorted({
+                match.group(0) for match in map(re.compile(r"^images/\d{4}/\d{2}(?=/)").match, rel_paths) if match
+            })
+            recover_paths = [path for path in month_dirs + ["images/dir_index.json"] if pl.Path(path).exists()]
+            if recover_paths:
+                print(f"git add {repo_dir}: {' '.join(recover_paths)} (recovering)")
+                _git("add", "-A", "--", *recover_paths)
+
+        _git("commit", "-m", "update " + dt.date.today().isoformat())
+
+    record_path.unlink()
+    return _start_push(repo_dir)
+
+
+def _start_push(repo_dir: pl.Path) -> tuple[pl.Path, sp.Popen]:
+    panzer_metrics.count("git_calls")
+    return (repo_dir, sp.Popen(["git", "push"], cwd=repo_dir))
+
+
+def _wait_pushes(pushes: list[tuple[pl.Path, sp.Popen]]) -> None:
+    for repo_dir, proc in pushes:
+        if proc.wait() != 0:
+            print(f"git push {repo_dir} failed: exit code {proc.returncode}")
+
+
+def _mark_rankings_dirty(changed_paths: list[pl.Path]) -> None:
+    # sprites and sizes in the rankings come from the entry indexes
+    panzer_rankings.mark_dirty(RANKINGS_STATE_DIR, (
+        path.parent.parent.name + "/" + path.parent.name
+        for path in changed_paths if path.name == "entry_index.json"
+    ))
+
+
+def _commit_archive(archiv_paths: dict[pl.Path, list[pl.Path]]) -> list[tuple[pl.Path, sp.Popen]]:
+    """Ingest the archive repos and commit the paths that were written.
+
+    The copied images are recorded before the ingest and the paths the
+    ingest wrote after it. Other archive repos with recorded paths (from
+    --ingest-uploads or a run that didn't finish) are committed too. The
+    pushes are started, but not waited for.
+    """
+    import ingest_uploads
 
-def _commit_www():
     cur_dir = pl.Path(".").absolute()
+    repo_dirs = list(archiv_paths)
+    for repo in IMG_REPOS.values():
+        repo_dir = cur_dir.parent / repo
+        if repo_dir not in repo_dirs and _uncommitted_paths_path(repo_dir).exists():
+            repo_dirs.append(repo_dir)
+
+    unfinished_repo_dirs = {repo_dir for repo_dir in repo_dirs if _uncommitted_paths_path(repo_dir).exists()}
+    for archiv_repo, paths in archiv_paths.items():
+        add_uncommitted(archiv_repo, paths)
+
+    if archiv_paths:
+        with panzer_metrics.stage("ingest"):
+            changed_paths = ingest_uploads.ingest(list(archiv_paths))
+        for archiv_repo in archiv_paths:
+            add_uncommitted(archiv_repo, [path for path in changed_paths if path.is_relative_to(archiv_repo)])
+        _mark_rankings_dirty(changed_paths)
+
+    pushes = []
+    with panzer_metrics.stage("commit_archive"):
+        for repo_dir in repo_dirs:
+            push = _commit_repo(repo_dir, recover=repo_dir in unfinished_repo_dirs)
+            if push:
+                pushes.append(push)
+    return pushes
+
+
+def _load_entry_index(month: str) -> list[dict]:
+    """The entries of a "YYYY/MM" month, from the entry_index.json of its archive repo."""
+    year = month[0:4]
+    if year not in IMG_REPOS:
+        return []
+    entry_index_path = pl.Path(".").absolute().parent / IMG_REPOS[year] / "images" / month / "entry_index.json"
+    if not entry_index_path.exists():
+        return []
+    with entry_index_path.open(mode='rb') as fobj:
+        return json.load(fobj)
+
+
+def update_rankings() -> None:
+    """Rank the months with changed counts or entries again.
+
+    The written files are recorded for the next www commit.
+    """
+    cur_dir = pl.Path(".").absolute()
+    changed_paths = panzer_rankings.update_rankings(RANKINGS_STATE_DIR, cur_dir / "images", _load_entry_index)
+    if changed_paths:
+        print(f"rankings    : {len(changed_paths)} files")
+        add_uncommitted(cur_dir, changed_paths)
+
+
+def _commit_www() -> list[tuple[pl.Path, sp.Popen]]:
+    push = _commit_repo(pl.Path(".").absolute())
+    return [push] if push else []
+
+
+def _publish(www_img_dirs: list[pl.Path], archiv_paths: dict[pl.Path, list[pl.Path]]) -> None:
+    """Commit the archive repos, update the dir index and commit the www repo.
 
-    result = sp.run(["git", "status"], capture_output=True, text=True)
-    assert result.returncode == 0
+    The pushes of all repos run at the same time, while the next steps go on.
+    """
+    pushes = _commit_archive(archiv_paths)
+    with panzer_metrics.stage("rankings"):
+        update_rankings()
+    with panzer_metrics.stage("dir_index"):
+        _update_dir_index(www_img_dirs)
+    with panzer_metrics.stage("commit_www"):
+        pushes += _commit_www()
+    with panzer_metrics.stage("push"):
+        _wait_pushes(pushes)
 
-    modified_files = set(re.findall(r"modified:\s+(.+)", result.stdout))
-    if "images/dir_index.json" in modified_files:
-        print(f"git add&commit {cur_dir}")
-        sp.call(["git", "add", str(cur_dir / "images" / "dir_index.json")])
-        sp.call(["git", "add", "scripts/telegram_messages_cache.json"])
-        sp.call(["git", "commit", "-m", "update " + dt.date.today().isoformat()])
-        sp.call(["git", "push"])
+
+def telethon_events(client) -> asyncio.Queue:
+    """A queue that receives the new messages of the channel."""
+    from telethon import events
+
+    queue = asyncio.Queue()
+
+    @client.on(events.NewMessage(chats=CHANNEL_NAME))
+    async def _on_new_message(event):
+        await queue.put(event.message)
+
+    return queue
+
+
+async def _next_batch(
+    events: asyncio.Queue, debounce: float, max_delay: float, poll_interval: float,
+) -> tuple[list, bool]:
+    """Wait for new messages and return them, with whether to stop.
+
+    Returns an empty batch after poll_interval without messages, right
+    away if it is 0. A None in the queue stops the daemon, after the
+    messages before it are synced.
+    """
+    if poll_interval <= 0:
+        return ([], False)
+
+    loop = asyncio.get_running_loop()
+    try:
+        msg = await asyncio.wait_for(events.get(), timeout=poll_interval)
+    except asyncio.TimeoutError:
+        return ([], False)
+    if msg is None:
+        return ([], True)
+
+    batch = [msg]
+    deadline = loop.time() + max_delay
+    while True:
+        timeout = min(debounce, deadline - loop.time())
+        if timeout <= 0:
+            return (batch, False)
+        try:
+            msg = await asyncio.wait_for(events.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return (batch, False)
+        if msg is None:
+            return (batch, True)
+        batch.append(msg)
+
+
+async def run_daemon(
+    client,
+    events: asyncio.Queue,
+    args: list[str] = [],
+    debounce: float = DAEMON_DEBOUNCE_SECS,
+    max_delay: float = DAEMON_MAX_DELAY_SECS,
+    poll_interval: float = DAEMON_POLL_SECS,
+    retry_delay: float = DAEMON_RETRY_SECS,
+) -> int:
+    """Sync in batches of new messages, until a None is put in events.
+
+    The messages and the digest index stay in memory between syncs.
+    Copying, ingest and commits run in a thread, so new messages are
+    queued for the next batch in the meantime. The first sync runs right
+    away, for what was posted (or left unfinished) while the daemon was
+    down. Returns the number of syncs that succeeded.
+    """
+    loop = asyncio.get_running_loop()
+    messages = load_last_messages()
+    digest_index = load_digest_index()
+
+    num_syncs = 0
+    num_failures = 0
+    wait_secs = 0
+    is_stopping = False
+    while not is_stopping:
+        batch, is_stopping = await _next_batch(events, debounce, max_delay, wait_secs)
+        if is_stopping and not batch:
+            break
+
+        print(f"daemon sync : {len(batch)} new messages")
+        try:
+            with panzer_metrics.run("panzer_imgsync_daemon"):
+                panzer_metrics.count("messages_received", len(batch))
+                with panzer_metrics.stage("fetch"):
+                    new_messages = await fetch_api_messages(messages, client=client, digest_index=digest_index)
+
+                if new_messages != messages:
+                    with panzer_metrics.stage("dump_messages"):
+                        dump_messages(new_messages, messages)
+                        update_ranking_counts(new_messages, messages)
+                    messages = new_messages
+                clear_sync_journal()
+
+                await loop.run_in_executor(None, lambda: _publish(*_copy_images(args)))
+        except Exception as ex:
+            traceback.print_exc()
+            num_failures += 1
+            # telethon's FloodWaitError says how long to wait
+            wait_secs = max(
+                min(retry_delay * 2 ** (num_failures - 1), poll_interval),
+                getattr(ex, 'seconds', 0) or 0,
+            )
+            if is_stopping:
+                print(f"daemon sync failed ({num_failures} in a row), stopping")
+            else:
+                print(f"daemon sync failed ({num_failures} in a row), retrying in {wait_secs:g}s")
+            continue
+
+        num_failures = 0
+        wait_secs = poll_interval
+        num_syncs += 1
+
+    return num_syncs
+
+
+def _find_img_path(fname: str) -> pl.Path | None:
+    img_path = mk_img_path(fname)
+    if img_path.exists():
+        return img_path
+
+    yyyy = fname[:4]
+    if yyyy in IMG_REPOS:
+        img_path = ROOT_DIR.parent / IMG_REPOS[yyyy] / img_path.relative_to(ROOT_DIR)
+        if img_path.exists():
+            return img_path
+    return None
+
+
+def find_duplicates(
+    digest_index: DigestIndex, max_distance: int, max_days: int | None = None,
+) -> list[list[str]]:
+    """Groups of images with similar digests, posted within max_days of each other."""
+    def is_related(fname_a: str, fname_b: str) -> bool:
+        return max_days is None or abs((_parse_date(fname_a) - _parse_date(fname_b)).days) <= max_days
+
+    return digest_index.clusters(max_distance, is_related)
+
+
+def _find_duplicates_main(args: list[str]) -> int:
+    max_distance = 2
+    max_days = None
+    for arg in args:
+        if arg.startswith("--distance="):
+            max_distance = int(arg.split("=", 1)[1])
+        if arg.startswith("--days="):
+            max_days = int(arg.split("=", 1)[1])
+
+    digest_index = load_digest_index()
+    add_message_digests(digest_index, load_last_messages())
+    if "--index-all" in args:
+        first_year = int(min(IMG_REPOS))
+        update_digest_index(digest_index, since=dt.date(first_year, 1, 1), check_duplicates=False)
+
+    clusters = find_duplicates(digest_index, max_distance, max_days)
+    for cluster in clusters:
+        print(f"{len(cluster)} similar images:")
+        for fname in cluster:
+            img_path = _find_img_path(fname)
+            img_size = f"{img_path.stat().st_size / 1024:9.1f} kb" if img_path else "  missing"
+            digests = ",".join(sorted(digest_index.digests[fname]))
+            print(f"    {fname:<60} {digests:<26} {img_size}  {img_path or ''}")
+
+    print(f"{len(clusters)} groups, {sum(len(cluster) for cluster in clusters)} images")
+    return 0
+
+
+def ingest_upload_dir(
+    upload_dir: pl.Path, keep: bool = False, workers: int | None = None,
+) -> dict[pl.Path, set[str]]:
+    """Place the images of upload_dir in the archive repos and ingest their months.
+
+    Uploads are prepared (converted, dated and digested) in parallel, then
+    placed in the order of their dates, so of duplicates within the upload
+    the oldest one is kept. Returns the months that changed by archive repo.
+    """
+    import ingest_uploads
+
+    upload_paths = []
+    for path in sorted(upload_dir.rglob("*")):
+        if not path.is_file() or path.name.startswith(".") or path.name == "README.md":
+            continue
+        if path.suffix.lower() in ingest_uploads.UPLOAD_SUFFIXES:
+            upload_paths.append(path)
+        else:
+            print("skipped     :", path)
+
+    if not upload_paths:
+        print(f"no uploads in {upload_dir}")
+        return {}
+
+    print(f"preparing {len(upload_paths)} uploads")
+    with panzer_metrics.stage("prepare"):
+        uploads = ingest_uploads.prepare_uploads(upload_paths, UPLOAD_STAGING_DIR, workers)
+
+    for upload in uploads:
+        if 'error' in upload:
+            print("invalid     :", upload['src'], upload['error'])
+            panzer_metrics.count("uploads_invalid")
+    uploads = sorted((upload for upload in uploads if 'error' not in upload), key=lambda upload: upload['name'])
+
+    changed_months = {}
+    with panzer_metrics.stage("dedupe"):
+        digest_index = load_digest_index()
+        add_message_digests(digest_index, load_last_messages())
+        if uploads:
+            first_date = _parse_date(uploads[0]['name']) - dt.timedelta(days=DUP_WINDOW_DAYS)
+            update_digest_index(digest_index, since=first_date, check_duplicates=False)
+
+    with panzer_metrics.stage("place"):
+        for upload in uploads:
+            fname = upload['name']
+            yyyy, mm = fname[0:4], fname[5:7]
+            archiv_repo = ROOT_DIR.parent / IMG_REPOS.get(yyyy, "")
+            if yyyy not in IMG_REPOS or not (archiv_repo / "images").exists():
+                print("no archive  :", upload['src'], fname)
+                continue
+
+            dup_fname = find_duplicate(digest_index, upload['dig'], _parse_date(fname), fname=fname)
+            if dup_fname:
+                print("dup detected:", upload['src'], fname, dup_fname)
+                panzer_metrics.count("duplicates")
+            else:
+                print("new         :", upload['src'], fname)
+                panzer_metrics.count("images_new")
+                tgt_fpath = archiv_repo / "images" / yyyy / mm / fname
+                tgt_fpath.parent.mkdir(parents=True, exist_ok=True)
+                add_uncommitted(archiv_repo, [tgt_fpath])
+                _link_or_copy(pl.Path(upload['path']), tgt_fpath)
+                append_digest_index(digest_index, fname, upload['dig'])
+                changed_months.setdefault(archiv_repo, set()).add(f"{yyyy}/{mm}")
+
+            if not keep:
+                pl.Path(upload['src']).unlink()
+
+    shutil.rmtree(UPLOAD_STAGING_DIR, ignore_errors=True)
+
+    if changed_months:
+        with panzer_metrics.stage("ingest"):
+            changed_paths = ingest_uploads.ingest(
+                sorted(changed_months), workers=workers, months=set().union(*changed_months.values()),
+            )
+        for archiv_repo in changed_months:
+            add_uncommitted(archiv_repo, [path for path in changed_paths if path.is_relative_to(archiv_repo)])
+        _mark_rankings_dirty(changed_paths)
+        with panzer_metrics.stage("dir_index"), change_dir(ROOT_DIR):
+            _merge_dir_index()
+
+    return changed_months
+
+
+def _ingest_uploads_main(args: list[str]) -> int:
+    workers = None
+    for arg in args:
+        if arg.startswith("--workers="):
+            workers = int(arg.split("=", 1)[1])
+
+    upload_dirs = [pl.Path(arg) for arg in args if not arg.startswith("-")] or [UPLOAD_DIR]
+    with panzer_metrics.run("panzer_imgsync_uploads"):
+        changed_months = ingest_upload_dir(upload_dirs[0].absolute(), keep="--keep" in args, workers=workers)
+
+    for archiv_repo, months in sorted(changed_months.items()):
+        print(f"uncommitted: {archiv_repo} ({', '.join(sorted(months))})")
+    return 0
+
+
+def _rebuild_rankings_main(args: list[str]) -> int:
+    messages = load_last_messages()
+    with open(IMAGES_DIR / "dir_index.json", mode="r") as fobj:
+        months = list(json.load(fobj))
+
+    with change_dir(ROOT_DIR):
+        panzer_rankings.update_counts(RANKINGS_STATE_DIR, messages)
+        panzer_rankings.mark_dirty(RANKINGS_STATE_DIR, months)
+        update_rankings()
+    return 0
+
+
+def _daemon_main(args: list[str]) -> int:
+    client = init_telethon_client()
+    with client:
+        events = telethon_events(client)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            client.loop.add_signal_handler(signum, events.put_nowait, None)
+        client.loop.run_until_complete(run_daemon(client, events, args))
+    return 0
 
 
 def main(args: list[str]) -> int:
@@ -412,11 +1270,30 @@ def main(args: list[str]) -> int:
         print(__doc__)
         return 0
 
-    www_img_dir, archiv_repo = _update_images(args)
-    if archiv_repo:
-        _commit_archive(archiv_repo)
-    _update_dir_index(www_img_dir)
-    _commit_www()
+    if "--export-messages" in args:
+        export_messages(load_last_messages())
+        return 0
+
+    if "--daemon" in args:
+        return _daemon_main(args)
+
+    if "--find-duplicates" in args:
+        return _find_duplicates_main(args)
+
+    if "--ingest-uploads" in args:
+        return _ingest_uploads_main(args)
+
+    if "--rebuild-rankings" in args:
+        return _rebuild_rankings_main(args)
+
+    profile = None
+    for arg in args:
+        if arg.startswith("--profile="):
+            profile = arg.split("=", 1)[1]
+
+    with panzer_metrics.run("panzer_imgsync", profile=profile):
+        www_img_dirs, archiv_paths = _update_images(args)
+        _publish(www_img_dirs, archiv_paths)
     return 0
 
 if __name__ == '__main__':
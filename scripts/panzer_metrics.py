@@ -0,0 +1,227 @@
+"""
+Structured timings and counters of sync and ingest runs.
+
+A run appends JSON lines to METRICS_LOG_PATH: one "stage" record when
+a stage ends and one "run" record at the end of the run. Each record
+has the wall and cpu time, the bytes read and written (from
+/proc/self/io, including reaped subprocesses) and the counters that
+were incremented while it was active.
+
+    with panzer_metrics.run("panzer_imgsync"):
+        with panzer_metrics.stage("fetch"):
+            ...
+            panzer_metrics.count("images_downloaded")
+
+Outside of a run, stages and counters cost next to nothing and
+nothing is written, so library callers (benchmarks etc.) are not
+affected.
+
+With profile="cprofile" the run is profiled and the stats are written
+next to the log, with profile="tracemalloc" the stage records get
+the peak memory and the run record the top allocations. Only the main
+process is profiled, not the ingest workers.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+import collections
+import pathlib as pl
+import datetime as dt
+
+METRICS_LOG_PATH = pl.Path(os.environ.get(
+    'PANZER_METRICS_LOG',
+    pl.Path(__file__).parent.parent / ".cache" / "metrics.jsonl",
+))
+
+# set to profile a single run without changing the command line
+PROFILE_MODE = os.environ.get('PANZER_PROFILE')
+PROFILE_MODES = ("cprofile", "tracemalloc")
+PROFILE_TOP_N = 20
+
+_LOCK = threading.Lock()
+_COUNTERS = collections.Counter()
+_RUN = None
+
+
+def count(name: str, num: int = 1) -> None:
+    with _LOCK:
+        _COUNTERS[name] += num
+
+
+def collect(func, *args) -> tuple:
+    """Call func(*args) and return its result with the counters it incremented.
+
+    Used for the tasks of a process pool, whose counters would
+    otherwise be lost with the worker.
+    """
+    global _COUNTERS
+
+    with _LOCK:
+        outer_counters = _COUNTERS
+        _COUNTERS = collections.Counter()
+    try:
+        result = func(*args)
+    finally:
+        with _LOCK:
+            task_counters = _COUNTERS
+            _COUNTERS = outer_counters
+    return (result, dict(task_counters))
+
+
+def merge(counters: dict[str, int]) -> None:
+    with _LOCK:
+        _COUNTERS.update(counters)
+
+
+def _io_counters() -> tuple[int, int]:
+    try:
+        with open("/proc/self/io", mode='rb') as fobj:
+            io_counters = dict(line.split(b":") for line in fobj.read().splitlines())
+    except OSError:
+        return (0, 0)
+    return (int(io_counters[b'rchar']), int(io_counters[b'wchar']))
+
+
+def _snapshot() -> tuple:
+    with _LOCK:
+        counters = dict(_COUNTERS)
+    return (time.perf_counter(), time.process_time(), *_io_counters(), counters)
+
+
+def _delta(started: tuple) -> dict:
+    t0, cpu0, read0, written0, counters0 = started
+    t1, cpu1, read1, written1, counters1 = _snapshot()
+    return {
+        'wall'         : round(t1 - t0, 6),
+        'cpu'          : round(cpu1 - cpu0, 6),
+        'bytes_read'   : read1 - read0,
+        'bytes_written': written1 - written0,
+        'counters'     : {
+            name: num - counters0.get(name, 0)
+            for name, num in sorted(counters1.items())
+            if num != counters0.get(name, 0)
+        },
+    }
+
+
+def _write(record: dict) -> None:
+    try:
+        METRICS_LOG_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with METRICS_LOG_PATH.open(mode='ab') as fobj:
+            fobj.write(json.dumps(record).encode("utf-8") + b"\n")
+    except OSError as ex:
+        print(f"metrics: can't write {METRICS_LOG_PATH}: {ex}", file=sys.stderr)
+
+
+def _record(event: str, **fields) -> dict:
+    return {
+        'ts'   : dt.datetime.now().isoformat(timespec='milliseconds'),
+        'run'  : _RUN['id'],
+        'prog' : _RUN['prog'],
+        'event': event,
+        **fields,
+    }
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Time a stage of the current run, stages can be nested."""
+    if _RUN is None:
+        yield
+        return
+
+    _RUN['stack'].append(name)
+    stage_path = "/".join(_RUN['stack'])
+    started = _snapshot()
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        record = _record("stage", stage=stage_path, status=status, **_delta(started))
+        if _RUN['profile'] == "tracemalloc":
+            import tracemalloc
+            record['mem_peak_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.reset_peak()
+            _RUN['mem_peak_kb'] = max(_RUN['mem_peak_kb'], record['mem_peak_kb'])
+        _RUN['stack'].pop()
+        _write(record)
+
+
+def _profile_top(profiler) -> list[dict]:
+    import pstats
+
+    stats = pstats.Stats(profiler).stats
+    top = sorted(stats.items(), key=lambda item: -item[1][3])[:PROFILE_TOP_N]
+    return [
+        {
+            'func'   : f"{fname}:{lineno}({func_name})",
+            'calls'  : num_calls,
+            'tottime': round(tottime, 6),
+            'cumtime': round(cumtime, 6),
+        }
+        for (fname, lineno, func_name), (_, num_calls, tottime, cumtime, _) in top
+    ]
+
+
+def _tracemalloc_top() -> list[dict]:
+    import tracemalloc
+
+    snapshot = tracemalloc.take_snapshot()
+    return [
+        {'line': str(stat.traceback), 'size_kb': stat.size // 1024, 'count': stat.count}
+        for stat in snapshot.statistics('lineno')[:PROFILE_TOP_N]
+    ]
+
+
+@contextlib.contextmanager
+def run(prog: str, profile: str | None = None):
+    """Record the stages of a run; a run inside of a run is part of it."""
+    global _RUN
+
+    if _RUN is not None:
+        with stage(prog):
+            yield
+        return
+
+    profile = profile or PROFILE_MODE
+    assert profile in (None, "") + PROFILE_MODES, f"invalid profile mode: {profile}"
+
+    run_id = dt.datetime.now().strftime("%Y%m%dT%H%M%S") + f"-{os.getpid()}"
+    _RUN = {'id': run_id, 'prog': prog, 'stack': [], 'profile': profile, 'mem_peak_kb': 0}
+
+    profiler = None
+    if profile == "cprofile":
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profile == "tracemalloc":
+        import tracemalloc
+        tracemalloc.start()
+
+    started = _snapshot()
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        record = _record("run", status=status, argv=sys.argv[1:], **_delta(started))
+        if profiler:
+            profiler.disable()
+            profile_path = METRICS_LOG_PATH.parent / f"profile_{run_id}.prof"
+            profile_path.parent.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(str(profile_path))
+            record['profile_path'] = str(profile_path)
+            record['profile_top'] = _profile_top(profiler)
+        elif profile == "tracemalloc":
+            import tracemalloc
+            record['mem_peak_kb'] = max(_RUN['mem_peak_kb'], tracemalloc.get_traced_memory()[1] // 1024)
+            record['tracemalloc_top'] = _tracemalloc_top()
+            tracemalloc.stop()
+
+        _RUN = None
+        _write(record)
@@ -0,0 +1,226 @@
+"""
+Precomputed "top" rankings of the gallery, by reactions and forwards.
+
+For each month, year and all-time and each metric ("rct" for reactions,
+"fwd" for forwards), images/top_<scope>_<metric>.json lists the images
+with the highest counts, newer images first among equal counts:
+
+    images/top_2025-09_rct.json     all images of the month with a count
+    images/top_2025_rct.json        the RANKING_TOP_N of the year
+    images/top_all_rct.json         the RANKING_TOP_N of all time
+
+Each entry is the entry of the image in the entry_index.json of its
+month, with the month dir and both counts added, so assets/app.js
+can show a ranking like a month of the gallery:
+
+    {"dir": "2025/09", "name": ..., "w": ..., "h": ..., "x": ..., "y": ...,
+     "s": ..., "d": [...], "rct": 12, "fwd": 3}
+
+The counts of each message are kept in <state_dir>/<YYYY-MM>.json,
+so recording them again is harmless. Reposts point to the same image,
+their counts are summed. Updates only touch what changed: the months
+of changed messages (or entry indexes) are ranked again, their years
+are merged from the rankings of their months and all-time from the
+rankings of the years.
+"""
+
+import json
+import pathlib as pl
+import typing as typ
+
+RANKING_METRICS = ("rct", "fwd")
+RANKING_TOP_N = 300
+RANKING_PREFIX = "top"
+
+# months whose rankings are outdated, one "YYYY/MM" per line
+DIRTY_MONTHS_NAME = "dirty_months.txt"
+
+# message fields of the counts of each metric
+MESSAGE_FIELDS = {'rct': 'trct', 'fwd': 'tfwd'}
+
+
+def ranking_path(img_dir: pl.Path, scope: str, metric: str) -> pl.Path:
+    """scope is "YYYY/MM", "YYYY" or "all"."""
+    return img_dir / f"{RANKING_PREFIX}_{scope.replace('/', '-')}_{metric}.json"
+
+
+def _month_state_path(state_dir: pl.Path, month: str) -> pl.Path:
+    return state_dir / (month.replace("/", "-") + ".json")
+
+
+def _load_json(path: pl.Path, default):
+    if not path.exists():
+        return default
+    with path.open(mode='rb') as fobj:
+        return json.load(fobj)
+
+
+def _write_json(path: pl.Path, obj) -> None:
+    tmp_path = path.parent / (path.name + ".tmp")
+    with tmp_path.open(mode='wb') as fobj:
+        fobj.write(json.dumps(obj, sort_keys=True).encode("utf-8"))
+    tmp_path.rename(path)
+
+
+def mark_dirty(state_dir: pl.Path, months: typ.Iterable[str]) -> None:
+    months = sorted(set(months))
+    if not months:
+        return
+
+    state_dir.mkdir(parents=True, exist_ok=True)
+    with (state_dir / DIRTY_MONTHS_NAME).open(mode='ab') as fobj:
+        for month in months:
+            fobj.write(month.encode("utf-8") + b"\n")
+
+
+def update_counts(state_dir: pl.Path, messages: dict[int, dict]) -> set[str]:
+    """Record the counts of (changed) messages, returns the months they are in.
+
+    The months are marked dirty first, so a crash in between at worst
+    ranks a month again that didn't change.
+    """
+    by_month = {}
+    for msg_id, message in messages.items():
+        name = message.get('name')
+        if name:
+            month = name[0:4] + "/" + name[5:7]
+            by_month.setdefault(month, {})[str(msg_id)] = [
+                name, *(message.get(MESSAGE_FIELDS[metric]) or 0 for metric in RANKING_METRICS),
+            ]
+
+    mark_dirty(state_dir, by_month)
+    for month, month_counts in sorted(by_month.items()):
+        state_path = _month_state_path(state_dir, month)
+        state = _load_json(state_path, {})
+        state.update(month_counts)
+        _write_json(state_path, state)
+
+    return set(by_month)
+
+
+def _ranked(entries: list[dict], metric: str, limit: int | None = None) -> list[dict]:
+    ranked = sorted(
+        (entry for entry in entries if entry[metric] > 0),
+        key=lambda entry: (entry[metric], entry['name']),
+        reverse=True,
+    )
+    return ranked[:limit]
+
+
+def _write_ranking(path: pl.Path, entries: list[dict]) -> bool:
+    """Write (or remove, if there are no entries) a ranking, returns whether it changed."""
+    if not entries:
+        if path.exists():
+            path.unlink()
+            return True
+        return False
+
+    data = json.dumps(entries, sort_keys=True).replace("}, {", "},\n{").encode("utf-8")
+    if path.exists() and path.read_bytes() == data:
+        return False
+
+    tmp_path = path.parent / (path.name + ".tmp")
+    with tmp_path.open(mode='wb') as fobj:
+        fobj.write(data)
+    tmp_path.rename(path)
+    return True
+
+
+def _month_entries(state_dir: pl.Path, month: str, month_entries: list[dict]) -> list[dict]:
+    counts = {}
+    for name, *metric_counts in _load_json(_month_state_path(state_dir, month), {}).values():
+        name_counts = counts.setdefault(name, [0] * len(RANKING_METRICS))
+        for i, count in enumerate(metric_counts):
+            name_counts[i] += count
+
+    return [
+        {'dir': month, **entry, **dict(zip(RANKING_METRICS, counts[entry['name']]))}
+        for entry in month_entries
+        if entry['name'] in counts
+    ]
+
+
+def update_rankings(
+    state_dir: pl.Path, img_dir: pl.Path, load_entries: typ.Callable[[str], list[dict]],
+) -> list[pl.Path]:
+    """Rank the dirty months again, then their years and all-time.
+
+    load_entries returns the entry_index.json entries of a "YYYY/MM"
+    month. Returns the paths of the rankings that were written or removed.
+    """
+    dirty_path = state_dir / DIRTY_MONTHS_NAME
+    if not dirty_path.exists():
+        return []
+
+    with dirty_path.open(mode='rb') as fobj:
+        months = sorted(set(fobj.read().decode("utf-8").split()))
+
+    changed_paths = []
+    for month in months:
+        entries = _month_entries(state_dir, month, load_entries(month))
+        for metric in RANKING_METRICS:
+            path = ranking_path(img_dir, month, metric)
+            if _write_ranking(path, _ranked(entries, metric)):
+                changed_paths.append(path)
+
+    # the top N of a year are among the top N of its months,
+    # the top N of all time among those of the years
+    years = sorted({month[0:4] for month in months})
+    for metric in RANKING_METRICS:
+        for year in years:
+            entries = []
+            for month_path in sorted(img_dir.glob(f"{RANKING_PREFIX}_{year}-??_{metric}.json")):
+                entries.extend(_load_json(month_path, [])[:RANKING_TOP_N])
+            path = ranking_path(img_dir, year, metric)
+            if _write_ranking(path, _ranked(entries, metric, RANKING_TOP_N)):
+                changed_paths.append(path)
+
+        if years:
+            entries = []
+            for year_path in sorted(img_dir.glob(f"{RANKING_PREFIX}_[0-9][0-9][0-9][0-9]_{metric}.json")):
+                entries.extend(_load_json(year_path, []))
+            path = ranking_path(img_dir, "all", metric)
+            if _write_ranking(path, _ranked(entries, metric, RANKING_TOP_N)):
+                changed_paths.append(path)
+
+    dirty_path.unlink()
+    return changed_paths
+
+
+def test_update_rankings(tmp_path: pl.Path) -> None:
+    state_dir = tmp_path / "state"
+    img_dir = tmp_path / "images"
+    img_dir.mkdir()
+
+    def entry(name: str) -> dict:
+        return {'name': name, 'w': 100, 'h': 100, 'x': 0, 'y': 0, 's': "thumbnails_000_x"}
+
+    month_entries = {
+        "2025/01": [entry("2025-01-01T000000_1_a.jpg"), entry("2025-01-02T000000_2_b.jpg")],
+        "2025/02": [entry("2025-02-01T000000_3_c.jpg")],
+    }
+    messages = {
+        1: {'name': "2025-01-01T000000_1_a.jpg", 'trct': 5, 'tfwd': 1},
+        2: {'name': "2025-01-02T000000_2_b.jpg", 'trct': 3, 'tfwd': 0},
+        3: {'name': "2025-02-01T000000_3_c.jpg", 'trct': 4, 'tfwd': 2},
+        # a repost of the first image
+        4: {'name': "2025-01-01T000000_1_a.jpg", 'trct': 1, 'tfwd': 1},
+    }
+    assert update_counts(state_dir, messages) == {"2025/01", "2025/02"}
+    changed_paths = update_rankings(state_dir, img_dir, month_entries.get)
+    assert len(changed_paths) == 2 * 3 + 2
+
+    def names(scope: str, metric: str) -> list[str]:
+        return [entry['name'][-5] for entry in _load_json(ranking_path(img_dir, scope, metric), [])]
+
+    assert names("2025/01", "rct") == ["a", "b"]
+    assert names("2025/01", "fwd") == ["a"]
+    assert names("all", "rct") == ["a", "c", "b"]
+    assert _load_json(ranking_path(img_dir, "all", "rct"), [])[0]['rct'] == 6
+
+    # only the changed month is ranked again, the counts are absolute
+    update_counts(state_dir, {2: {**messages[2], 'trct': 9}})
+    changed_paths = update_rankings(state_dir, img_dir, month_entries.get)
+    assert ranking_path(img_dir, "2025/02", "rct") not in changed_paths
+    assert names("2025", "rct") == ["b", "a", "c"]
+    assert update_rankings(state_dir, img_dir, month_entries.get) == []
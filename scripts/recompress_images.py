@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Recompress the JPEGs of an archive repo with a lower quality setting.
+
+Images are re-encoded in-process by a pool of workers. A re-encoded
+image is only kept if it saves at least --min-saved-kb, in which case it
+replaces the original atomically (.tmp + rename). All kept files are
+staged with a single git call.
+
+Files that were already tried (same size and mtime, same quality) are
+recorded in .cache/recompress_tried.json and skipped on later runs.
+
+Before anything is written, the savings are estimated by re-encoding
+a sample of the images in memory.
+
+Usage:
+
+    ./scripts/recompress_images.py [options] <YYYY/MM> [<YYYY/MM>]
+
+Options:
+
+    --quality=75        JPEG quality of the re-encoded images
+    --min-saved-kb=20   minimum savings for an image to be replaced
+    --workers=N         number of worker processes (default: one per cpu)
+    --sample=50         number of images for the estimate (0: all)
+    --dry-run           only print the estimate
+    --no-git            don't stage the replaced files
+"""
+
+import io
+import os
+import re
+import sys
+import json
+import pathlib as pl
+import subprocess as sp
+import concurrent.futures as cf
+from PIL import Image
+
+CACHE_DIR_NAME = ".cache"
+
+DEFAULT_OPTIONS = {
+    'quality'     : 75,
+    'min-saved-kb': 20,
+    'workers'     : 0,
+    'sample'      : 50,
+}
+
+
+def _reencode(img_path: pl.Path, quality: int) -> bytes:
+    with Image.open(img_path) as img:
+        save_kwargs = {'quality': quality, 'optimize': True}
+        if img.info.get('icc_profile'):
+            save_kwargs['icc_profile'] = img.info['icc_profile']
+        if img.info.get('exif'):
+            save_kwargs['exif'] = img.info['exif']
+        if img.info.get('progressive'):
+            save_kwargs['progressive'] = True
+
+        if img.mode not in ("RGB", "L", "CMYK"):
+            img = img.convert("RGB")
+
+        out = io.BytesIO()
+        img.save(out, "JPEG", **save_kwargs)
+        return out.getvalue()
+
+
+def estimate_savings(img_path: pl.Path, quality: int) -> tuple[int, int]:
+    """Return the (old, new) size of an image, without writing anything."""
+    return (img_path.stat().st_size, len(_reencode(img_path, quality)))
+
+
+def recompress(img_path: pl.Path, quality: int, min_saved_bytes: int) -> tuple[int, int, bool]:
+    """Replace an image with a recompressed version if it saves enough bytes.
+
+    Returns the old size, the new size and whether the file was replaced.
+    """
+    old_size = img_path.stat().st_size
+    new_data = _reencode(img_path, quality)
+    new_size = len(new_data)
+
+    if old_size - new_size < min_saved_bytes:
+        return (old_size, new_size, False)
+
+    tmp_path = img_path.parent / (img_path.name + ".tmp")
+    with tmp_path.open(mode='wb') as fobj:
+        fobj.write(new_data)
+    tmp_path.rename(img_path)
+    return (old_size, new_size, True)
+
+
+def _month_dirs(img_dir: pl.Path, first_month: str, last_month: str) -> list[pl.Path]:
+    month_dirs = []
+    for month_dir in sorted(img_dir.glob("*/*")):
+        yyyy_mm = month_dir.relative_to(img_dir).as_posix()
+        if month_dir.is_dir() and first_month <= yyyy_mm <= last_month:
+            month_dirs.append(month_dir)
+    return month_dirs
+
+
+def _tried_cache_path(repo_dir: pl.Path) -> pl.Path:
+    return repo_dir / CACHE_DIR_NAME / "recompress_tried.json"
+
+
+def _load_tried(repo_dir: pl.Path) -> dict[str, dict]:
+    cache_path = _tried_cache_path(repo_dir)
+    if not cache_path.exists():
+        return {}
+
+    with cache_path.open(mode='rb') as fobj:
+        return json.load(fobj)
+
+
+def _dump_tried(repo_dir: pl.Path, tried: dict[str, dict]) -> None:
+    cache_path = _tried_cache_path(repo_dir)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_path = cache_path.parent / (cache_path.name + ".tmp")
+    with tmp_path.open(mode='wb') as fobj:
+        fobj.write(json.dumps(tried, sort_keys=True, indent=0).encode("utf-8"))
+    tmp_path.rename(cache_path)
+
+
+def _tried_record(img_path: pl.Path, quality: int) -> dict:
+    stat = img_path.stat()
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'quality': quality}
+
+
+def git_add(repo_dir: pl.Path, paths: list[pl.Path]) -> None:
+    """Stage many paths with a single git call."""
+    if not paths:
+        return
+
+    pathspecs = b"".join(str(path.relative_to(repo_dir)).encode("utf-8") + b"\0" for path in paths)
+    sp.run(
+        ["git", "add", "--pathspec-from-file=-", "--pathspec-file-nul"],
+        input=pathspecs,
+        cwd=repo_dir,
+        check=True,
+    )
+
+
+def _parse_options(args: list[str]) -> tuple[dict, list[str]]:
+    options = dict(DEFAULT_OPTIONS)
+    positional = []
+    for arg in args:
+        match = re.match(r"--([\w-]+)(?:=(.*))?$", arg)
+        if match is None:
+            positional.append(arg)
+        elif match.group(2) is None:
+            options[match.group(1)] = True
+        else:
+            options[match.group(1)] = int(match.group(2))
+    return (options, positional)
+
+
+def main(args: list[str]) -> int:
+    options, months = _parse_options(args)
+    if "help" in options or not 1 <= len(months) <= 2:
+        print(__doc__)
+        return 0
+
+    first_month = months[0]
+    last_month = months[-1]
+    quality = options['quality']
+    min_saved_bytes = options['min-saved-kb'] * 1024
+    workers = options['workers'] or os.cpu_count() or 1
+
+    repo_dir = pl.Path(".").absolute()
+    tried = _load_tried(repo_dir)
+
+    img_paths = []
+    for month_dir in _month_dirs(repo_dir / "images", first_month, last_month):
+        for img_path in sorted(month_dir.glob("*.jpg")):
+            if img_path.name.startswith("thumbnails"):
+                continue
+            relpath = img_path.relative_to(repo_dir).as_posix()
+            if tried.get(relpath) == _tried_record(img_path, quality):
+                continue
+            img_paths.append(img_path)
+
+    print(f"{len(img_paths)} images to recompress in {first_month} - {last_month}")
+    if not img_paths:
+        return 0
+
+    with cf.ProcessPoolExecutor(max_workers=workers) as executor:
+        sample_size = options['sample'] or len(img_paths)
+        step = max(1, len(img_paths) // sample_size)
+        sample_paths = img_paths[::step][:sample_size]
+
+        sizes = list(executor.map(estimate_savings, sample_paths, [quality] * len(sample_paths)))
+        sample_saved = sum(old - new for old, new in sizes if old - new >= min_saved_bytes)
+        sample_size_kb = sum(old for old, new in sizes) / 1024
+        est_saved_kb = sample_saved / 1024 * len(img_paths) / len(sample_paths)
+        print(
+            f"estimate : {est_saved_kb / 1024:>9.3f} mb saved"
+            f" (sample of {len(sample_paths)} images, {sample_size_kb / 1024:.3f} mb)"
+        )
+        if options.get('dry-run'):
+            return 0
+
+        futures = {
+            executor.submit(recompress, img_path, quality, min_saved_bytes): img_path
+            for img_path in img_paths
+        }
+
+        kept_paths = []
+        total_saved = 0
+        for future in cf.as_completed(futures):
+            img_path = futures[future]
+            relpath = img_path.relative_to(repo_dir).as_posix()
+            try:
+                old_size, new_size, is_replaced = future.result()
+            except Exception as e:
+                print(f"Error processing {img_path}: {e}")
+                continue
+
+            tried[relpath] = _tried_record(img_path, quality)
+            if is_replaced:
+                kb_saved = (old_size - new_size) / 1024
+                total_saved += old_size - new_size
+                kept_paths.append(img_path)
+                print(f"updated  : {str(img_path):<100} {kb_saved:>9.3f} kb saved")
+
+    _dump_tried(repo_dir, tried)
+
+    print(f"total    : {total_saved / 1024 / 1024:>9.3f} mb saved in {len(kept_paths)} images")
+    if not options.get('no-git'):
+        git_add(repo_dir, sorted(kept_paths))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,558 @@
+#!/usr/bin/env python3
+"""
+Replay a sync of panzer_imgsync.py offline, against temporary repos.
+
+A temporary www repo and archive repos (each with a bare remote, so
+git push works) are set up with an already synced state. Then
+panzer_imgsync.main() runs against them, with fake_telegram.FakeClient
+serving the messages that are new since that state.
+
+The messages are either synthetic (new photos, re-posts of archived
+photos and reaction updates), or replayed from a message log, with the
+photos taken from archive checkouts.
+
+For each stage of the pipeline, the wall time and the bytes read and
+written (including subprocesses, from /proc/self/io) are reported.
+Nested stages are included in the times of their parents, "self" is
+the time spent in a stage outside of its nested stages.
+
+Usage:
+
+    ./scripts/replay_sync.py [options]
+
+Options:
+
+    --new=50            number of new messages
+    --reposts=10        number of re-posts of archived photos (synthetic only)
+    --archived=100      number of archived photos per month (synthetic only)
+    --messages=PATH     replay a message log (telegram_messages.jsonl)
+    --images=DIR,...    archive checkouts with the photos of --messages
+    --delay=0.0         seconds per simulated photo download
+    --crash-after=N     drop the connection during download N+1, then
+                        run the sync again (it resumes from its journal),
+                        with --daemon the daemon retries the failed sync
+    --daemon            post the new messages to panzer_imgsync.run_daemon
+                        one at a time, instead of running main()
+    --post-interval=0.1 seconds between the posts (--daemon)
+    --debounce=0.5      debounce of the daemon in seconds (--daemon)
+    --seed=1            seed of the synthetic messages
+    --out=PATH          write the report as json to PATH
+    --keep=DIR          set up the repos in DIR and keep them
+"""
+
+import io
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import inspect
+import random
+import shutil
+import tempfile
+import contextlib
+import functools
+import subprocess as sp
+import pathlib as pl
+import datetime as dt
+
+# panzer_imgsync only needs these to talk to Telegram
+os.environ.setdefault('PANZER_IMGSYNC_API_ID', "0")
+os.environ.setdefault('PANZER_IMGSYNC_API_HASH', "replay")
+
+for _var in ('GIT_AUTHOR_NAME', 'GIT_COMMITTER_NAME'):
+    os.environ.setdefault(_var, "panzer replay")
+for _var in ('GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_EMAIL'):
+    os.environ.setdefault(_var, "replay@localhost")
+
+import bench_ingest
+import fake_telegram
+import gen_html
+import ingest_uploads
+import panzer_imgsync
+
+ROOT_DIR = pl.Path(__file__).parent.parent
+
+DEFAULT_OPTIONS = {
+    'new'     : 50,
+    'reposts' : 10,
+    'archived': 100,
+    'seed'    : 1,
+}
+
+# (module, function name, stage name) of the functions that are timed
+STAGE_FUNCS = [
+    (panzer_imgsync, 'main'                , "total"),
+    (panzer_imgsync, 'run_daemon'          , "total"),
+    (panzer_imgsync, 'load_last_messages'  , "load_messages"),
+    (panzer_imgsync, 'fetch_api_messages'  , "fetch"),
+    (panzer_imgsync, 'load_digest_index'   , "dedupe"),
+    (panzer_imgsync, 'update_digest_index' , "dedupe"),
+    (panzer_imgsync, 'find_duplicate'      , "dedupe"),
+    (panzer_imgsync, 'dump_messages'       , "dump_messages"),
+    (panzer_imgsync, '_sync_month'         , "copy"),
+    (panzer_imgsync, '_commit_archive'     , "commit_archive"),
+    (ingest_uploads, 'ingest'              , "ingest"),
+    (panzer_imgsync, 'update_rankings'     , "rankings"),
+    (panzer_imgsync, '_update_dir_index'   , "dir_index"),
+    (panzer_imgsync, '_commit_www'         , "commit_www"),
+    (panzer_imgsync, '_wait_pushes'        , "push"),
+]
+
+
+def _io_counters() -> tuple[int, int]:
+    """Bytes read and written by this process and its reaped children."""
+    try:
+        with open("/proc/self/io", mode='rb') as fobj:
+            counters = dict(line.split(b":") for line in fobj.read().splitlines())
+    except OSError:
+        return (0, 0)
+    return (int(counters[b'rchar']), int(counters[b'wchar']))
+
+
+class StageTimer:
+
+    def __init__(self):
+        self.stages = {}
+        self._stack = []
+
+    def _enter(self, name: str) -> tuple:
+        self._stack.append([name, 0.0])
+        return (time.perf_counter(), *_io_counters())
+
+    def _exit(self, name: str, started: tuple) -> None:
+        t0, read0, written0 = started
+        read1, written1 = _io_counters()
+        wall = time.perf_counter() - t0
+
+        _, nested_wall = self._stack.pop()
+        if self._stack:
+            self._stack[-1][1] += wall
+
+        stage = self.stages.setdefault(name, {
+            'calls': 0, 'wall': 0.0, 'self': 0.0, 'bytes_read': 0, 'bytes_written': 0,
+        })
+        stage['calls'] += 1
+        stage['wall'] += wall
+        stage['self'] += wall - nested_wall
+        stage['bytes_read'] += read1 - read0
+        stage['bytes_written'] += written1 - written0
+
+    def _is_active(self, name: str) -> bool:
+        return any(stack_name == name for stack_name, _ in self._stack)
+
+    def wrap(self, func, name: str):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if self._is_active(name):
+                    return await func(*args, **kwargs)
+                started = self._enter(name)
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self._exit(name, started)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if self._is_active(name):
+                return func(*args, **kwargs)
+            started = self._enter(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._exit(name, started)
+
+        return wrapper
+
+    def install(self) -> None:
+        self._originals = [(module, func_name, getattr(module, func_name)) for module, func_name, _ in STAGE_FUNCS]
+        for module, func_name, stage_name in STAGE_FUNCS:
+            setattr(module, func_name, self.wrap(getattr(module, func_name), stage_name))
+
+    def uninstall(self) -> None:
+        for module, func_name, func in self._originals:
+            setattr(module, func_name, func)
+
+
+def _git(repo_dir: pl.Path, *args: str) -> None:
+    sp.run(["git", *args], cwd=repo_dir, check=True, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+
+
+def _init_repo(repo_dir: pl.Path, paths: list[str]) -> None:
+    """Commit the paths of a repo and push them to a bare remote next to it."""
+    remote_dir = repo_dir.parent / "remotes" / (repo_dir.name + ".git")
+    remote_dir.mkdir(parents=True)
+    _git(remote_dir, "init", "--quiet", "--bare")
+
+    _git(repo_dir, "init", "--quiet")
+    _git(repo_dir, "add", *paths)
+    _git(repo_dir, "commit", "--quiet", "-m", "initial state")
+    _git(repo_dir, "remote", "add", "origin", str(remote_dir))
+    _git(repo_dir, "push", "--quiet", "-u", "origin", "HEAD")
+
+
+def _name_date(fname: str) -> dt.datetime:
+    date = dt.datetime.strptime(fname[:17].replace("-", "")[:15], "%Y%m%dT%H%M%S")
+    return date.replace(tzinfo=dt.timezone.utc)
+
+
+def _archive_img_path(replay_dir: pl.Path, fname: str) -> pl.Path:
+    datestr = fname.replace("-", "")
+    repo_name = panzer_imgsync.IMG_REPOS[datestr[0:4]]
+    return replay_dir / repo_name / "images" / datestr[0:4] / datestr[4:6] / fname
+
+
+def _read_photo(img_path: pl.Path) -> bytes:
+    with img_path.open(mode='rb') as fobj:
+        return fobj.read()
+
+
+def synthetic_scenario(replay_dir: pl.Path, options: dict) -> tuple[dict[int, dict], list]:
+    """Archive the photos of the last two months and create messages
+    for them (with changed reactions), re-posts and new photos.
+
+    Returns the synced messages and the messages of the channel.
+    """
+    staging_dir = replay_dir / "staging"
+    archived_paths = bench_ingest.mk_synthetic_archive(staging_dir, 2, options['archived'], options['seed'])
+
+    old_messages = {}
+    channel_messages = []
+    for img_path in archived_paths:
+        msg_id = int(img_path.name.split("_")[1])
+        digest = img_path.stem.split("_")[2]
+        tgt_path = _archive_img_path(replay_dir, img_path.name)
+        tgt_path.parent.mkdir(parents=True, exist_ok=True)
+        img_path.rename(tgt_path)
+
+        old_messages[msg_id] = {'name': img_path.name, 'tfwd': msg_id % 5, 'trct': msg_id % 11, 'dig': digest}
+        channel_messages.append(fake_telegram.mk_message(
+            msg_id, _name_date(img_path.name), _read_photo(tgt_path),
+            forwards=msg_id % 5 + 1, reactions=msg_id % 11 + 1,
+        ))
+    shutil.rmtree(staging_dir)
+
+    # not the seed of the archive, which would generate the same photos again
+    rng = random.Random(f"replay-{options['seed']}")
+    now = dt.datetime.now(dt.timezone.utc).replace(microsecond=0)
+    next_id = max(old_messages) + 1
+
+    # re-posts of recent archived photos, within the duplicate window
+    recent_msgs = [msg for msg in channel_messages if msg.date > now - dt.timedelta(days=panzer_imgsync.DUP_WINDOW_DAYS - 1)]
+    for msg in rng.sample(recent_msgs, min(options['reposts'], len(recent_msgs))):
+        repost_date = min(now, msg.date + dt.timedelta(hours=12))
+        channel_messages.append(fake_telegram.mk_message(next_id, repost_date, msg.photo, forwards=1))
+        next_id += 1
+
+    sizes = [(w, h) for w, h, weight in bench_ingest.IMG_SIZES for _ in range(weight)]
+    for i in range(options['new']):
+        photo = bench_ingest.mk_synthetic_img(rng, *rng.choice(sizes))
+        date = now - dt.timedelta(minutes=10 * (options['new'] - i))
+        channel_messages.append(fake_telegram.mk_message(next_id, date, photo, forwards=i % 3, reactions=i % 9))
+        next_id += 1
+
+    channel_messages.sort(key=lambda msg: msg.id)
+    return (old_messages, channel_messages)
+
+
+def _load_message_log(log_path: pl.Path) -> dict[int, dict]:
+    with log_path.open(mode='rb') as fobj:
+        data = fobj.read()
+
+    if log_path.suffix == ".jsonl":
+        messages = {}
+        for line in data.splitlines():
+            if line.strip():
+                record = json.loads(line)
+                messages[record.pop('id')] = record
+        return messages
+
+    return {int(key): val for key, val in json.loads(data).items()}
+
+
+def _find_photo(img_dirs: list[pl.Path], fname: str) -> pl.Path | None:
+    datestr = fname.replace("-", "")
+    for img_dir in img_dirs:
+        for img_path in (
+            img_dir / "images" / datestr[0:4] / datestr[4:6] / fname,
+            img_dir / datestr[0:4] / datestr[4:6] / fname,
+        ):
+            if img_path.exists():
+                return img_path
+    return None
+
+
+def recorded_scenario(replay_dir: pl.Path, options: dict) -> tuple[dict[int, dict], list]:
+    """The last --new messages of a message log are replayed as new, the
+    photos of earlier messages in the same months are archived."""
+    log_messages = _load_message_log(pl.Path(options['messages']))
+    img_dirs = [pl.Path(img_dir) for img_dir in options.get('images', "..").split(",")]
+
+    msg_photos = {}
+    for msg_id, message in sorted(log_messages.items()):
+        if message.get('name'):
+            img_path = _find_photo(img_dirs, message['name'])
+            if img_path:
+                msg_photos[msg_id] = img_path
+    print(f"found photos of {len(msg_photos)} of {len(log_messages)} messages", file=sys.stderr)
+
+    new_ids = sorted(msg_photos)[-options['new']:]
+    new_months = {log_messages[msg_id]['name'].replace("-", "")[:6] for msg_id in new_ids}
+    old_messages = {msg_id: message for msg_id, message in log_messages.items() if msg_id < new_ids[0]}
+
+    channel_messages = []
+    for msg_id, img_path in msg_photos.items():
+        message = log_messages[msg_id]
+        if msg_id < new_ids[0]:
+            if message['name'].replace("-", "")[:6] not in new_months:
+                continue
+            tgt_path = _archive_img_path(replay_dir, message['name'])
+            tgt_path.parent.mkdir(parents=True, exist_ok=True)
+            if not tgt_path.exists():
+                panzer_imgsync._link_or_copy(img_path, tgt_path)
+
+        channel_messages.append(fake_telegram.mk_message(
+            msg_id, _name_date(message['name']), _read_photo(img_path),
+            forwards=message.get('tfwd', 0), reactions=message.get('trct', 0),
+        ))
+
+    return (old_messages, channel_messages)
+
+
+def setup_repos(replay_dir: pl.Path, old_messages: dict[int, dict]) -> pl.Path:
+    """Ingest and commit the archive repos and create the www repo."""
+    archive_repos = sorted(path for path in replay_dir.glob("panzer-archiv-*") if path.is_dir())
+    with contextlib.redirect_stdout(io.StringIO()):
+        ingest_uploads.ingest(archive_repos)
+
+    dir_index = {}
+    for archive_repo in archive_repos:
+        _init_repo(archive_repo, ["images"])
+        with (archive_repo / "images" / "dir_index.json").open() as fobj:
+            dir_index.update(json.load(fobj))
+
+    www_dir = replay_dir / "panzer-www"
+    (www_dir / "images").mkdir(parents=True)
+    (www_dir / "scripts").mkdir()
+    with (www_dir / "images" / "dir_index.json").open(mode="w") as fobj:
+        json.dump(dir_index, fobj, sort_keys=True, indent=2)
+    ingest_uploads.write_gallery_manifest(www_dir / "images", dir_index)
+
+    _point_imgsync_at(www_dir)
+    panzer_imgsync.compact_messages_log(old_messages)
+
+    # the digests of the archive, as the previous syncs left them
+    digest_index = panzer_imgsync.DigestIndex()
+    for archive_repo in archive_repos:
+        for img_path in sorted((archive_repo / "images").glob("*/*/*.jpg")):
+            if not ingest_uploads.is_sprite_name(img_path.name):
+                panzer_imgsync.append_digest_index(digest_index, img_path.name, img_path.stem.rsplit("_", 1)[-1])
+
+    # the page, as the sync renders it again
+    shutil.copytree(ROOT_DIR / "templates", www_dir / "templates")
+    shutil.copytree(ROOT_DIR / "assets", www_dir / "assets", ignore=shutil.ignore_patterns("*.gz", "*.br"))
+    shutil.copyfile(ROOT_DIR / "index.html", www_dir / "index.html")
+
+    (www_dir / ".gitignore").write_text("/.cache/\n")
+    _init_repo(www_dir, [".gitignore", "images", "scripts", "templates", "assets", "index.html"])
+    return www_dir
+
+
+def _point_imgsync_at(www_dir: pl.Path) -> None:
+    panzer_imgsync.ROOT_DIR = www_dir
+    panzer_imgsync.IMAGES_DIR = www_dir / "images"
+    panzer_imgsync.MESSAGES_CACHE_PATH = www_dir / "scripts" / "telegram_messages_cache.json"
+    panzer_imgsync.MESSAGES_LOG_PATH = www_dir / "scripts" / "telegram_messages.jsonl"
+    panzer_imgsync.CACHE_DIR = www_dir / ".cache"
+    panzer_imgsync.DIGEST_INDEX_PATH = www_dir / ".cache" / "digest_index.jsonl"
+    panzer_imgsync.SYNC_JOURNAL_PATH = www_dir / ".cache" / "sync_journal.jsonl"
+    panzer_imgsync.DOWNLOADS_DIR = www_dir / ".cache" / "downloads"
+    panzer_imgsync.UPLOAD_STAGING_DIR = www_dir / ".cache" / "uploads"
+    panzer_imgsync.UPLOAD_DIR = www_dir / "upload"
+    panzer_imgsync.RANKINGS_STATE_DIR = www_dir / ".cache" / "rankings"
+    ingest_uploads.DECODE_CACHE_DIR = www_dir / ".cache" / "decoded"
+    gen_html.ROOT_DIR = www_dir
+    gen_html.TEMPLATES_DIR = www_dir / "templates"
+    gen_html.ASSETS_DIR = www_dir / "assets"
+    gen_html.IMAGES_DIR = www_dir / "images"
+
+
+def replay(replay_dir: pl.Path, options: dict) -> dict:
+    t0 = time.perf_counter()
+    if 'messages' in options:
+        old_messages, channel_messages = recorded_scenario(replay_dir, options)
+    else:
+        old_messages, channel_messages = synthetic_scenario(replay_dir, options)
+    www_dir = setup_repos(replay_dir, old_messages)
+    print(f"set up {replay_dir} in {time.perf_counter() - t0:.1f} s", file=sys.stderr)
+
+    download_delay = float(options.get('delay', 0.0))
+    num_syncs = None
+    timer = StageTimer()
+    timer.install()
+    try:
+        with panzer_imgsync.change_dir(www_dir):
+            if options.get('daemon'):
+                client, num_syncs = _replay_daemon(old_messages, channel_messages, download_delay, options)
+            else:
+                client = fake_telegram.FakeClient(
+                    channel_messages, download_delay=download_delay, fail_after=int(options['crash-after']) if 'crash-after' in options else None,
+                )
+                panzer_imgsync._CLIENT = client
+                if client.fail_after is not None:
+                    try:
+                        panzer_imgsync.main([])
+                    except ConnectionError as ex:
+                        print(f"sync crashed after {client.downloads} downloads: {ex}", file=sys.stderr)
+                    client.fail_after = None
+                panzer_imgsync.main([])
+    finally:
+        timer.uninstall()
+
+    new_messages = panzer_imgsync.load_last_messages()
+    new_names = {message['name'] for message in new_messages.values() if message.get('name')}
+    old_names = {message['name'] for message in old_messages.values() if message.get('name')}
+
+    return {
+        'meta': {
+            'date'             : dt.datetime.now().isoformat(timespec='seconds'),
+            'options'          : options,
+            'channel_messages' : len(channel_messages),
+            'synced_messages'  : len(old_messages),
+        },
+        'counts': {
+            'downloads'        : client.downloads,
+            'bytes_downloaded' : client.bytes_downloaded,
+            'new_images'       : len(new_names - old_names),
+            'syncs'            : num_syncs,
+            'messages'         : len(new_messages),
+        },
+        'stages': {
+            name: {key: round(val, 6) if isinstance(val, float) else val for key, val in stage.items()}
+            for name, stage in timer.stages.items()
+        },
+    }
+
+
+def _replay_daemon(
+    old_messages: dict[int, dict], channel_messages: list, download_delay: float, options: dict,
+) -> tuple:
+    """Post the messages that are new since old_messages to the daemon."""
+    last_synced_id = max(old_messages, default=0)
+    client = fake_telegram.FakeClient(
+        [msg for msg in channel_messages if msg.id <= last_synced_id],
+        download_delay=download_delay,
+        fail_after=int(options['crash-after']) if 'crash-after' in options else None,
+    )
+    events = client.subscribe()
+    post_interval = float(options.get('post-interval', 0.1))
+    debounce = float(options.get('debounce', 0.5))
+
+    async def post_messages():
+        for msg in channel_messages:
+            if msg.id > last_synced_id:
+                await asyncio.sleep(post_interval)
+                client.post(msg)
+        # time for the last batch (and a retry of it) before the daemon stops
+        await asyncio.sleep(4 * debounce)
+        events.put_nowait(None)
+
+    async def replay_daemon():
+        num_syncs, _ = await asyncio.gather(
+            panzer_imgsync.run_daemon(
+                client, events, [], debounce=debounce, max_delay=10 * debounce, retry_delay=debounce,
+            ),
+            post_messages(),
+        )
+        return num_syncs
+
+    return (client, client.loop.run_until_complete(replay_daemon()))
+
+
+def _print_report(report: dict) -> None:
+    print(f"{'stage':<16} {'calls':>6} {'wall s':>9} {'self s':>9} {'read kb':>11} {'written kb':>11}", file=sys.stderr)
+    for name, stage in report['stages'].items():
+        print(
+            f"{name:<16} {stage['calls']:>6} {stage['wall']:>9.3f} {stage['self']:>9.3f}"
+            f" {stage['bytes_read'] / 1024:>11.1f} {stage['bytes_written'] / 1024:>11.1f}",
+            file=sys.stderr,
+        )
+    counts = report['counts']
+    print(
+        f"{counts['downloads']} downloads ({counts['bytes_downloaded'] / 1024:.1f} kb),"
+        f" {counts['new_images']} new images"
+        + (f" in {counts['syncs']} syncs" if counts['syncs'] is not None else ""),
+        file=sys.stderr,
+    )
+
+
+def _parse_options(args: list[str]) -> tuple[dict, list[str]]:
+    options = dict(DEFAULT_OPTIONS)
+    positional = []
+    for arg in args:
+        match = re.match(r"--([\w-]+)(?:=(.*))?$", arg)
+        if match is None:
+            positional.append(arg)
+        elif match.group(2) is None:
+            options[match.group(1)] = True
+        elif match.group(1) in DEFAULT_OPTIONS:
+            options[match.group(1)] = int(match.group(2))
+        else:
+            options[match.group(1)] = match.group(2)
+    return (options, positional)
+
+
+def main(args: list[str]) -> int:
+    options, positional = _parse_options(args)
+    if "help" in options or positional:
+        print(__doc__)
+        return 0
+
+    with contextlib.ExitStack() as stack:
+        if 'keep' in options:
+            replay_dir = pl.Path(options['keep']).absolute()
+            shutil.rmtree(replay_dir, ignore_errors=True)
+            replay_dir.mkdir(parents=True)
+        else:
+            replay_dir = pl.Path(stack.enter_context(tempfile.TemporaryDirectory(prefix="panzer_replay_")))
+
+        report = replay(replay_dir, options)
+
+    _print_report(report)
+    if 'out' in options:
+        with pl.Path(options['out']).open(mode='w') as fobj:
+            fobj.write(json.dumps(report, indent=2) + "\n")
+
+    return 0
+
+
+
+def test_daemon_startup_sync(tmp_path: pl.Path, monkeypatch) -> None:
+    # _point_imgsync_at repoints these, they are restored after the test
+    for module in (panzer_imgsync, ingest_uploads, gen_html):
+        for name, value in list(vars(module).items()):
+            if name.isupper() and isinstance(value, pl.Path):
+                monkeypatch.setattr(module, name, value)
+    monkeypatch.setattr(panzer_imgsync.panzer_metrics, 'METRICS_LOG_PATH', tmp_path / "metrics.jsonl")
+
+    options = {**DEFAULT_OPTIONS, 'new': 3, 'reposts': 1, 'archived': 5}
+    old_messages, channel_messages = synthetic_scenario(tmp_path, options)
+    www_dir = setup_repos(tmp_path, old_messages)
+
+    # everything was posted while the daemon was down, no events are queued
+    client = fake_telegram.FakeClient(channel_messages)
+    events = client.subscribe()
+    events.put_nowait(None)
+    with panzer_imgsync.change_dir(www_dir), contextlib.redirect_stdout(io.StringIO()):
+        num_syncs = client.loop.run_until_complete(panzer_imgsync.run_daemon(client, events, []))
+
+    assert num_syncs == 1
+    assert set(panzer_imgsync.load_last_messages()) == {msg.id for msg in channel_messages}
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
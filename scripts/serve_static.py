@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+"""
+Static file server for the site and the archive domains.
+
+Replaces `python -m http.server` for local development and can be the
+origin behind the CDN of derrosarotepanzer.com and of the archivN
+domains (IMG_HOSTS in scripts/gen_html.py).
+
+ - All connections are handled by one asyncio loop (per worker), with
+   HTTP/1.1 keep-alive and pipelining.
+ - File bodies are sent with sendfile(2), without being copied through
+   python, small files are sent with the response head in one write.
+ - Conditional requests (If-None-Match, If-Modified-Since) get a 304,
+   single byte ranges (Range, If-Range) a 206.
+ - Content-hashed assets and sprites are marked as immutable.
+ - The .br/.gz siblings written by scripts/gen_html.py are served if the
+   client accepts them and they are not older than the file.
+
+Requests are routed by their Host header: archivN.<any domain> is served
+from ../panzer-archiv-0N (if that repo exists), everything else from
+--root. Browsers resolve *.localhost to the loopback address, so the
+archives can be checked locally with http://archiv0.localhost:8082/.
+Responses of the archives allow cross origin requests, the gallery
+fetches their json indexes from the www domain.
+
+Dotfiles and dot directories (.git, .cache) are never served.
+
+Usage:
+
+    ./scripts/serve_static.py [options]
+
+Options:
+
+    --port=8082         port to listen on
+    --bind=127.0.0.1    address to listen on
+    --root=DIR          directory of the site (default: the www repo)
+    --workers=1         number of processes accepting on the port
+    --vhost=HOST=DIR    serve requests for HOST from DIR, can be repeated
+    --quiet             don't log requests
+
+Load test with scripts/bench_serve.py, or with any load generator:
+
+    wrk -c 64 -d 10 -H 'Accept-Encoding: gzip' http://127.0.0.1:8082/
+"""
+
+import os
+import re
+import sys
+import time
+import socket
+import asyncio
+import mimetypes
+import contextlib
+import email.utils
+import urllib.parse
+import pathlib as pl
+import http as ht
+
+import gen_html
+
+ROOT_DIR = pl.Path(__file__).parent.parent
+
+DEFAULT_PORT = 8082
+DEFAULT_BIND = "127.0.0.1"
+
+KEEPALIVE_TIMEOUT_SECS = 15
+MAX_HEADER_BYTES = 16 * 1024
+LISTEN_BACKLOG = 1024
+
+# a sendfile call costs more than copying a small body
+SENDFILE_MIN_BYTES = 64 * 1024
+
+# archivN.<domain> -> ../panzer-archiv-0N, see IMG_REPOS in panzer_imgsync.py
+ARCHIV_HOST_RE = re.compile(r"^archiv(\d+)\.")
+ARCHIV_REPO_RE = re.compile(r"^panzer-archiv-(\d+)$")
+
+# names that change whenever their content does
+IMMUTABLE_NAME_RES = (
+    gen_html.HASHED_ASSET_RE,                                   # app.3f2a1b9c0d.js
+    re.compile(r"^thumbnails_\d+_[0-9a-f]{10}(@\dx)?\.\w+$"),  # thumbnails_000_3f2a1b9c0d@2x.webp
+)
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# images keep their name when they are recompressed, but don't need to be fresh
+MEDIA_CACHE_CONTROL = "public, max-age=86400"
+MEDIA_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp", ".avif", ".gif", ".mp4"}
+# pages and json indexes are revalidated with their ETag
+DEFAULT_CACHE_CONTROL = "no-cache"
+
+# in order of preference
+CONTENT_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+mimetypes.add_type("image/webp", ".webp")
+mimetypes.add_type("image/avif", ".avif")
+mimetypes.add_type("text/javascript", ".js")
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status: int, headers: dict | None = None):
+        super().__init__(status)
+        self.status = status
+        self.headers = headers or {}
+
+
+def archiv_vhosts(root_dir: pl.Path) -> dict[int, pl.Path]:
+    """The archive repos next to root_dir, by the number of their domain."""
+    vhosts = {}
+    for repo_dir in sorted(root_dir.parent.glob("panzer-archiv-*")):
+        match = ARCHIV_REPO_RE.match(repo_dir.name)
+        if match and repo_dir.is_dir():
+            vhosts[int(match.group(1))] = repo_dir
+    return vhosts
+
+
+def _http_date(timestamp: float) -> str:
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+
+_DATE_CACHE = [0, ""]
+
+
+def _now_date() -> str:
+    now = int(time.time())
+    if _DATE_CACHE[0] != now:
+        _DATE_CACHE[:] = [now, _http_date(now)]
+    return _DATE_CACHE[1]
+
+
+def _accepted_encodings(value: str) -> set[str]:
+    encodings = set()
+    for part in value.split(","):
+        coding, _, params = part.strip().partition(";")
+        if not re.match(r"\s*q=0(\.0*)?\s*$", params):
+            encodings.add(coding.strip().lower())
+    return encodings
+
+
+def _etag_matches(value: str, etag: str) -> bool:
+    if value.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in value.split(","))
+
+
+def _not_modified(headers: dict, etag: str, mtime: int) -> bool:
+    if 'if-none-match' in headers:
+        return _etag_matches(headers['if-none-match'], etag)
+    if 'if-modified-since' in headers:
+        try:
+            since = email.utils.parsedate_to_datetime(headers['if-modified-since'])
+        except (TypeError, ValueError):
+            return False
+        return mtime <= since.timestamp()
+    return False
+
+
+def parse_range(value: str, size: int) -> tuple[int, int] | None:
+    """The (offset, count) of a single byte range, None to send the whole file.
+
+    Multiple ranges and invalid headers are ignored, as RFC 9110 allows.
+    """
+    match = re.match(r"^bytes=(\d*)-(\d*)$", value.strip())
+    if match is None or match.group(1) == match.group(2) == "":
+        return None
+
+    if match.group(1) == "":
+        count = min(int(match.group(2)), size)
+        if count == 0:
+            raise HTTPError(416, {'Content-Range': f"bytes */{size}"})
+        return (size - count, count)
+
+    first = int(match.group(1))
+    if match.group(2) and int(match.group(2)) < first:
+        return None
+    if first >= size:
+        raise HTTPError(416, {'Content-Range': f"bytes */{size}"})
+    last = int(match.group(2)) if match.group(2) else size - 1
+    return (first, min(last, size - 1) - first + 1)
+
+
+def _cache_control(path: pl.Path) -> str:
+    if any(name_re.match(path.name) for name_re in IMMUTABLE_NAME_RES):
+        return IMMUTABLE_CACHE_CONTROL
+    if path.suffix in MEDIA_SUFFIXES:
+        return MEDIA_CACHE_CONTROL
+    return DEFAULT_CACHE_CONTROL
+
+
+def _resolve(root_dir: pl.Path, target: str) -> pl.Path:
+    url_path = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+    parts = [part for part in url_path.split("/") if part]
+    if any(part.startswith(".") or "\0" in part or "\\" in part for part in parts):
+        raise HTTPError(404)
+
+    path = root_dir.joinpath(*parts)
+    if path.is_dir():
+        if not url_path.endswith("/"):
+            raise HTTPError(301, {'Location': urllib.parse.quote(url_path) + "/"})
+        path = path / "index.html"
+    if not path.is_file():
+        raise HTTPError(404)
+    return path
+
+
+def _select_variant(path: pl.Path, headers: dict) -> tuple[pl.Path, os.stat_result, str | None]:
+    stat = path.stat()
+    if path.suffix not in gen_html.COMPRESS_SUFFIXES:
+        return (path, stat, None)
+
+    accepted = _accepted_encodings(headers.get('accept-encoding', ""))
+    for encoding, suffix in CONTENT_ENCODINGS:
+        if encoding not in accepted:
+            continue
+        variant_path = path.parent / (path.name + suffix)
+        try:
+            variant_stat = variant_path.stat()
+        except FileNotFoundError:
+            continue
+        if variant_stat.st_mtime_ns >= stat.st_mtime_ns:
+            return (variant_path, variant_stat, encoding)
+    return (path, stat, None)
+
+
+class Server:
+
+    def __init__(self, root_dir: pl.Path, vhosts: dict, archiv_dirs: dict[int, pl.Path], quiet: bool = False):
+        self.root_dir = root_dir
+        self.vhosts = vhosts
+        self.archiv_dirs = archiv_dirs
+        self.quiet = quiet
+
+    def _site(self, host: str) -> tuple[pl.Path, bool]:
+        """The root dir for a Host header and whether it is an archive."""
+        host = host.rsplit(":", 1)[0].lower()
+        if host in self.vhosts:
+            return (self.vhosts[host], False)
+
+        match = ARCHIV_HOST_RE.match(host)
+        if match and int(match.group(1)) in self.archiv_dirs:
+            return (self.archiv_dirs[int(match.group(1))], True)
+        return (self.root_dir, False)
+
+    def respond(self, method: str, target: str, headers: dict) -> tuple[int, dict, tuple | None]:
+        """Returns the status, the headers and the (path, offset, count) of the body."""
+        if method not in ("GET", "HEAD"):
+            raise HTTPError(405, {'Allow': "GET, HEAD"})
+
+        root_dir, is_archiv = self._site(headers.get('host', ""))
+        path = _resolve(root_dir, target)
+        file_path, stat, encoding = _select_variant(path, headers)
+
+        mtime = int(stat.st_mtime)
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}' + (f'-{encoding}"' if encoding else '"')
+        content_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        if content_type.startswith("text/") or content_type == "application/json":
+            content_type += "; charset=utf-8"
+
+        resp_headers = {
+            'Content-Type' : content_type,
+            'Last-Modified': _http_date(mtime),
+            'ETag'         : etag,
+            'Cache-Control': _cache_control(path),
+        }
+        if encoding:
+            resp_headers['Content-Encoding'] = encoding
+        if path.suffix in gen_html.COMPRESS_SUFFIXES:
+            resp_headers['Vary'] = "Accept-Encoding"
+        else:
+            resp_headers['Accept-Ranges'] = "bytes"
+        if is_archiv:
+            resp_headers['Access-Control-Allow-Origin'] = "*"
+
+        if _not_modified(headers, etag, mtime):
+            return (304, resp_headers, None)
+
+        status = 200
+        offset, count = (0, stat.st_size)
+        if 'range' in headers and encoding is None and 'Accept-Ranges' in resp_headers:
+            if_range = headers.get('if-range')
+            if if_range is None or if_range.strip() == etag:
+                byte_range = parse_range(headers['range'], stat.st_size)
+                if byte_range:
+                    status = 206
+                    offset, count = byte_range
+                    resp_headers['Content-Range'] = f"bytes {offset}-{offset + count - 1}/{stat.st_size}"
+
+        resp_headers['Content-Length'] = str(count)
+        return (status, resp_headers, (file_path, offset, count))
+
+    async def _send(self, writer, head: bytes, body: tuple | None) -> None:
+        if body is None or body[2] == 0:
+            writer.write(head)
+            await writer.drain()
+            return
+
+        file_path, offset, count = body
+        with file_path.open(mode='rb') as fobj:
+            if count < SENDFILE_MIN_BYTES:
+                fobj.seek(offset)
+                writer.write(head + fobj.read(count))
+                await writer.drain()
+            else:
+                writer.write(head)
+                await asyncio.get_running_loop().sendfile(writer.transport, fobj, offset, count)
+
+    async def handle(self, reader, writer) -> None:
+        peer = (writer.get_extra_info('peername') or ("-",))[0]
+        try:
+            keep_alive = True
+            while keep_alive:
+                keep_alive = await self._handle_request(reader, writer, peer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def _handle_request(self, reader, writer, peer: str) -> bool:
+        """Respond to the next request, returns whether the connection is kept open."""
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT_SECS)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            return False
+        except asyncio.LimitOverrunError:
+            head = None
+
+        method, target, version, headers = ("-", "-", "HTTP/1.0", {})
+        keep_alive = False
+        try:
+            if head is None:
+                raise HTTPError(431)
+
+            lines = head.decode("latin-1").split("\r\n")
+            request_line = lines[0].split(" ")
+            if len(request_line) != 3 or not request_line[2].startswith("HTTP/1."):
+                raise HTTPError(400)
+
+            method, target, version = request_line
+            for line in lines[1:]:
+                if line:
+                    name, sep, value = line.partition(":")
+                    if not sep:
+                        raise HTTPError(400)
+                    headers[name.strip().lower()] = value.strip()
+
+            connection = headers.get('connection', "").lower()
+            if version == "HTTP/1.0":
+                keep_alive = connection == "keep-alive"
+            else:
+                keep_alive = connection != "close"
+            if 'content-length' in headers or 'transfer-encoding' in headers:
+                # request bodies aren't read, so the stream can't be reused
+                keep_alive = False
+
+            status, resp_headers, body = self.respond(method, target, headers)
+        except HTTPError as ex:
+            status, resp_headers = (ex.status, ex.headers)
+            reason = ht.HTTPStatus(status).phrase.encode("ascii")
+            body = None
+            if status >= 400:
+                resp_headers['Content-Type'] = "text/plain; charset=utf-8"
+                resp_headers['Content-Length'] = str(len(reason) + 1)
+            else:
+                resp_headers['Content-Length'] = "0"
+        except OSError:
+            status, resp_headers, body = (500, {'Content-Length': "0"}, None)
+
+        if keep_alive:
+            resp_headers['Keep-Alive'] = f"timeout={KEEPALIVE_TIMEOUT_SECS}"
+        else:
+            resp_headers['Connection'] = "close"
+
+        head_lines = [f"HTTP/1.1 {status} {ht.HTTPStatus(status).phrase}", f"Date: {_now_date()}"]
+        head_lines += [f"{name}: {value}" for name, value in resp_headers.items()]
+        resp_head = ("\r\n".join(head_lines) + "\r\n\r\n").encode("latin-1")
+        if status >= 400 and method != "HEAD":
+            resp_head += ht.HTTPStatus(status).phrase.encode("ascii") + b"\n"
+
+        await self._send(writer, resp_head, body if method == "GET" else None)
+
+        if not self.quiet:
+            length = body[2] if body and method == "GET" else 0
+            print(f"{peer:<15} {method:<4} {status} {length:>10} {headers.get('host', '-')}{target}")
+        return keep_alive
+
+
+async def serve(sock: socket.socket, server: Server) -> None:
+    async_server = await asyncio.start_server(server.handle, sock=sock, limit=MAX_HEADER_BYTES)
+    async with async_server:
+        await async_server.serve_forever()
+
+
+def _parse_options(args: list[str]) -> tuple[dict, list[str]]:
+    options = {'vhost': []}
+    positional = []
+    for arg in args:
+        match = re.match(r"--([\w-]+)(?:=(.*))?$", arg)
+        if match is None:
+            positional.append(arg)
+        elif match.group(2) is None:
+            options[match.group(1)] = True
+        elif match.group(1) == "vhost":
+            options['vhost'].append(match.group(2))
+        else:
+            options[match.group(1)] = match.group(2)
+    return (options, positional)
+
+
+def main(args: list[str]) -> int:
+    options, positional = _parse_options(args)
+    if "help" in options or positional:
+        print(__doc__)
+        return 0
+
+    root_dir = pl.Path(options.get('root', ROOT_DIR)).absolute()
+    vhosts = {}
+    for vhost in options['vhost']:
+        host, _, host_dir = vhost.partition("=")
+        vhosts[host.lower()] = pl.Path(host_dir).absolute()
+    archiv_dirs = archiv_vhosts(root_dir)
+
+    port = int(options.get('port', DEFAULT_PORT))
+    bind = options.get('bind', DEFAULT_BIND)
+    workers = int(options.get('workers', 1))
+
+    sock = socket.create_server((bind, port), backlog=LISTEN_BACKLOG)
+    print(f"serving     {root_dir} on http://{bind}:{port}/ ({workers} workers)")
+    for num, repo_dir in archiv_dirs.items():
+        print(f"serving     {repo_dir} on archiv{num}.*")
+    for host, host_dir in vhosts.items():
+        print(f"serving     {host_dir} on {host}")
+    sys.stdout.flush()
+
+    # pre-fork, all workers accept on the same socket
+    for _ in range(workers - 1):
+        if os.fork() == 0:
+            break
+
+    server = Server(root_dir, vhosts, archiv_dirs, quiet="quiet" in options)
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(serve(sock, server))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))